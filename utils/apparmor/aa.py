@@ -14,6 +14,7 @@
 # ----------------------------------------------------------------------
 # No old version logs, only 2.6 + supported
 from __future__ import division, with_statement
+import collections
 import inspect
 import os
 import re
@@ -26,15 +27,12 @@ import atexit
 import tempfile
 
 import apparmor.config
-import apparmor.logparser
-import apparmor.severity
-
-from copy import deepcopy
 
 from apparmor.common import (AppArmorException, AppArmorBug, open_file_read, valid_path, hasher,
-                             open_file_write, convert_regexp, DebugLogger)
+                             open_file_write, convert_regexp, regexp_cache, DebugLogger, cmd)
 
 import apparmor.ui as aaui
+import apparmor.instrument as instrument
 
 from apparmor.aamode import (str_to_mode, mode_to_str, contains, split_mode,
                              mode_to_str_user, mode_contains, AA_OTHER,
@@ -49,14 +47,21 @@ from apparmor.regex import (RE_PROFILE_START, RE_PROFILE_END, RE_PROFILE_LINK,
                             RE_PROFILE_HAT_DEF, RE_PROFILE_DBUS, RE_PROFILE_MOUNT,
                             RE_PROFILE_SIGNAL, RE_PROFILE_PTRACE, RE_PROFILE_PIVOT_ROOT,
                             RE_PROFILE_UNIX, RE_RULE_HAS_COMMA, RE_HAS_COMMENT_SPLIT,
+                            RE_PROFILE_LINE_KEYWORD,
                             strip_quotes, parse_profile_start_line, re_match_include )
 
 import apparmor.rules as aarules
 
-from apparmor.rule.capability import CapabilityRuleset, CapabilityRule
-from apparmor.rule.change_profile import ChangeProfileRuleset, ChangeProfileRule
+from apparmor.pathmatcher import get_path_matcher, PathIndex, PathRules
+
+from apparmor.profile_storage import ProfileStorage, intern_name
+
+from apparmor.snapshot import SnapshotStore, snapshot_copy
+
+from apparmor.rule.capability import CapabilityRule
+from apparmor.rule.change_profile import ChangeProfileRule
 from apparmor.rule.network    import NetworkRuleset,    NetworkRule
-from apparmor.rule.rlimit     import RlimitRuleset,    RlimitRule
+from apparmor.rule.rlimit     import RlimitRule
 from apparmor.rule import parse_modifiers, quote_if_needed
 
 from apparmor.yasti import SendDataToYast, GetDataFromYast, shutdown_yast
@@ -87,8 +92,25 @@ logger = None
 profile_dir = None
 extra_profile_dir = None
 ### end our
+# Cache for parsed profiles and includes, see load_cached_profile_data()
+# None until first use (see get_parse_cache()), False if caching is disabled
+parse_cache = None
+# Resolver for the libraries needed by binaries, see get_elf_resolver()
+elf_resolver = None
+# Index of the profile names and attachments in profile_dir, see get_profile_index()
+profile_index = None
+# Number of worker processes to use for parsing the log and the profiles
+parallel_jobs = 1
+# Parse records of files parsed by prefetch_profile_data(), see load_cached_profile_data()
+prefetched_records = dict()
+# If set, the apparmor.logparser.LogCursor to start reading the log at
+log_cursor = None
 # To keep track of previously included profile fragments
 include = dict()
+# Flattened include closures, see include_closure()
+include_closures = dict()
+# profile_dir -> reverse index of the loaded includes, see get_include_index()
+include_index = dict()
 
 existing_profiles = dict()
 
@@ -105,7 +127,7 @@ t = hasher()  # dict()
 transitions = hasher()
 
 aa = hasher()  # Profiles originally in sd, replace by aa
-original_aa = hasher()
+original_aa = SnapshotStore()  # Snapshot of aa as it was read from disk, used to diff changes
 extras = hasher()  # Inactive profiles from extras
 ### end our
 log = []
@@ -276,18 +298,29 @@ def enforce(path):
 
 def set_complain(filename, program):
     """Sets the profile to complain mode"""
+    change_profile_flags(*prepare_complain(filename, program))
+
+def prepare_complain(filename, program):
+    """Does everything needed to set the profile to complain mode except changing
+       the flags. Returns the (filename, program, flag, set_flag) change for
+       change_profile_flags() or change_profiles_flags()"""
     aaui.UI_Info(_('Setting %s to complain mode.') % (filename if program is None else program))
     # a force-complain symlink is more packaging-friendly, but breaks caching
     # create_symlink('force-complain', filename)
     delete_symlink('disable', filename)
-    change_profile_flags(filename, program, 'complain', True)
+    return (filename, program, 'complain', True)
 
 def set_enforce(filename, program):
     """Sets the profile to enforce mode"""
+    change_profile_flags(*prepare_enforce(filename, program))
+
+def prepare_enforce(filename, program):
+    """Does everything needed to set the profile to enforce mode except changing
+       the flags. Returns the change like prepare_complain()"""
     aaui.UI_Info(_('Setting %s to enforce mode.') % (filename if program is None else program))
     delete_symlink('force-complain', filename)
     delete_symlink('disable', filename)
-    change_profile_flags(filename, program, 'complain', False)
+    return (filename, program, 'complain', False)
 
 def delete_symlink(subdir, filename):
     path = filename
@@ -355,12 +388,63 @@ def get_output(params):
         output.pop()
     return (ret, output)
 
+def get_elf_resolver():
+    '''Return the resolver for the libraries needed by ELF files (created on first use)'''
+    global elf_resolver
+    if elf_resolver is None:
+        import apparmor.elf
+        cache_file = None
+        if cfg['settings'].get('cachedir', False):
+            cache_file = os.path.join(cfg['settings']['cachedir'], 'elf.json')
+        elf_resolver = apparmor.elf.LibraryResolver(cache_file)
+        atexit.register(elf_resolver.save)
+    return elf_resolver
+
+def find_tool(setting, default, name):
+    '''Return the path of the tool configured as setting in logprof.conf (or default).
+       Raises an AppArmorException if it isn't an executable file.'''
+    path = conf.find_first_file(cfg['settings'][setting]) or default
+    if not os.path.isfile(path) or not os.access(path, os.EX_OK):
+        raise AppArmorException('Can\'t find %s' % name)
+    return path
+
+def get_parser():
+    '''Return the path of apparmor_parser (looked up on first use)'''
+    global parser
+    if parser is None:
+        parser = find_tool('parser', '/sbin/apparmor_parser', 'apparmor_parser')
+    return parser
+
+def get_ldd():
+    '''Return the path of ldd (looked up on first use)'''
+    global ldd
+    if ldd is None:
+        ldd = find_tool('ldd', '/usr/bin/ldd', 'ldd')
+    return ldd
+
+def get_logger():
+    '''Return the path of logger (looked up on first use)'''
+    global logger
+    if logger is None:
+        logger = find_tool('logger', '/bin/logger', 'logger')
+    return logger
+
 def get_reqs(file):
+    """Returns a list of paths of the libraries file needs (directly and indirectly)"""
+    with instrument.span('get_reqs', file=file):
+        reqs = get_elf_resolver().get_reqs(file)
+        if reqs is None:
+            # an ELF file the resolver can't handle
+            instrument.count('ldd calls')
+            reqs = get_reqs_ldd(file)
+    return reqs
+
+def get_reqs_ldd(file):
     """Returns a list of paths from ldd output"""
     pattern1 = re.compile('^\s*\S+ => (\/\S+)')
     pattern2 = re.compile('^\s*(\/\S+)')
     reqs = []
-    ret, ldd_out = get_output([ldd, file])
+    ret, ldd_out = get_output([get_ldd(), file])
     if ret == 0:
         for line in ldd_out:
             if 'not a dynamic executable' in line:
@@ -385,8 +469,7 @@ def handle_binfmt(profile, path):
     while reqs:
         library = reqs.pop()
         if not reqs_processed.get(library, False):
-            if get_reqs(library):
-                reqs += get_reqs(library)
+            reqs += get_reqs(library)
             reqs_processed[library] = True
         combined_mode = match_prof_incs_to_path(profile, 'allow', library)
         if combined_mode:
@@ -403,31 +486,8 @@ def get_inactive_profile(local_profile):
     return dict()
 
 def profile_storage():
-    # keys used in aa[profile][hat]:
-    # a) rules (as dict): alias, include, lvar
-    # b) rules (as hasher): allow, deny
-    # c) one for each rule class
-    # d) other: external, flags, name, profile, attachment, initial_comment,
-    #           profile_keyword, header_comment (these two are currently only set by set_profile_flags())
-
-    # Note that this function doesn't explicitely init all those keys (yet).
-    # It will be extended over time, with the final goal to get rid of hasher().
-
-    profile = hasher()
-
-    profile['capability']       = CapabilityRuleset()
-    profile['change_profile']   = ChangeProfileRuleset()
-    profile['network']          = NetworkRuleset()
-    profile['rlimit']           = RlimitRuleset()
-
-    profile['allow']['path'] = hasher()
-    profile['allow']['dbus'] = list()
-    profile['allow']['mount'] = list()
-    profile['allow']['signal'] = list()
-    profile['allow']['ptrace'] = list()
-    profile['allow']['pivot_root'] = list()
-
-    return profile
+    # see apparmor.profile_storage for the keys used in aa[profile][hat]
+    return ProfileStorage()
 
 def create_new_profile(localfile, is_stub=False):
     local_profile = hasher()
@@ -476,7 +536,7 @@ def create_new_profile(localfile, is_stub=False):
         created.append(localfile)
         changed[localfile] = True
 
-    debug_logger.debug("Profile for %s:\n\t%s" % (localfile, local_profile.__str__()))
+    debug_logger.debug("Profile for %s:\n\t%s", localfile, local_profile)
     return {localfile: local_profile}
 
 def delete_profile(local_prof):
@@ -673,6 +733,51 @@ def change_profile_flags(filename, program, flag, set_flag):
 
     set_profile_flags(filename, program, newflags)
 
+def _change_flags_worker(args):
+    '''Worker function for change_profiles_flags()
+
+       Apply the (program, flag, set_flag) changes to filename, and return
+       (filename, None), or (filename, error message) if that failed.'''
+    filename, changes = args
+    try:
+        for program, flag, set_flag in changes:
+            change_profile_flags(filename, program, flag, set_flag)
+    except (AppArmorException, AppArmorBug, IOError, OSError) as e:
+        return filename, str(e)
+    return filename, None
+
+def change_profiles_flags(changes, jobs=None):
+    '''Run change_profile_flags() for a list of (filename, program, flag, set_flag)
+       in jobs (default: parallel_jobs) worker processes.
+
+       Changes to the same file are applied in order by the same worker.
+       Returns a dict filename -> error message (or None if the file was
+       changed successfully).'''
+    if jobs is None:
+        jobs = parallel_jobs
+
+    files = collections.OrderedDict()
+    for filename, program, flag, set_flag in changes:
+        files.setdefault(filename, []).append((program, flag, set_flag))
+    instrument.count('profiles flags changed', len(files))
+
+    with instrument.span('change_profiles_flags', files=len(files)):
+        if jobs <= 1 or len(files) <= 1:
+            return dict(_change_flags_worker(args) for args in files.items())
+
+        # only needed here, and expensive to import
+        import multiprocessing
+
+        pool = multiprocessing.Pool(min(jobs, len(files)), _init_parse_worker, (profile_dir,))
+        try:
+            chunksize = max(1, len(files) // (jobs * 4))
+            results = dict(pool.imap_unordered(_change_flags_worker, list(files.items()), chunksize))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return results
+
 def set_profile_flags(prof_filename, program, newflags):
     """Reads the old profile file and updates the flags accordingly"""
     # TODO: count the number of matching lines (separated by profile and hat?) and return it
@@ -688,38 +793,44 @@ def set_profile_flags(prof_filename, program, newflags):
 
     with open_file_read(prof_filename) as f_in:
         temp_file = tempfile.NamedTemporaryFile('w', prefix=prof_filename, suffix='~', delete=False, dir=profile_dir)
-        shutil.copymode(prof_filename, temp_file.name)
-        with open_file_write(temp_file.name) as f_out:
-            for line in f_in:
-                if RE_PROFILE_START.search(line):
-                    matches = parse_profile_start_line(line, prof_filename)
-                    space = matches['leadingspace'] or ''
-                    profile = matches['profile']
-
-                    if profile == program or program is None:
-                        found = True
-                        header_data = {
-                            'attachment': matches['attachment'] or '',
-                            'flags': newflags,
-                            'profile_keyword': matches['profile_keyword'],
-                            'header_comment': matches['comment'] or '',
-                        }
-                        line = write_header(header_data, len(space)/2, profile, False, True)
-                        line = '%s\n' % line[0]
-                elif RE_PROFILE_HAT_DEF.search(line):
-                    matches = RE_PROFILE_HAT_DEF.search(line)
-                    space = matches.group('leadingspace') or ''
-                    hat_keyword = matches.group('hat_keyword')
-                    hat = matches.group('hat')
-                    comment = matches.group('comment') or ''
-                    if comment:
-                        comment = ' %s' % comment
-
-                    if newflags:
-                        line = '%s%s%s flags=(%s) {%s\n' % (space, hat_keyword, hat, newflags, comment)
-                    else:
-                        line = '%s%s%s {%s\n' % (space, hat_keyword, hat, comment)
-                f_out.write(line)
+        temp_file.close()
+        try:
+            shutil.copymode(prof_filename, temp_file.name)
+            with open_file_write(temp_file.name) as f_out:
+                for line in f_in:
+                    if RE_PROFILE_START.search(line):
+                        matches = parse_profile_start_line(line, prof_filename)
+                        space = matches['leadingspace'] or ''
+                        profile = matches['profile']
+
+                        if profile == program or program is None:
+                            found = True
+                            header_data = {
+                                'attachment': matches['attachment'] or '',
+                                'flags': newflags,
+                                'profile_keyword': matches['profile_keyword'],
+                                'header_comment': matches['comment'] or '',
+                            }
+                            line = write_header(header_data, len(space)/2, profile, False, True)
+                            line = '%s\n' % line[0]
+                    elif RE_PROFILE_HAT_DEF.search(line):
+                        matches = RE_PROFILE_HAT_DEF.search(line)
+                        space = matches.group('leadingspace') or ''
+                        hat_keyword = matches.group('hat_keyword')
+                        hat = matches.group('hat')
+                        comment = matches.group('comment') or ''
+                        if comment:
+                            comment = ' %s' % comment
+
+                        if newflags:
+                            line = '%s%s%s flags=(%s) {%s\n' % (space, hat_keyword, hat, newflags, comment)
+                        else:
+                            line = '%s%s%s {%s\n' % (space, hat_keyword, hat, comment)
+                    f_out.write(line)
+        except:
+            # the profile is only replaced (atomically) if the new version was written completely
+            os.unlink(temp_file.name)
+            raise
     os.rename(temp_file.name, prof_filename)
 
     if not found:
@@ -728,6 +839,48 @@ def set_profile_flags(prof_filename, program, newflags):
         else:
             raise AppArmorBug("%(file)s doesn't contain a valid profile for %(profile)s (syntax error?)" % {'file': prof_filename, 'profile': program})
 
+def get_profile_index():
+    '''Return the index of the profile names and attachments in profile_dir
+       (created on first use, and cached in the cachedir)'''
+    global profile_index
+    if profile_index is None or profile_index.profile_dir != profile_dir:
+        import apparmor.cache
+        import apparmor.profile_index
+        if profile_index is None:
+            atexit.register(save_profile_index)
+        else:
+            # the exit handler only saves the current index
+            profile_index.save()
+        cache_file = None
+        if cfg['settings'].get('cachedir', False):
+            # one cache file per profile_dir, so switching between them doesn't invalidate it
+            cache_file = os.path.join(cfg['settings']['cachedir'], 'profile_index-%s.json' % apparmor.cache.cache_key(profile_dir))
+        with instrument.span('profile_index'):
+            profile_index = apparmor.profile_index.ProfileIndex(profile_dir, is_skippable_file, cache_file)
+    return profile_index
+
+def save_profile_index():
+    '''Write the cache file of the profile index (if it was used)'''
+    if profile_index is not None:
+        profile_index.save()
+
+def find_profile(name):
+    '''Return (profile name, file) for the profile name (or the profile attached
+       to the path name) without parsing all profiles, or (None, None) if
+       there is no such profile'''
+    if existing_profiles.get(name, False):
+        return name, existing_profiles[name]
+    return get_profile_index().find(name)
+
+def read_profile_for(name):
+    '''Parse only the file containing the profile for name (and its includes)
+       instead of all profiles like read_profiles(). Returns the profile name
+       and file like find_profile().'''
+    profile, filename = find_profile(name)
+    if filename and not filelist.get(filename, False):
+        read_profile(filename, True)
+    return profile, filename
+
 def profile_exists(program):
     """Returns True if profile exists, False otherwise"""
     # Check cache of profiles
@@ -1475,7 +1628,7 @@ def handle_children(profile, hat, root):
 
                                 aa[profile][hat]['flags'] = 'complain'
 
-                                aa[profile][hat]['allow']['path'] = hasher()
+                                aa[profile][hat]['allow']['path'] = PathRules()
                                 if stub_profile[hat][hat]['allow'].get('path', False):
                                     aa[profile][hat]['allow']['path'] = stub_profile[hat][hat]['allow']['path']
 
@@ -1754,33 +1907,10 @@ def ask_the_questions():
                     if not mode_contains(allow_mode, mode):
                         default_option = 1
                         options = []
-                        newincludes = []
-                        include_valid = False
-
-                        for incname in include.keys():
-                            include_valid = False
-                            # If already present skip
-                            if aa[profile][hat]['include'].get(incname, False):
-                                continue
-                            if incname.startswith(profile_dir):
-                                incname = incname.replace(profile_dir + '/', '', 1)
-
-                            include_valid = valid_include('', incname)
-
-                            if not include_valid:
-                                continue
-
-                            cm, am, m = match_include_to_path(incname, 'allow', path)
-
-                            if cm and mode_contains(cm, mode):
-                                dm = match_include_to_path(incname, 'deny', path)[0]
-                                # If the mode is denied
-                                if not mode & dm:
-                                    if not list(filter(lambda s: '/**' == s, m)):
-                                        newincludes.append(incname)
+                        newincludes = suggest_includes_for_path(aa[profile][hat], path, mode)
                         # Add new includes to the options
                         if newincludes:
-                            options += list(map(lambda s: '#include <%s>' % s, sorted(set(newincludes))))
+                            options += list(map(lambda s: '#include <%s>' % s, newincludes))
                         # We should have literal the path in options list too
                         options.append(path)
                         # Add any the globs matching path from logprof
@@ -2101,13 +2231,100 @@ def delete_duplicates(profile, incname):
 
 def match_includes(profile, rule_type, rule_obj):
     newincludes = []
-    for incname in include.keys():
+    for incname in get_include_index()['valid']:
+        if profile and profile['include'].get(incname, False):
+            continue
+        incdata = include.get(incname, {}).get(incname, {})
         # XXX type check should go away once we init all profiles correctly
-        if valid_include(profile, incname) and include[incname][incname].get(rule_type, False) and include[incname][incname][rule_type].is_covered(rule_obj):
+        if incdata and incdata.get(rule_type, False) and incdata[rule_type].is_covered(rule_obj):
             newincludes.append(incname)
 
     return newincludes
 
+def get_include_index():
+    '''Return the reverse index of the loaded includes (built on first use)
+
+       The index is a dict with
+         'valid': the names of the includes that pass valid_include()
+         'users': include file -> valid includes whose include_closure() contains the file
+         'allow', 'deny': PathIndex of the path rules in all include files
+       It gets rebuilt after loading another include.'''
+    index = include_index.get(profile_dir)
+    if index is not None:
+        return index
+
+    with instrument.span('build include index'):
+        loaded = None
+        # include_closure() might load more includes, which need to be indexed too
+        while loaded != len(include):
+            loaded = len(include)
+            valid = []
+            users = dict()
+            for incname in list(include.keys()):
+                if incname.startswith(profile_dir):
+                    incname = incname.replace(profile_dir + '/', '', 1)
+                if not valid_include('', incname):
+                    continue
+                valid.append(incname)
+                for incfile in include_closure(incname):
+                    users.setdefault(incfile, []).append(incname)
+
+        index = {'valid': valid, 'users': users}
+        for allow in ['allow', 'deny']:
+            fragments = []
+            for incfile in include:
+                incdata = include[incfile].get(incfile, {})
+                if incdata:
+                    fragments.append((incfile, incdata[allow]['path']))
+            index[allow] = PathIndex(fragments)
+
+    include_index.clear()
+    include_index[profile_dir] = index
+    return index
+
+def _include_files_mode(index, allow, incfiles, path):
+    '''Return the mode and the matching entries of the allow or deny rules for path in incfiles'''
+    combinedmode = set()
+    matches = []
+    found = index[allow].match(path)
+    for incfile in incfiles:
+        if incfile not in found:
+            continue
+        rules = include[incfile][incfile][allow]['path']
+        mode = set()
+        for entry in found[incfile]:
+            mode |= rules[entry].get('mode', set())
+        if mode:
+            combinedmode |= mode
+            matches += found[incfile]
+    return combinedmode, matches
+
+def suggest_includes_for_path(profile, path, mode):
+    '''Return the valid includes that allow mode for path and don't deny it
+       (like match_include_to_path() for each include), sorted by name.
+       Includes already used in profile and includes that only match
+       because of a /** rule are skipped.'''
+    index = get_include_index()
+    candidates = set()
+    for incfile in index['allow'].match(path):
+        candidates.update(index['users'].get(incfile, []))
+
+    newincludes = []
+    for incname in candidates:
+        if profile and profile['include'].get(incname, False):
+            continue
+
+        incfiles = include_closure(incname)
+        cm, m = _include_files_mode(index, 'allow', incfiles, path)
+        if not cm or not mode_contains(cm, mode):
+            continue
+        dm = _include_files_mode(index, 'deny', incfiles, path)[0]
+        if mode & dm or '/**' in m:
+            continue
+        newincludes.append(incname)
+
+    return sorted(newincludes)
+
 def valid_include(profile, incname):
     if profile and profile['include'].get(incname, False):
         return False
@@ -2161,10 +2378,15 @@ def do_logprof_pass(logmark='', passno=0, pid=pid):
 
     if not passno:
         aaui.UI_Info(_('Updating AppArmor profiles in %s.') % profile_dir)
-        read_profiles()
+        with instrument.span('read_profiles'):
+            read_profiles()
+
+    # only needed here, and expensive to import
+    import apparmor.logparser
+    import apparmor.severity
 
     if not sev_db:
-        sev_db = apparmor.severity.Severity(CONFDIR + '/severity.db', _('unknown'))
+        sev_db = apparmor.severity.Severity(CONFDIR + '/severity.db', _('unknown'), cfg['settings'].get('cachedir'))
     #print(pid)
     #print(existing_profiles)
     ##if not repo_cf and cfg['repostory']['url']:
@@ -2172,21 +2394,32 @@ def do_logprof_pass(logmark='', passno=0, pid=pid):
     ##    if not repo_cfg['repository'].get('enabled', False) or repo_cfg['repository]['enabled'] not in ['yes', 'no']:
     ##    UI_ask_to_enable_repo()
 
-    log_reader = apparmor.logparser.ReadLog(pid, logfile, existing_profiles, profile_dir, log)
-    log = log_reader.read_log(logmark)
+    log_reader = apparmor.logparser.ReadLog(pid, logfile, existing_profiles, profile_dir, log, log_cursor)
+    # This can't use get_events() to handle the log in batches: handle_children()
+    # tracks the profile and hat of each process along the complete list of its
+    # events (events of null-complain-profile inherit them, unknown_hat and
+    # fork entries change them, some answers stop handling the process), and
+    # collapse_log() and ask_the_questions() work on everything collected so far.
+    with instrument.span('read_log', jobs=parallel_jobs):
+        log = log_reader.read_log(logmark, parallel_jobs)
     #read_log(logmark)
 
-    for root in log:
-        handle_children('', '', root)
-    #for root in range(len(log)):
-        #log[root] = handle_children('', '', log[root])
-    #print(log)
-    for pid in sorted(profile_changes.keys()):
-        set_process(pid, profile_changes[pid])
+    with instrument.span('handle_children'):
+        for root in log:
+            handle_children('', '', root)
+        #for root in range(len(log)):
+            #log[root] = handle_children('', '', log[root])
+        #print(log)
+        for pid in sorted(profile_changes.keys()):
+            set_process(pid, profile_changes[pid])
 
-    collapse_log()
+    with instrument.span('collapse_log'):
+        collapse_log()
 
-    ask_the_questions()
+    questions = seen_events
+    with instrument.span('ask_the_questions'):
+        ask_the_questions()
+    instrument.count('questions', seen_events - questions)
 
     if aaui.UI_mode == 'yast':
         # To-Do
@@ -2194,7 +2427,8 @@ def do_logprof_pass(logmark='', passno=0, pid=pid):
 
     finishing = False
     # Check for finished
-    save_profiles()
+    with instrument.span('save_profiles'):
+        save_profiles()
 
     ##if not repo_cfg['repository'].get('upload', False) or repo['repository']['upload'] == 'later':
     ##    UI_ask_to_upload_profiles()
@@ -2211,6 +2445,16 @@ def do_logprof_pass(logmark='', passno=0, pid=pid):
 
 
 def save_profiles():
+    '''Ask which changed profiles to save, write them and reload them (with one parser call)'''
+    queue = ReloadQueue()
+    try:
+        _save_profiles(queue)
+    finally:
+        # also reload the profiles that were saved before an abort
+        if queue:
+            report_reload_failures(queue.flush())
+
+def _save_profiles(queue):
     # Ensure the changed profiles are actual active profiles
     for prof_name in changed.keys():
         if not is_active_profile(prof_name):
@@ -2246,7 +2490,7 @@ def save_profiles():
                 selected_profiles_ref = yarg['PROFILES']
                 for profile_name in selected_profiles_ref:
                     write_profile_ui_feedback(profile_name)
-                    reload_base(profile_name)
+                    reload_base(profile_name, queue)
 
         else:
             q = aaui.PromptQuestion()
@@ -2265,7 +2509,7 @@ def save_profiles():
                 if ans == 'CMD_SAVE_SELECTED':
                     profile_name = list(changed.keys())[arg]
                     write_profile_ui_feedback(profile_name)
-                    reload_base(profile_name)
+                    reload_base(profile_name, queue)
 
                 elif ans == 'CMD_VIEW_CHANGES':
                     which = list(changed.keys())[arg]
@@ -2287,7 +2531,7 @@ def save_profiles():
 
             for profile_name in sorted(changed.keys()):
                 write_profile_ui_feedback(profile_name)
-                reload_base(profile_name)
+                reload_base(profile_name, queue)
 
 def get_pager():
     pass
@@ -2468,12 +2712,20 @@ def read_profiles():
     except:
         fatal_error(_("Can't read AppArmor profiles in %s") % profile_dir)
 
+    files = []
     for file in os.listdir(profile_dir):
         if os.path.isfile(profile_dir + '/' + file):
             if is_skippable_file(file):
                 continue
             else:
-                read_profile(profile_dir + '/' + file, True)
+                files.append(profile_dir + '/' + file)
+
+    prefetch_profile_data([(file, file, False) for file in files])
+    try:
+        for file in files:
+            read_profile(file, True)
+    finally:
+        prefetched_records.clear()
 
 def read_inactive_profiles():
     if not os.path.exists(extra_profile_dir):
@@ -2483,36 +2735,228 @@ def read_inactive_profiles():
     except:
         fatal_error(_("Can't read AppArmor profiles in %s") % extra_profile_dir)
 
+    files = []
     for file in os.listdir(profile_dir):
         if os.path.isfile(extra_profile_dir + '/' + file):
             if is_skippable_file(file):
                 continue
             else:
-                read_profile(extra_profile_dir + '/' + file, False)
+                files.append(extra_profile_dir + '/' + file)
 
-def read_profile(file, active_profile):
-    data = None
+    prefetch_profile_data([(file, file, False) for file in files])
     try:
-        with open_file_read(file) as f_in:
-            data = f_in.readlines()
-    except IOError:
-        debug_logger.debug("read_profile: can't read %s - skipping" % file)
-        return None
+        for file in files:
+            read_profile(file, False)
+    finally:
+        prefetched_records.clear()
+
+def read_profile(file, active_profile):
+    profile_data = load_cached_profile_data(file, file, False)
+    if profile_data is None:
+        data = None
+        try:
+            with open_file_read(file) as f_in:
+                data = f_in.readlines()
+        except IOError:
+            debug_logger.debug("read_profile: can't read %s - skipping", file)
+            return None
 
-    profile_data = parse_profile_data(data, file, 0)
+        profile_data = parse_profile_data(data, file, 0)
+        store_cached_profile_data(file, file, False, profile_data)
 
+    # profile_data was just parsed (or loaded from the cache) and isn't used
+    # elsewhere, so it can be attached without copying it. original_aa
+    # stores a snapshot anyway.
     if profile_data and active_profile:
-        attach_profile_data(aa, profile_data)
         attach_profile_data(original_aa, profile_data)
+        attach_profile_data(aa, profile_data, False)
     elif profile_data:
-        attach_profile_data(extras, profile_data)
+        attach_profile_data(extras, profile_data, False)
+
+
+def _parse_cache_key(file, do_include):
+    # parse_profile_data() results also depend on these settings
+    return (file, bool(do_include), profile_dir, sorted(cfg['required_hats'].items()))
+
+def get_parse_cache():
+    '''Return the cache for parsed profiles (created on first use), or False if caching is disabled'''
+    global parse_cache
+    if parse_cache is None:
+        if cfg['settings'].get('cachedir', False):
+            import apparmor.cache
+            # the cached data contains instances of the classes in apparmor/ and
+            # apparmor/rule/, so an update of any of these modules invalidates it
+            version = apparmor.cache.modules_version(os.path.dirname(os.path.abspath(__file__)))
+            parse_cache = apparmor.cache.FileCache(cfg['settings']['cachedir'], 'profiles', version)
+        else:
+            parse_cache = False
+    return parse_cache
+
+def load_cached_profile_data(path, file, do_include):
+    '''Return the cached result of parse_profile_data() for the profile or
+       include in path, or None if it isn't cached.
+       Replays the side effects of parse_profile_data() (filelist,
+       existing_profiles and loading the includes) on a cache hit.
+
+       Files parsed by prefetch_profile_data() are used (once) before
+       checking the parse cache.'''
+    cached = prefetched_records.pop((path, file, bool(do_include)), None)
+    if cached is None:
+        if not get_parse_cache():
+            return None
+        cached = parse_cache.load(path, _parse_cache_key(file, do_include))
+        if cached is None:
+            instrument.count('parse cache misses')
+            return None
+        instrument.count('parse cache hits')
+
+    return apply_parse_record(file, cached)
+
+def store_cached_profile_data(path, file, do_include, profile_data):
+    '''Store the result of parse_profile_data() for path in the parse cache'''
+    if not get_parse_cache():
+        return
+
+    parse_cache.store(path, make_parse_record(file, profile_data), _parse_cache_key(file, do_include))
+
+def make_parse_record(file, profile_data):
+    '''Return the result of parse_profile_data() for file, together with its
+       side effects (see apply_parse_record()), as a picklable dict'''
+    includes = []
+    if filelist.get(file, False):
+        includes += filelist[file].get('include', {}).keys()
+    for profile in profile_data:
+        for hat in profile_data[profile]:
+            includes += profile_data[profile][hat].get('include', {}).keys()
+
+    return {
+        'profile_data': profile_data,
+        'filelist': filelist.get(file),
+        'profiles': [p for p in profile_data if existing_profiles.get(p) == file],
+        'includes': includes,
+    }
+
+def apply_parse_record(file, record):
+    '''Replay the side effects of parse_profile_data() stored in record
+       (filelist, existing_profiles and loading the includes), and return
+       the parsed profile_data.
+       Raises the parser error if parsing the file failed.'''
+    if record.get('error'):
+        raise record['error']
+
+    if record['filelist'] is not None:
+        filelist[file] = record['filelist']
+    for profile in record['profiles']:
+        existing_profiles[profile] = file
+
+    profile_data = record['profile_data']
+    for incname in record['includes']:
+        load_include_or_dir(incname)
+
+    return profile_data
+
+def _init_parse_worker(worker_profile_dir):
+    '''Initializer for the prefetch_profile_data() and change_profiles_flags() worker
+       processes (needed if the workers don't inherit the globals of the parent process)'''
+    global profile_dir
+    profile_dir = worker_profile_dir
+
+def _parse_profile_worker(args):
+    '''Worker function for prefetch_profile_data()
+
+       Parse a profile or include file without loading the includes it
+       contains, and return (args, parse record). If parsing fails, the
+       record only contains the exception as 'error'. Returns (args, None)
+       for files that can't be read, they'll be handled when reading them
+       the usual way.'''
+    path, file, do_include = args
+
+    if get_parse_cache():
+        cached = parse_cache.load(path, _parse_cache_key(file, do_include))
+        if cached is not None:
+            return args, cached
+
+    try:
+        if do_include:
+            data = get_include_data(file)
+        else:
+            with open_file_read(path) as f_in:
+                data = f_in.readlines()
+    except (IOError, AppArmorException):
+        return args, None
 
+    # the worker might have parsed this file before
+    filelist.pop(file, None)
 
-def attach_profile_data(profiles, profile_data):
+    try:
+        profile_data = parse_profile_data(data, file, do_include, load_includes=False)
+    except AppArmorException as e:
+        return args, {'error': e}
+
+    store_cached_profile_data(path, file, do_include, profile_data)
+    return args, make_parse_record(file, profile_data)
+
+def _include_files(incname):
+    '''return the include files that load_include_or_dir(incname) will load'''
+    if os.path.isdir(profile_dir + '/' + incname):
+        return include_dir_filelist(profile_dir, incname)
+    return [incname]
+
+def prefetch_profile_data(files, jobs=None):
+    '''Parse the given files, and all includes they need, in jobs (default:
+       parallel_jobs) worker processes.
+
+       files is a list of (path, file, do_include) like the parameters of
+       load_cached_profile_data(). The parse records are stored in
+       prefetched_records, and are merged into the global data when
+       read_profile() or load_include() reach the file. This means they are
+       merged in the usual order, and parser errors are raised at the usual
+       place. Callers should clear prefetched_records when done.
+
+       Does nothing if jobs is 1.'''
+    if jobs is None:
+        jobs = parallel_jobs
+    if jobs <= 1 or not files:
+        return
+
+    # only needed here, and expensive to import
+    import multiprocessing
+
+    seen = set(files)
+    pool = multiprocessing.Pool(jobs, _init_parse_worker, (profile_dir,))
+    try:
+        while files:
+            instrument.count('files prefetched', len(files))
+            new_files = []
+            chunksize = max(1, len(files) // (jobs * 4))
+            for args, record in pool.imap(_parse_profile_worker, files, chunksize):
+                if record is None:
+                    continue
+                prefetched_records[args] = record
+
+                # also parse the includes of this file in the next round
+                for incname in record.get('includes', []):
+                    for incfile in _include_files(incname):
+                        inc_args = (profile_dir + '/' + incfile, incfile, True)
+                        if inc_args in seen or include.get(incfile, False):
+                            continue
+                        seen.add(inc_args)
+                        if os.path.isfile(inc_args[0]):
+                            new_files.append(inc_args)
+            files = new_files
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def attach_profile_data(profiles, profile_data, copy=True):
     # Make deep copy of data to avoid changes to
     # arising due to mutables
     for p in profile_data.keys():
-        profiles[p] = deepcopy(profile_data[p])
+        if copy and not isinstance(profiles, SnapshotStore):
+            profiles[p] = snapshot_copy(profile_data[p])
+        else:
+            profiles[p] = profile_data[p]
 
 
 def parse_profile_start(line, file, lineno, profile, hat):
@@ -2547,9 +2991,107 @@ def parse_profile_start(line, file, lineno, profile, hat):
     attachment = matches['attachment']
     flags = matches['flags']
 
+    profile = intern_name(profile)
+    hat = intern_name(hat)
+
     return (profile, hat, attachment, flags, in_contained_hat, pps_set_profile, pps_set_hat_external)
 
-def parse_profile_data(data, file, do_include):
+def _regex_matcher(regex):
+    # look up regex.search only when matching, to keep the regex compilation lazy
+    return lambda line: regex.search(line)
+
+# line types in parse_profile_data() with the function that matches them.
+# The order matters if a line matches more than one type - the first one wins.
+PROFILE_LINE_TYPES = [
+    ('profile_start',           _regex_matcher(RE_PROFILE_START)),
+    ('profile_end',             _regex_matcher(RE_PROFILE_END)),
+    ('capability',              CapabilityRule._cached_match),
+    ('link',                    _regex_matcher(RE_PROFILE_LINK)),
+    ('change_profile',          ChangeProfileRule._cached_match),
+    ('alias',                   _regex_matcher(RE_PROFILE_ALIAS)),
+    ('rlimit',                  RlimitRule._cached_match),
+    ('boolean',                 _regex_matcher(RE_PROFILE_BOOLEAN)),
+    ('variable',                _regex_matcher(RE_PROFILE_VARIABLE)),
+    ('conditional',             _regex_matcher(RE_PROFILE_CONDITIONAL)),
+    ('conditional_variable',    _regex_matcher(RE_PROFILE_CONDITIONAL_VARIABLE)),
+    ('conditional_boolean',     _regex_matcher(RE_PROFILE_CONDITIONAL_BOOLEAN)),
+    ('bare_file',               _regex_matcher(RE_PROFILE_BARE_FILE_ENTRY)),
+    ('path',                    _regex_matcher(RE_PROFILE_PATH_ENTRY)),
+    ('include',                 re_match_include),
+    ('network',                 NetworkRule._cached_match),
+    ('dbus',                    _regex_matcher(RE_PROFILE_DBUS)),
+    ('mount',                   _regex_matcher(RE_PROFILE_MOUNT)),
+    ('signal',                  _regex_matcher(RE_PROFILE_SIGNAL)),
+    ('ptrace',                  _regex_matcher(RE_PROFILE_PTRACE)),
+    ('pivot_root',              _regex_matcher(RE_PROFILE_PIVOT_ROOT)),
+    ('unix',                    _regex_matcher(RE_PROFILE_UNIX)),
+    ('change_hat',              _regex_matcher(RE_PROFILE_CHANGE_HAT)),
+    ('hat_def',                 _regex_matcher(RE_PROFILE_HAT_DEF)),
+]
+
+# line types that can match a line starting with the given keyword (see RE_PROFILE_LINE_KEYWORD).
+# Lines with other keywords are checked against all PROFILE_LINE_TYPES.
+PROFILE_LINE_KEYWORDS = {
+    '/':                ['profile_start', 'path'],
+    '"':                ['profile_start', 'path'],
+    'profile':          ['profile_start'],
+    '}':                ['profile_end'],
+    'capability':       ['capability'],
+    'link':             ['link'],
+    'change_profile':   ['change_profile'],
+    'alias':            ['alias'],
+    'set':              ['rlimit'],
+    '$':                ['boolean'],
+    '@':                ['variable', 'path'],
+    'if':               ['conditional', 'conditional_variable', 'conditional_boolean'],
+    'file':             ['bare_file', 'path'],
+    '#':                ['include'],
+    'include':          ['include'],
+    'network':          ['network'],
+    'dbus':             ['dbus'],
+    'mount':            ['mount'],
+    'remount':          ['mount'],
+    'umount':           ['mount'],
+    'unmount':          ['mount'],
+    'signal':           ['signal'],
+    'ptrace':           ['ptrace'],
+    'pivot_root':       ['pivot_root'],
+    'unix':             ['unix'],
+    '^':                ['change_hat', 'hat_def'],
+    'hat':              ['hat_def'],
+}
+
+_line_type_matchers = dict(PROFILE_LINE_TYPES)
+_line_type_candidates = dict((keyword, [(line_type, _line_type_matchers[line_type]) for line_type in line_types])
+                             for keyword, line_types in PROFILE_LINE_KEYWORDS.items())
+
+def classify_profile_line(line):
+    '''return (line_type, matches) for a stripped line from a profile,
+       or (None, None) if the line doesn't match any type in PROFILE_LINE_TYPES.
+
+       Instead of trying all types, only the types that can start with the
+       leading keyword of the line are checked. matches is the result of the
+       matching function (for most types the regex match object).'''
+
+    keyword = RE_PROFILE_LINE_KEYWORD.search(line)
+    candidates = None
+    if keyword:
+        candidates = _line_type_candidates.get(keyword.group('keyword'))
+    if candidates is None:
+        candidates = PROFILE_LINE_TYPES
+
+    for line_type, matcher in candidates:
+        matches = matcher(line)
+        if matches:
+            return line_type, matches
+
+    return None, None
+
+def parse_profile_data(data, file, do_include, load_includes=True):
+    '''parse the lines in data (from file), and return the profiles in it
+       Only the names of included files are stored if load_includes is False,
+       the includes themselves aren't loaded.'''
+    instrument.count('files parsed')
     profile_data = hasher()
     profile = None
     hat = None
@@ -2572,8 +3114,10 @@ def parse_profile_data(data, file, do_include):
         if lastline:
             line = '%s %s' % (lastline, line)
             lastline = None
+        line_type, matches = classify_profile_line(line)
+
         # Starting line of a profile
-        if RE_PROFILE_START.search(line):
+        if line_type == 'profile_start':
             (profile, hat, attachment, flags, in_contained_hat, pps_set_profile, pps_set_hat_external) = parse_profile_start(line, file, lineno, profile, hat)
 
             if profile_data[profile].get(hat, False):
@@ -2609,7 +3153,7 @@ def parse_profile_data(data, file, do_include):
                 profile_data[profile][profile]['repo']['url'] = repo_data['url']
                 profile_data[profile][profile]['repo']['user'] = repo_data['user']
 
-        elif RE_PROFILE_END.search(line):
+        elif line_type == 'profile_end':
             # If profile ends and we're not in one
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected End of Profile reached in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
@@ -2623,14 +3167,14 @@ def parse_profile_data(data, file, do_include):
 
             initial_comment = ''
 
-        elif CapabilityRule.match(line):
+        elif line_type == 'capability':
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected capability entry found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
 
             profile_data[profile][hat]['capability'].add(CapabilityRule.parse(line))
 
-        elif RE_PROFILE_LINK.search(line):
-            matches = RE_PROFILE_LINK.search(line).groups()
+        elif line_type == 'link':
+            matches = matches.groups()
 
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected link entry found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
@@ -2657,14 +3201,14 @@ def parse_profile_data(data, file, do_include):
             else:
                 profile_data[profile][hat][allow]['link'][link]['audit'] = set()
 
-        elif ChangeProfileRule.match(line):
+        elif line_type == 'change_profile':
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected change profile entry found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
 
             profile_data[profile][hat]['change_profile'].add(ChangeProfileRule.parse(line))
 
-        elif RE_PROFILE_ALIAS.search(line):
-            matches = RE_PROFILE_ALIAS.search(line).groups()
+        elif line_type == 'alias':
+            matches = matches.groups()
 
             from_name = strip_quotes(matches[0])
             to_name = strip_quotes(matches[1])
@@ -2676,14 +3220,14 @@ def parse_profile_data(data, file, do_include):
                     filelist[file] = hasher()
                 filelist[file]['alias'][from_name] = to_name
 
-        elif RlimitRule.match(line):
+        elif line_type == 'rlimit':
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected rlimit entry found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
 
             profile_data[profile][hat]['rlimit'].add(RlimitRule.parse(line))
 
-        elif RE_PROFILE_BOOLEAN.search(line):
-            matches = RE_PROFILE_BOOLEAN.search(line).groups()
+        elif line_type == 'boolean':
+            matches = matches.groups()
 
             if profile and not do_include:
                 raise AppArmorException(_('Syntax Error: Unexpected boolean definition found inside profile in file: %(file)s line: %(line)s') % {
@@ -2694,9 +3238,9 @@ def parse_profile_data(data, file, do_include):
 
             profile_data[profile][hat]['lvar'][bool_var] = value
 
-        elif RE_PROFILE_VARIABLE.search(line):
+        elif line_type == 'variable':
             # variable additions += and =
-            matches = RE_PROFILE_VARIABLE.search(line).groups()
+            matches = matches.groups()
 
             list_var = strip_quotes(matches[0])
             var_operation = matches[1]
@@ -2711,27 +3255,30 @@ def parse_profile_data(data, file, do_include):
                     filelist[file]['lvar'][list_var] = []
                 store_list_var(filelist[file]['lvar'], list_var, value, var_operation, file)
 
-        elif RE_PROFILE_CONDITIONAL.search(line):
+        elif line_type == 'conditional':
             # Conditional Boolean
             pass
 
-        elif RE_PROFILE_CONDITIONAL_VARIABLE.search(line):
+        elif line_type == 'conditional_variable':
             # Conditional Variable defines
             pass
 
-        elif RE_PROFILE_CONDITIONAL_BOOLEAN.search(line):
+        elif line_type == 'conditional_boolean':
             # Conditional Boolean defined
             pass
 
-        elif RE_PROFILE_BARE_FILE_ENTRY.search(line):
-            matches = RE_PROFILE_BARE_FILE_ENTRY.search(line)
+        elif line_type == 'bare_file':
 
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected bare file rule found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
 
-            audit, allow, allow_keyword, comment = parse_modifiers(matches)
+            audit, deny, allow_keyword, comment = parse_modifiers(matches)
             # TODO: honor allow_keyword and comment
 
+            allow = 'allow'
+            if deny:
+                allow = 'deny'
+
             mode = apparmor.aamode.AA_BARE_FILE_MODE
             if not matches.group('owner'):
                 mode |= AA_OTHER(apparmor.aamode.AA_BARE_FILE_MODE)
@@ -2743,8 +3290,8 @@ def parse_profile_data(data, file, do_include):
                 path_rule['audit'] = mode
             path_rule['file_prefix'] = True
 
-        elif RE_PROFILE_PATH_ENTRY.search(line):
-            matches = RE_PROFILE_PATH_ENTRY.search(line).groups()
+        elif line_type == 'path':
+            matches = matches.groups()
 
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected path entry found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
@@ -2771,10 +3318,8 @@ def parse_profile_data(data, file, do_include):
             if nt_name:
                 nt_name = nt_name.strip()
 
-            p_re = convert_regexp(path)
-            try:
-                re.compile(p_re)
-            except:
+            # also warms the regexp cache used by matchliteral()
+            if regexp_cache.get(path) is None:
                 raise AppArmorException(_('Syntax Error: Invalid Regex %(path)s in file: %(file)s line: %(line)s') % { 'path': path, 'file': file, 'line': lineno + 1 })
 
             if not validate_profile_mode(mode, allow, nt_name):
@@ -2799,9 +3344,9 @@ def parse_profile_data(data, file, do_include):
             else:
                 profile_data[profile][hat][allow]['path'][path]['audit'] = set()
 
-        elif re_match_include(line):
+        elif line_type == 'include':
             # Include files
-            include_name = re_match_include(line)
+            include_name = matches
             if include_name.startswith('local/'):
                 profile_data[profile][hat]['localinclude'][include_name] = True
 
@@ -2811,16 +3356,10 @@ def parse_profile_data(data, file, do_include):
                 if not filelist.get(file):
                     filelist[file] = hasher()
                 filelist[file]['include'][include_name] = True
-            # If include is a directory
-            if os.path.isdir(profile_dir + '/' + include_name):
-                for file_name in include_dir_filelist(profile_dir, include_name):
-                    if not include.get(file_name, False):
-                        load_include(file_name)
-            else:
-                if not include.get(include_name, False):
-                    load_include(include_name)
+            if load_includes:
+                load_include_or_dir(include_name)
 
-        elif NetworkRule.match(line):
+        elif line_type == 'network':
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected network entry found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
 
@@ -2830,8 +3369,8 @@ def parse_profile_data(data, file, do_include):
 
             profile_data[profile][hat]['network'].add(NetworkRule.parse(line))
 
-        elif RE_PROFILE_DBUS.search(line):
-            matches = RE_PROFILE_DBUS.search(line).groups()
+        elif line_type == 'dbus':
+            matches = matches.groups()
 
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected dbus entry found in file: %(file)s line: %(line)s') % {'file': file, 'line': lineno + 1 })
@@ -2853,8 +3392,8 @@ def parse_profile_data(data, file, do_include):
             dbus_rules.append(dbus_rule)
             profile_data[profile][hat][allow]['dbus'] = dbus_rules
 
-        elif RE_PROFILE_MOUNT.search(line):
-            matches = RE_PROFILE_MOUNT.search(line).groups()
+        elif line_type == 'mount':
+            matches = matches.groups()
 
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected mount entry found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
@@ -2875,8 +3414,8 @@ def parse_profile_data(data, file, do_include):
             mount_rules.append(mount_rule)
             profile_data[profile][hat][allow]['mount'] = mount_rules
 
-        elif RE_PROFILE_SIGNAL.search(line):
-            matches = RE_PROFILE_SIGNAL.search(line).groups()
+        elif line_type == 'signal':
+            matches = matches.groups()
 
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected signal entry found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
@@ -2897,8 +3436,8 @@ def parse_profile_data(data, file, do_include):
             signal_rules.append(signal_rule)
             profile_data[profile][hat][allow]['signal'] = signal_rules
 
-        elif RE_PROFILE_PTRACE.search(line):
-            matches = RE_PROFILE_PTRACE.search(line).groups()
+        elif line_type == 'ptrace':
+            matches = matches.groups()
 
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected ptrace entry found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
@@ -2919,8 +3458,8 @@ def parse_profile_data(data, file, do_include):
             ptrace_rules.append(ptrace_rule)
             profile_data[profile][hat][allow]['ptrace'] = ptrace_rules
 
-        elif RE_PROFILE_PIVOT_ROOT.search(line):
-            matches = RE_PROFILE_PIVOT_ROOT.search(line).groups()
+        elif line_type == 'pivot_root':
+            matches = matches.groups()
 
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected pivot_root entry found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
@@ -2941,8 +3480,8 @@ def parse_profile_data(data, file, do_include):
             pivot_root_rules.append(pivot_root_rule)
             profile_data[profile][hat][allow]['pivot_root'] = pivot_root_rules
 
-        elif RE_PROFILE_UNIX.search(line):
-            matches = RE_PROFILE_UNIX.search(line).groups()
+        elif line_type == 'unix':
+            matches = matches.groups()
 
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected unix entry found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
@@ -2963,8 +3502,8 @@ def parse_profile_data(data, file, do_include):
             unix_rules.append(unix_rule)
             profile_data[profile][hat][allow]['unix'] = unix_rules
 
-        elif RE_PROFILE_CHANGE_HAT.search(line):
-            matches = RE_PROFILE_CHANGE_HAT.search(line).groups()
+        elif line_type == 'change_hat':
+            matches = matches.groups()
 
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected change hat declaration found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
@@ -2972,15 +3511,14 @@ def parse_profile_data(data, file, do_include):
             aaui.UI_Important(_('Ignoring no longer supported change hat declaration "^%(hat)s," found in file: %(file)s line: %(line)s') % {
                     'hat': matches[0], 'file': file, 'line': lineno + 1 })
 
-        elif RE_PROFILE_HAT_DEF.search(line):
+        elif line_type == 'hat_def':
             # An embedded hat syntax definition starts
-            matches = RE_PROFILE_HAT_DEF.search(line)
             if not profile:
                 raise AppArmorException(_('Syntax Error: Unexpected hat definition found in file: %(file)s line: %(line)s') % { 'file': file, 'line': lineno + 1 })
 
             in_contained_hat = True
             hat = matches.group('hat')
-            hat = strip_quotes(hat)
+            hat = intern_name(strip_quotes(hat))
 
             # if hat is already known, the filelist check some lines below will error out.
             # nevertheless, just to be sure, don't overwrite existing profile_data.
@@ -3019,9 +3557,10 @@ def parse_profile_data(data, file, do_include):
 
         elif not RE_RULE_HAS_COMMA.search(line):
             # Bah, line continues on to the next line
-            if RE_HAS_COMMENT_SPLIT.search(line):
+            comment_split = RE_HAS_COMMENT_SPLIT.search(line)
+            if comment_split:
                 # filter trailing comments
-                lastline = RE_HAS_COMMENT_SPLIT.search(line).group('not_comment')
+                lastline = comment_split.group('not_comment')
             else:
                 lastline = line
         else:
@@ -3548,8 +4087,8 @@ def serialize_profile_from_old_profile(profile_data, name, options):
     include_flags = True
     prof_filename = get_profile_filename(name)
 
-    write_filelist = deepcopy(filelist[prof_filename])
-    write_prof_data = deepcopy(profile_data)
+    write_filelist = snapshot_copy(filelist[prof_filename])
+    write_prof_data = snapshot_copy(profile_data)
 
     if options:  # and type(options) == dict:
         if options.get('METADATA', False):
@@ -3648,8 +4187,10 @@ def serialize_profile_from_old_profile(profile_data, name, options):
             #data.append(' ')#data.append('read: '+line)
             if RE_PROFILE_START.search(line):
 
+                # write_prof_data is keyed by hat (see profile_data in save_profiles())
+                prev_hat_data = write_prof_data.get(hat, dict())
                 (profile, hat, attachment, flags, in_contained_hat, correct) = serialize_parse_profile_start(
-                        line, prof_filename, None, profile, hat, write_prof_data[profile][hat]['profile'], write_prof_data[profile][hat]['external'], correct)
+                        line, prof_filename, None, profile, hat, prev_hat_data.get('profile', False), prev_hat_data.get('external', False), correct)
 
                 if not write_prof_data[hat]['name'] == profile:
                     correct = False
@@ -3885,7 +4426,7 @@ def serialize_profile_from_old_profile(profile_data, name, options):
                 if matches[0]:
                     audit = mode
 
-                path_rule = write_prof_data[profile][hat][allow]['path'][ALL]
+                path_rule = write_prof_data[hat][allow]['path'].get(ALL, dict())
                 if path_rule.get('mode', set()) & mode and \
                    (not audit or path_rule.get('audit', set()) & audit) and \
                    path_rule.get('file_prefix', set()):
@@ -4030,18 +4571,16 @@ def write_profile(profile):
     newprof.close()
 
     os.rename(newprof.name, prof_filename)
+    instrument.count('profiles written')
 
     changed.pop(profile)
-    original_aa[profile] = deepcopy(aa[profile])
+    original_aa[profile] = aa[profile]  # stores a snapshot
 
 def matchliteral(aa_regexp, literal):
-    p_regexp = '^' + convert_regexp(aa_regexp) + '$'
-    match = False
-    try:
-        match = re.search(p_regexp, literal)
-    except:
+    p_regexp = regexp_cache.get(aa_regexp)
+    if p_regexp is None:
         return None
-    return match
+    return p_regexp.search(literal)
 
 def profile_known_exec(profile, typ, exec_target):
     if typ == 'exec':
@@ -4073,41 +4612,109 @@ def is_known_rule(profile, rule_type, rule_obj):
         if profile[rule_type].is_covered(rule_obj, False):
             return True
 
-    includelist = list(profile['include'].keys())
-    checked = []
-
-    while includelist:
-        incname = includelist.pop(0)
-        checked.append(incname)
-
-        if os.path.isdir(profile_dir + '/' + incname):
-            includelist += include_dir_filelist(profile_dir, incname)
-        else:
-            if include[incname][incname].get(rule_type, False):
-                if include[incname][incname][rule_type].is_covered(rule_obj, False):
-                    return True
-
-            for childinc in include[incname][incname]['include'].keys():
-                if childinc not in checked:
-                    includelist += [childinc]
+    for incname in profile_include_closure(profile):
+        incdata = include.get(incname, {}).get(incname, {})
+        if incdata.get(rule_type, False):
+            if incdata[rule_type].is_covered(rule_obj, False):
+                return True
 
     return False
 
-def reload_base(bin_path):
+class ReloadQueue(object):
+    '''Collects the profile files to (re)load or unload, and hands them to
+       apparmor_parser in one call per action when flush() is called.
+
+       flush() returns a dict filename -> (success, parser output). If the
+       batched call fails, the files are loaded one by one to find out
+       which of them failed.'''
+
+    def __init__(self, parser_bin=None, include_dirs=None, base=None, cache_dir=None):
+        # the default parser is looked up when it's needed, see command()
+        self.parser = parser_bin
+        self.include_dirs = include_dirs or [profile_dir]
+        self.base = base or profile_dir
+        self.cache_dir = cache_dir
+        self.replace = []
+        self.remove = []
+
+    def __len__(self):
+        return len(self.replace) + len(self.remove)
+
+    def add(self, filename):
+        '''Queue filename to be (re)loaded'''
+        if filename in self.remove:
+            self.remove.remove(filename)
+        if filename not in self.replace:
+            self.replace.append(filename)
+
+    def unload(self, filename):
+        '''Queue the profiles in filename to be unloaded'''
+        if filename in self.replace:
+            self.replace.remove(filename)
+        if filename not in self.remove:
+            self.remove.append(filename)
+
+    def command(self, action, files):
+        command = [self.parser or get_parser()]
+        command += ['-I%s' % include_dir for include_dir in self.include_dirs]
+        command += ['--base', self.base]
+        if self.cache_dir:
+            command += ['--cache-loc', self.cache_dir]
+        return command + [action] + files
+
+    def run(self, action, files):
+        instrument.count('parser calls')
+        ret, output = cmd(self.command(action, files))
+        if ret == 0:
+            return dict((filename, (True, output)) for filename in files)
+        if len(files) == 1:
+            return {files[0]: (False, output)}
+
+        # the parser output doesn't reliably tell which file failed
+        results = dict()
+        for filename in files:
+            instrument.count('parser calls')
+            ret, output = cmd(self.command(action, [filename]))
+            results[filename] = (ret == 0, output)
+        return results
+
+    def flush(self):
+        '''Load and unload the queued files, and empty the queue'''
+        results = dict()
+        with instrument.span('reload', profiles=len(self)):
+            if self.replace:
+                results.update(self.run('-r', self.replace))
+            if self.remove:
+                results.update(self.run('-R', self.remove))
+        self.replace = []
+        self.remove = []
+        return results
+
+def report_reload_failures(results):
+    for filename in sorted(results):
+        success, output = results[filename]
+        if not success:
+            aaui.UI_Important(_('Reloading %(file)s failed:\n%(output)s') % { 'file': filename, 'output': output })
+
+def reload_base(bin_path, queue=None):
+    '''Reload the profile for bin_path, or add it to the given ReloadQueue'''
     if not check_for_apparmor():
         return None
 
     prof_filename = get_profile_filename(bin_path)
 
-    # XXX use reload_profile() from tools.py instead (and don't hide output in /dev/null)
-    subprocess.call("cat '%s' | %s -I%s -r >/dev/null 2>&1" % (prof_filename, parser, profile_dir), shell=True)
+    if queue is not None:
+        queue.add(prof_filename)
+        return
 
-def reload(bin_path):
+    report_reload_failures(ReloadQueue().run('-r', [prof_filename]))
+
+def reload(bin_path, queue=None):
     bin_path = find_executable(bin_path)
     if not bin_path:
         return None
 
-    return reload_base(bin_path)
+    return reload_base(bin_path, queue)
 
 def get_include_data(filename):
     data = []
@@ -4133,6 +4740,17 @@ def include_dir_filelist(profile_dir, include_name):
 
     return files
 
+def load_include_or_dir(include_name):
+    '''load include_name, or all files in it if include_name is a directory'''
+    # If include is a directory
+    if os.path.isdir(profile_dir + '/' + include_name):
+        for file_name in include_dir_filelist(profile_dir, include_name):
+            if not include.get(file_name, False):
+                load_include(file_name)
+    else:
+        if not include.get(include_name, False):
+            load_include(include_name)
+
 def load_include(incname):
     load_includeslist = [incname]
     if include.get(incname, {}).get(incname, False):
@@ -4140,14 +4758,21 @@ def load_include(incname):
     while load_includeslist:
         incfile = load_includeslist.pop(0)
         if os.path.isfile(profile_dir + '/' + incfile):
-            data = get_include_data(incfile)
-            incdata = parse_profile_data(data, incfile, True)
+            instrument.count('includes loaded')
+            incdata = load_cached_profile_data(profile_dir + '/' + incfile, incfile, True)
+            if incdata is None:
+                data = get_include_data(incfile)
+                incdata = parse_profile_data(data, incfile, True)
+                store_cached_profile_data(profile_dir + '/' + incfile, incfile, True, incdata)
             #print(incdata)
             if not incdata:
                 # If include is empty, simply push in a placeholder for it
                 # because other profiles may mention them
                 incdata = hasher()
                 incdata[incname] = hasher()
+            if incfile not in include:
+                include_closures.clear()
+                include_index.clear()
             attach_profile_data(include, incdata)
         #If the include is a directory means include all subfiles
         elif os.path.isdir(profile_dir + '/' + incfile):
@@ -4163,81 +4788,108 @@ def rematchfrag(frag, allow, path):
     matches = []
     if not frag:
         return combinedmode, combinedaudit, matches
-    for entry in frag[allow]['path'].keys():
-        match = matchliteral(entry, path)
-        if match:
-            #print(frag[allow]['path'][entry]['mode'])
-            combinedmode |= frag[allow]['path'][entry].get('mode', set())
-            combinedaudit |= frag[allow]['path'][entry].get('audit', set())
-            matches.append(entry)
+    path_rules = frag[allow]['path']
+    for entry in get_path_matcher(path_rules).match(path):
+        #print(path_rules[entry]['mode'])
+        combinedmode |= path_rules[entry].get('mode', set())
+        combinedaudit |= path_rules[entry].get('audit', set())
+        matches.append(entry)
 
     return combinedmode, combinedaudit, matches
 
-def match_include_to_path(incname, allow, path):
-    combinedmode = set()
-    combinedaudit = set()
-    matches = []
-    includelist = [incname]
+def _include_mtime(incname):
+    try:
+        return os.stat(profile_dir + '/' + incname).st_mtime
+    except OSError:
+        return None
+
+def include_closure(incname):
+    '''Return the include files reachable from incname (including incname itself)
+
+       Included directories are replaced by the files they contain, and each
+       file is listed only once, so include loops are harmless. Includes are
+       loaded if needed.
+
+       The result is cached until profile_dir changes, a new include gets
+       loaded or an included file or directory changes. Changed files are
+       parsed again.'''
+    cached = include_closures.get((profile_dir, incname))
+    if cached is not None:
+        closure, mtimes = cached
+        changed = [incfile for incfile, mtime in mtimes if _include_mtime(incfile) != mtime]
+        if not changed:
+            return closure
+        for incfile in changed:
+            # make load_include() read it again
+            include.pop(incfile, None)
+
+    instrument.count('include closures computed')
+    closure = []
+    mtimes = []
+    checked = set()
+    includelist = collections.deque([incname])
     while includelist:
-        incfile = str(includelist.pop(0))
-        # ret = load_include(incfile)
-        load_include(incfile)
-        if not include.get(incfile, {}):
+        incfile = str(includelist.popleft())
+        if incfile in checked:
             continue
-        cm, am, m = rematchfrag(include[incfile].get(incfile, {}), allow, path)
-        #print(incfile, cm, am, m)
-        if cm:
-            combinedmode |= cm
-            combinedaudit |= am
-            matches += m
-
-        if path in include[incfile][incfile][allow]['path']:
-            combinedmode |= include[incfile][incfile][allow]['path'][path]['mode']
-            combinedaudit |= include[incfile][incfile][allow]['path'][path]['audit']
-
-        if include[incfile][incfile]['include'].keys():
-            includelist += include[incfile][incfile]['include'].keys()
+        checked.add(incfile)
 
-    return combinedmode, combinedaudit, matches
+        mtimes.append((incfile, _include_mtime(incfile)))
+        if os.path.isdir(profile_dir + '/' + incfile):
+            includelist.extend(include_dir_filelist(profile_dir, incfile))
+            continue
 
-def match_prof_incs_to_path(frag, allow, path):
+        load_include(incfile)
+        closure.append(incfile)
+        incdata = include.get(incfile, {}).get(incfile, {})
+        if incdata:
+            includelist.extend(incdata['include'].keys())
+
+    closure = tuple(closure)
+    include_closures[(profile_dir, incname)] = (closure, tuple(mtimes))
+    return closure
+
+def profile_include_closure(frag):
+    '''Return the include files reachable from the includes of the given profile or hat'''
+    closure = []
+    checked = set()
+    for incname in list(frag['include'].keys()):
+        for incfile in include_closure(incname):
+            if incfile not in checked:
+                checked.add(incfile)
+                closure.append(incfile)
+
+    return closure
+
+def match_include_files_to_path(incfiles, allow, path):
     combinedmode = set()
     combinedaudit = set()
     matches = []
-
-    includelist = list(frag['include'].keys())
-    while includelist:
-        incname = includelist.pop(0)
-        cm, am, m = match_include_to_path(incname, allow, path)
+    for incfile in incfiles:
+        incdata = include.get(incfile, {}).get(incfile, {})
+        if not incdata:
+            continue
+        cm, am, m = rematchfrag(incdata, allow, path)
+        #print(incfile, cm, am, m)
         if cm:
             combinedmode |= cm
             combinedaudit |= am
             matches += m
 
-    return combinedmode, combinedaudit, matches
-
-def suggest_incs_for_path(incname, path, allow):
-    combinedmode = set()
-    combinedaudit = set()
-    matches = []
+        if path in incdata[allow]['path']:
+            combinedmode |= incdata[allow]['path'][path]['mode']
+            combinedaudit |= incdata[allow]['path'][path]['audit']
 
-    includelist = [incname]
-    while includelist:
-        inc = includelist.pop(0)
-        cm, am, m = rematchfrag(include[inc][inc], 'allow', path)
-        if cm:
-            combinedmode |= cm
-            combinedaudit |= am
-            matches += m
+    return combinedmode, combinedaudit, matches
 
-        if include[inc][inc]['allow']['path'].get(path, False):
-            combinedmode |= include[inc][inc]['allow']['path'][path]['mode']
-            combinedaudit |= include[inc][inc]['allow']['path'][path]['audit']
+def match_include_to_path(incname, allow, path):
+    return match_include_files_to_path(include_closure(incname), allow, path)
 
-        if include[inc][inc]['include'].keys():
-            includelist += include[inc][inc]['include'].keys()
+def match_prof_incs_to_path(frag, allow, path):
+    return match_include_files_to_path(profile_include_closure(frag), allow, path)
 
-    return combinedmode, combinedaudit, matches
+def suggest_incs_for_path(incname, path, allow):
+    return match_include_files_to_path(include_closure(incname), 'allow', path)
 
 def check_qualifiers(program):
     if cfg['qualifiers'].get(program, False):
@@ -4253,6 +4905,7 @@ def get_subdirectories(current_dir):
         return os.walk(current_dir).__next__()[1]
 
 def loadincludes():
+    incfiles = []
     incdirs = get_subdirectories(profile_dir)
     for idir in incdirs:
         if is_skippable_dir(idir):
@@ -4266,7 +4919,15 @@ def loadincludes():
                 else:
                     fi = dirpath + '/' + fi
                     fi = fi.replace(profile_dir + '/', '', 1)
-                    load_include(fi)
+                    incfiles.append(fi)
+
+    with instrument.span('loadincludes'):
+        prefetch_profile_data([(profile_dir + '/' + fi, fi, True) for fi in incfiles if not include.get(fi, False)])
+        try:
+            for fi in incfiles:
+                load_include(fi)
+        finally:
+            prefetched_records.clear()
 
 def glob_common(path):
     globs = []
@@ -4351,14 +5012,4 @@ if not os.path.isdir(profile_dir):
 
 extra_profile_dir = conf.find_first_dir(cfg['settings']['inactive_profiledir']) or '/etc/apparmor/profiles/extras/'
 
-parser = conf.find_first_file(cfg['settings']['parser']) or '/sbin/apparmor_parser'
-if not os.path.isfile(parser) or not os.access(parser, os.EX_OK):
-    raise AppArmorException('Can\'t find apparmor_parser')
-
-ldd = conf.find_first_file(cfg['settings']['ldd']) or '/usr/bin/ldd'
-if not os.path.isfile(ldd) or not os.access(ldd, os.EX_OK):
-    raise AppArmorException('Can\'t find ldd')
-
-logger = conf.find_first_file(cfg['settings']['logger']) or '/bin/logger'
-if not os.path.isfile(logger) or not os.access(logger, os.EX_OK):
-    raise AppArmorException('Can\'t find logger')
+# parser, ldd and logger are looked up on first use, see get_parser(), get_ldd() and get_logger()
@@ -0,0 +1,187 @@
+# ----------------------------------------------------------------------
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License as published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+# ----------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import stat
+import sys
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from apparmor.common import DebugLogger
+
+debug_logger = DebugLogger('cache')
+
+# bump this if the layout of the cache files changes
+CACHE_FORMAT = 1
+
+def is_trusted(path):
+    '''Check if path is owned by the current user (or root) and not writeable by anybody else'''
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+
+    if st.st_uid not in (0, os.geteuid()):
+        return False
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        return False
+
+    return True
+
+def cache_key(name):
+    '''Return a hash of name that can be used in cache file names'''
+    if sys.version_info[0] >= 3:
+        name = name.encode('utf-8', 'surrogateescape')
+    elif not isinstance(name, bytes):
+        # unicode in python 2
+        name = name.encode('utf-8')
+    return hashlib.sha1(name).hexdigest()
+
+def modules_version(directory):
+    '''Return a hash of the names and mtimes of the python files in
+       directory (including subdirectories), which changes with each update
+       of these modules'''
+    mtimes = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.py'):
+                path = os.path.join(root, name)
+                mtimes.append((os.path.relpath(path, directory), os.path.getmtime(path)))
+    return cache_key(repr(mtimes))
+
+def load_json_cache(path, version):
+    '''Return the data stored in path by save_json_cache(), or None if path
+       doesn't exist, is untrusted, can't be read or has another version'''
+    if not path or not os.path.exists(path):
+        return None
+    if not is_trusted(path):
+        debug_logger.debug('Cache file %s has insecure owner or permissions - ignoring it', path)
+        return None
+    try:
+        with open(path) as f_in:
+            cached = json.load(f_in)
+        if cached.get('format') == version:
+            return cached['data']
+    except (IOError, ValueError, KeyError, AttributeError):
+        debug_logger.debug('Unable to read cache file %s', path)
+    return None
+
+def save_json_cache(path, version, data):
+    '''Atomically write data (and version) to path. Returns False if that
+       failed - errors are ignored otherwise, the data just won't be cached.'''
+    tmp = None
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        fd, tmp = tempfile.mkstemp(prefix='.tmp', dir=directory)
+        with os.fdopen(fd, 'w') as f_out:
+            json.dump({'format': version, 'data': data}, f_out)
+        os.rename(tmp, path)
+        return True
+    except (IOError, OSError) as e:
+        debug_logger.debug('Unable to write cache file %s: %s', path, e)
+        if tmp and os.path.exists(tmp):
+            os.unlink(tmp)
+        return False
+
+class FileCache(object):
+    '''Persistent cache for data derived from files (for example parsed profiles)
+
+       Each entry is stored in its own file below cache_dir/namespace and is
+       only returned if path, mtime and size of the source file, the given
+       version and the optional extra key still match.
+
+       Since the entries are unpickled, the cache directory and the cache
+       files must be owned by the current user (or root) and must not be
+       writeable by anybody else. Otherwise the cache is silently disabled.'''
+
+    def __init__(self, cache_dir, namespace, version=None):
+        self.cache_dir = os.path.join(cache_dir, namespace)
+        self.version = (CACHE_FORMAT, sys.version_info[0], version)
+        self.enabled = self._check_dir()
+
+    def _check_dir(self):
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0o700)
+        except OSError:
+            debug_logger.debug('Unable to create cache directory %s - caching disabled', self.cache_dir)
+            return False
+
+        if not is_trusted(self.cache_dir):
+            debug_logger.debug('Cache directory %s has insecure owner or permissions - caching disabled', self.cache_dir)
+            return False
+
+        return os.access(self.cache_dir, os.W_OK)
+
+    def _entry_path(self, path, extra_key):
+        return os.path.join(self.cache_dir, cache_key('%s\0%s' % (path, repr(extra_key))))
+
+    def _key(self, path, extra_key):
+        st = os.stat(path)
+        return (path, st.st_mtime, st.st_size, self.version, extra_key)
+
+    def load(self, path, extra_key=None):
+        '''Return the cached data for path, or None if there is no valid cache entry'''
+        if not self.enabled:
+            return None
+
+        entry = self._entry_path(path, extra_key)
+        try:
+            key = self._key(path, extra_key)
+            if not is_trusted(entry):
+                return None
+            with open(entry, 'rb') as f_in:
+                cached_key, data = pickle.load(f_in)
+        except Exception:
+            # missing or broken cache file
+            return None
+
+        if cached_key != key:
+            return None
+
+        return data
+
+    def store(self, path, data, extra_key=None):
+        '''Store data for path. Errors are ignored, the data just won't be cached.'''
+        if not self.enabled:
+            return
+
+        tmp = None
+        try:
+            key = self._key(path, extra_key)
+            content = pickle.dumps((key, data), pickle.HIGHEST_PROTOCOL)
+
+            fd, tmp = tempfile.mkstemp(prefix='.tmp', dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f_out:
+                f_out.write(content)
+            os.rename(tmp, self._entry_path(path, extra_key))
+        except Exception as e:
+            debug_logger.debug('Unable to cache %s: %s', path, e)
+            if tmp and os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def clear(self):
+        '''Remove all cache entries'''
+        if not self.enabled:
+            return
+
+        for name in os.listdir(self.cache_dir):
+            os.unlink(os.path.join(self.cache_dir, name))
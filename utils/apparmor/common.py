@@ -13,7 +13,6 @@ from __future__ import print_function
 import codecs
 import collections
 import glob
-import logging
 import os
 import re
 import subprocess
@@ -210,8 +209,9 @@ def hasher():
     #          This might cause strange effects when using .keys()
     return collections.defaultdict(hasher)
 
+regex_paren = re.compile('^(.*){([^}]*)}(.*)$')
+
 def convert_regexp(regexp):
-    regex_paren = re.compile('^(.*){([^}]*)}(.*)$')
     regexp = regexp.strip()
     new_reg = re.sub(r'(?<!\\)(\.|\+|\$)', r'\\\1', regexp)
 
@@ -238,6 +238,48 @@ def convert_regexp(regexp):
         new_reg = new_reg + '$'
     return new_reg
 
+class RegexpCache(object):
+    '''Bounded LRU cache of compiled AppArmor globs
+
+       Maps an AppArmor glob to the compiled result of convert_regexp(), or to
+       None if the glob can't be converted or compiled.
+       hits and misses count the lookups, and can be used for profiling.'''
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def get(self, aa_regexp):
+        '''Return the compiled regex for aa_regexp, or None if it is invalid'''
+        try:
+            compiled = self._cache.pop(aa_regexp)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            try:
+                compiled = re.compile(convert_regexp(aa_regexp))
+            except Exception:
+                compiled = None
+            if len(self._cache) >= self.maxsize:
+                self._cache.popitem(last=False)
+
+        # (re-)insert to mark the entry as most recently used
+        self._cache[aa_regexp] = compiled
+        return compiled
+
+    def clear(self):
+        '''Drop all cached entries and reset the counters'''
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+regexp_cache = RegexpCache()
+
 def user_perm(prof_dir):
     if not os.access(prof_dir, os.W_OK):
         sys.stdout.write("Cannot write to profile directory.\n" +
@@ -258,8 +300,9 @@ class DebugLogger(object):
     def __init__(self, module_name=__name__):
         self.debugging = False
         self.logfile = '/var/log/apparmor/logprof.log'
-        self.debug_level = logging.DEBUG
         if os.getenv('LOGPROF_DEBUG', False):
+            import logging
+            self.debug_level = logging.DEBUG
             self.debugging = os.getenv('LOGPROF_DEBUG')
             try:
                 self.debugging = int(self.debugging)
@@ -291,18 +334,20 @@ class DebugLogger(object):
 
             self.logger = logging.getLogger(module_name)
 
-    def error(self, message):
+    def error(self, message, *args):
         if self.debugging:
-            self.logger.error(message)
+            self.logger.error(message, *args)
 
-    def info(self, message):
+    def info(self, message, *args):
         if self.debugging:
-            self.logger.info(message)
+            self.logger.info(message, *args)
 
-    def debug(self, message):
+    def debug(self, message, *args):
         if self.debugging:
-            self.logger.debug(message)
+            self.logger.debug(message, *args)
 
     def shutdown(self):
-        logging.shutdown()
+        if self.debugging:
+            import logging
+            logging.shutdown()
         #logging.shutdown([self.logger])
@@ -0,0 +1,356 @@
+# ----------------------------------------------------------------------
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License as published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+# ----------------------------------------------------------------------
+'''Find the shared libraries an ELF binary needs, like ldd(1), but without running it
+
+The dynamic section of each ELF file is read directly, and the DT_NEEDED
+entries are searched like the dynamic linker does (DT_RPATH, DT_RUNPATH,
+ld.so.conf and the default directories). Results can be cached in a JSON
+file, keyed by inode, mtime and size of each file.'''
+
+import glob
+import os
+import struct
+import sys
+
+from apparmor.cache import load_json_cache, save_json_cache
+from apparmor.common import DebugLogger
+
+debug_logger = DebugLogger('elf')
+
+# bump this if the content of the cache changes
+CACHE_FORMAT = 2
+
+ELF_MAGIC = b'\x7fELF'
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# (ELF header after e_ident, program header, dynamic entry) per class
+ELF_STRUCTS = {
+    # e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, e_ehsize, e_phentsize, e_phnum, ...
+    ELFCLASS32: ('HHIIIIIHHHHHH', 'IIIIIIII', 'iI'),
+    ELFCLASS64: ('HHIQQQIHHHHHH', 'IIQQQQQQ', 'qQ'),
+}
+
+DEFAULT_LIBRARY_DIRS = ['/lib64', '/usr/lib64', '/lib', '/usr/lib']
+
+class ElfError(Exception):
+    pass
+
+def _decode(name):
+    if sys.version_info[0] >= 3:
+        return name.decode('utf-8', 'surrogateescape')
+    return name
+
+def _read_at(f_in, offset, size):
+    f_in.seek(offset)
+    data = f_in.read(size)
+    if len(data) != size:
+        raise ElfError('truncated file')
+    return data
+
+def read_elf_info(filename):
+    '''Return a dict with class, machine, interpreter, soname, needed, rpath and
+       runpath of the ELF file, or None if filename isn't an ELF file.
+       Raises ElfError if the file is broken or uses an unsupported format.'''
+    with open(filename, 'rb') as f_in:
+        ident = f_in.read(16)
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            return None
+
+        elf_class = bytearray(ident)[4]
+        elf_data = bytearray(ident)[5]
+        if elf_class not in ELF_STRUCTS or elf_data not in (ELFDATA2LSB, ELFDATA2MSB):
+            raise ElfError('unsupported ELF class or data encoding')
+
+        endian = '<' if elf_data == ELFDATA2LSB else '>'
+        header_fmt, phdr_fmt, dyn_fmt = [struct.Struct(endian + fmt) for fmt in ELF_STRUCTS[elf_class]]
+
+        header = header_fmt.unpack(_read_at(f_in, 16, header_fmt.size))
+        machine = header[1]
+        phoff, phentsize, phnum = header[4], header[8], header[9]
+        if phnum and phentsize < phdr_fmt.size:
+            raise ElfError('invalid program header size')
+
+        loads = []
+        dynamic = None
+        interp = None
+        for i in range(phnum):
+            phdr = phdr_fmt.unpack(_read_at(f_in, phoff + i * phentsize, phdr_fmt.size))
+            if elf_class == ELFCLASS32:
+                p_type, p_offset, p_vaddr, p_paddr, p_filesz = phdr[:5]
+            else:
+                p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz = phdr[:6]
+
+            if p_type == PT_LOAD:
+                loads.append((p_vaddr, p_filesz, p_offset))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+            elif p_type == PT_INTERP:
+                interp = _decode(_read_at(f_in, p_offset, p_filesz).rstrip(b'\0'))
+
+        info = {
+            'class':    elf_class,
+            'machine':  machine,
+            'interp':   interp,
+            'soname':   None,
+            'needed':   [],
+            'rpath':    [],
+            'runpath':  [],
+        }
+        if not dynamic:
+            return info  # statically linked
+
+        entries = []
+        strtab = None
+        strsz = None
+        data = _read_at(f_in, dynamic[0], dynamic[1] - dynamic[1] % dyn_fmt.size)
+        for pos in range(0, len(data), dyn_fmt.size):
+            tag, value = dyn_fmt.unpack_from(data, pos)
+            if tag == DT_NULL:
+                break
+            elif tag == DT_STRTAB:
+                strtab = value
+            elif tag == DT_STRSZ:
+                strsz = value
+            elif tag in (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH):
+                entries.append((tag, value))
+
+        if not entries:
+            return info
+        if strtab is None or strsz is None:
+            raise ElfError('dynamic section without string table')
+
+        # DT_STRTAB is a virtual address
+        for vaddr, filesz, offset in loads:
+            if vaddr <= strtab < vaddr + filesz:
+                strings = _read_at(f_in, strtab - vaddr + offset, min(strsz, vaddr + filesz - strtab))
+                break
+        else:
+            raise ElfError('string table outside of the loaded segments')
+
+    for tag, value in entries:
+        end = strings.find(b'\0', value)
+        if end < 0:
+            raise ElfError('invalid string table offset')
+        name = _decode(strings[value:end])
+        if tag == DT_NEEDED:
+            info['needed'].append(name)
+        elif tag == DT_SONAME:
+            info['soname'] = name
+        elif tag == DT_RPATH:
+            info['rpath'] += [path for path in name.split(':') if path]
+        else:
+            info['runpath'] += [path for path in name.split(':') if path]
+
+    return info
+
+def read_ld_so_conf(filename='/etc/ld.so.conf', seen=None):
+    '''Return the library directories listed in filename and the files it includes'''
+    if seen is None:
+        seen = set()
+    if filename in seen:
+        return []
+    seen.add(filename)
+
+    dirs = []
+    try:
+        with open(filename) as f_in:
+            lines = f_in.readlines()
+    except IOError:
+        return dirs
+
+    for line in lines:
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+
+        if line.startswith('include') and line[7:8].isspace():
+            for pattern in line[8:].split():
+                if not pattern.startswith('/'):
+                    pattern = os.path.join(os.path.dirname(filename), pattern)
+                for incfile in sorted(glob.glob(pattern)):
+                    dirs += read_ld_so_conf(incfile, seen)
+        elif line.startswith('hwcap') and line[5:6].isspace():
+            continue
+        else:
+            for directory in line.replace(',', ' ').replace(':', ' ').split():
+                # drop the libc5-era "=TYPE" suffix
+                dirs.append(directory.split('=')[0].rstrip('/') or '/')
+
+    return dirs
+
+class LibraryResolver(object):
+    '''Resolves the libraries needed by ELF files, see get_reqs()
+
+       If cache_file is given, the information read from the ELF files is
+       stored there (with save()) and reused as long as inode, mtime and
+       size of each file don't change.'''
+
+    def __init__(self, cache_file=None, ld_so_conf='/etc/ld.so.conf', default_dirs=None):
+        self.cache_file = cache_file
+        self.ld_so_conf = ld_so_conf
+        self.default_dirs = DEFAULT_LIBRARY_DIRS if default_dirs is None else default_dirs
+        self.conf_dirs = None
+        self.files = dict()  # path -> {'key': [inode, mtime, size], 'info': info}
+        self.dirty = False
+        self.reqs = dict()  # path -> result of get_reqs() during this run
+        self._load_cache()
+
+    def _load_cache(self):
+        self.files = load_json_cache(self.cache_file, CACHE_FORMAT) or dict()
+
+    def save(self):
+        '''Write the cache file (if anything changed). Errors are ignored.'''
+        if not self.cache_file or not self.dirty:
+            return
+        if save_json_cache(self.cache_file, CACHE_FORMAT, self.files):
+            self.dirty = False
+
+    def get_info(self, path):
+        '''Return read_elf_info() for path (from the cache if possible).
+           Raises OSError/IOError if path can't be read.'''
+        st = os.stat(path)
+        key = [st.st_ino, st.st_mtime, st.st_size]
+        cached = self.files.get(path)
+        if cached and cached['key'] == key:
+            return cached['info']
+
+        info = read_elf_info(path)
+        self.files[path] = {'key': key, 'info': info}
+        self.dirty = True
+        return info
+
+    def get_conf_dirs(self):
+        if self.conf_dirs is None:
+            self.conf_dirs = read_ld_so_conf(self.ld_so_conf)
+        return self.conf_dirs
+
+    def _compatible(self, path, info):
+        '''Check if path is an ELF file that can be loaded by an object described by info'''
+        try:
+            candidate = self.get_info(path)
+        except (IOError, OSError, ElfError):
+            return False
+        return candidate is not None and candidate['class'] == info['class'] and candidate['machine'] == info['machine']
+
+    def _expand(self, directory, origin, info):
+        for var in ['${ORIGIN}', '$ORIGIN']:
+            directory = directory.replace(var, origin)
+        for var in ['${LIB}', '$LIB']:
+            directory = directory.replace(var, 'lib64' if info['class'] == ELFCLASS64 else 'lib')
+        for var in ['${PLATFORM}', '$PLATFORM']:
+            directory = directory.replace(var, os.uname()[4])
+        return directory
+
+    def _find(self, name, path, info, main_info, main_path):
+        '''Search the library name needed by path (described by info)'''
+        if '/' in name:
+            name = os.path.normpath(self._expand(name, os.path.dirname(os.path.realpath(path)), info))
+            if os.path.isfile(name):
+                return name
+            return None
+
+        dirs = []
+        # DT_RPATH is ignored if DT_RUNPATH is set
+        if not info['runpath']:
+            dirs += [self._expand(d, os.path.dirname(os.path.realpath(path)), info) for d in info['rpath']]
+            if path != main_path and not main_info['runpath']:
+                dirs += [self._expand(d, os.path.dirname(os.path.realpath(main_path)), main_info) for d in main_info['rpath']]
+        dirs += [self._expand(d, os.path.dirname(os.path.realpath(path)), info) for d in info['runpath']]
+        dirs += self.get_conf_dirs()
+        dirs += self.default_dirs
+
+        for directory in dirs:
+            # $ORIGIN/../lib -> /usr/lib
+            candidate = os.path.normpath(os.path.join(directory, name))
+            if os.path.isfile(candidate) and self._compatible(candidate, info):
+                return candidate
+        return None
+
+    def get_reqs(self, path):
+        '''Return the paths of the libraries path needs (directly and
+           indirectly), including the dynamic linker, like ldd(1).
+           Returns [] for static binaries and non-ELF files, and None if
+           path is an ELF file that can't be handled.'''
+        if path in self.reqs:
+            return list(self.reqs[path])
+
+        try:
+            main_info = self.get_info(path)
+        except (IOError, OSError):
+            return []
+        except ElfError as e:
+            debug_logger.debug('Unable to read ELF file %s: %s', path, e)
+            return None
+        if main_info is None:
+            return []
+
+        reqs = []
+        loaded = set()
+        interp = main_info['interp']
+        if interp:
+            loaded.add(os.path.basename(interp))
+            try:
+                interp_info = self.get_info(interp)
+                if interp_info and interp_info['soname']:
+                    loaded.add(interp_info['soname'])
+            except (IOError, OSError, ElfError):
+                pass
+
+        queue = [(path, main_info)]
+        while queue:
+            obj_path, obj_info = queue.pop(0)
+            for name in obj_info['needed']:
+                if name in loaded:
+                    continue
+                loaded.add(name)
+
+                library = self._find(name, obj_path, obj_info, main_info, path)
+                if not library:
+                    debug_logger.debug('%s: library %s not found', path, name)
+                    continue
+
+                try:
+                    lib_info = self.get_info(library)
+                except (IOError, OSError):
+                    continue
+                except ElfError as e:
+                    debug_logger.debug('Unable to read ELF file %s: %s', library, e)
+                    return None
+
+                if lib_info is None or library in reqs:
+                    continue
+                if lib_info['soname']:
+                    loaded.add(lib_info['soname'])
+                reqs.append(library)
+                queue.append((library, lib_info))
+
+        if interp and interp not in reqs:
+            reqs.append(interp)
+
+        self.reqs[path] = reqs
+        return list(reqs)
@@ -0,0 +1,165 @@
+# ----------------------------------------------------------------------
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License as published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+# ----------------------------------------------------------------------
+'''Named timing spans and counters
+
+Instrumentation is disabled by default. Then span() returns a shared
+do-nothing context manager and count() returns immediately, so the calls
+can stay in the code. After enable(), the spans and counters are recorded
+and can be printed with summary() or written as Chrome trace (readable by
+chrome://tracing and Perfetto) with write_chrome_trace().'''
+
+import atexit
+import json
+import os
+import sys
+import time
+
+# perf_counter is more exact, but not available in python 2
+_clock = getattr(time, 'perf_counter', time.time)
+
+enabled = False
+
+_spans = []  # (name, start, duration, depth, args) of the finished spans
+_counters = dict()
+_depth = 0
+_start = 0
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span(object):
+    __slots__ = ['name', 'args', 'start', 'depth']
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        global _depth
+        self.depth = _depth
+        _depth += 1
+        self.start = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _depth
+        duration = _clock() - self.start
+        _depth -= 1
+        _spans.append((self.name, self.start, duration, self.depth, self.args))
+        return False
+
+def enable():
+    '''Start recording (and forget everything recorded before)'''
+    global enabled
+    reset()
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    global _depth, _start
+    del _spans[:]
+    _counters.clear()
+    _depth = 0
+    _start = _clock()
+
+def span(name, **args):
+    '''Context manager that records how long its block took
+
+       args are stored with the span and show up in the Chrome trace.'''
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+def count(name, value=1):
+    '''Add value to the counter name'''
+    if not enabled:
+        return
+    _counters[name] = _counters.get(name, 0) + value
+
+def get_counters():
+    return dict(_counters)
+
+def get_span_totals():
+    '''Returns a dict name -> (calls, total seconds, max seconds) of the recorded spans'''
+    totals = dict()
+    for name, start, duration, depth, args in _spans:
+        calls, total, longest = totals.get(name, (0, 0.0, 0.0))
+        totals[name] = (calls + 1, total + duration, max(longest, duration))
+    return totals
+
+def summary():
+    '''Returns a human-readable table of the spans (slowest first) and counters'''
+    lines = []
+    totals = get_span_totals()
+    if totals:
+        lines.append('%-32s %8s %12s %12s' % ('span', 'calls', 'total [s]', 'max [s]'))
+        for name in sorted(totals, key=lambda name: totals[name][1], reverse=True):
+            calls, total, longest = totals[name]
+            lines.append('%-32s %8d %12.4f %12.4f' % (name, calls, total, longest))
+    if _counters:
+        if lines:
+            lines.append('')
+        lines.append('%-32s %8s' % ('counter', 'value'))
+        for name in sorted(_counters):
+            lines.append('%-32s %8s' % (name, _counters[name]))
+    return '\n'.join(lines) + '\n'
+
+def chrome_trace():
+    '''Returns the recorded spans and counters in Chrome's trace event format'''
+    pid = os.getpid()
+    events = []
+    end = 0
+    for name, start, duration, depth, args in _spans:
+        event = {
+            'name': name,
+            'ph':   'X',
+            'ts':   (start - _start) * 1000000,
+            'dur':  duration * 1000000,
+            'pid':  pid,
+            'tid':  pid,
+        }
+        if args:
+            event['args'] = dict((key, str(value)) for key, value in args.items())
+        events.append(event)
+        end = max(end, event['ts'] + event['dur'])
+
+    for name in sorted(_counters):
+        events.append({'name': name, 'ph': 'C', 'ts': end, 'pid': pid, 'args': {'value': _counters[name]}})
+
+    # sorted by start time, outer spans first
+    events.sort(key=lambda event: (event['ts'], -event.get('dur', 0)))
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def write_chrome_trace(filename):
+    with open(filename, 'w') as f_out:
+        json.dump(chrome_trace(), f_out)
+
+def report_at_exit(stats=False, trace_file=None):
+    '''Enable recording, and when the program exits, print the summary()
+       to stderr (if stats is True) and/or write the Chrome trace to trace_file'''
+    def report():
+        if stats:
+            sys.stderr.write('\n' + summary())
+        if trace_file:
+            write_chrome_trace(trace_file)
+
+    enable()
+    atexit.register(report)
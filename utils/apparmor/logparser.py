@@ -12,12 +12,18 @@
 #    GNU General Public License for more details.
 #
 # ----------------------------------------------------------------------
+import collections
+import json
+import multiprocessing
 import os
 import re
+import select
+import struct
 import sys
 import time
 import LibAppArmor
-from apparmor.common import AppArmorException, open_file_read, DebugLogger
+from apparmor.common import AppArmorBug, AppArmorException, DebugLogger
+import apparmor.instrument as instrument
 
 from apparmor.aamode import validate_log_mode, log_str_to_mode, hide_log_mode, AA_MAY_EXEC
 
@@ -25,6 +31,34 @@ from apparmor.aamode import validate_log_mode, log_str_to_mode, hide_log_mode, A
 from apparmor.translations import init_translation
 _ = init_translation()
 
+# number of bytes to read from the logfile at once
+LOG_CHUNK_SIZE = 1024 * 1024
+
+# all lines matched by RE_LOG_v2_6_syslog and RE_LOG_v2_6_audit contain this
+LOG_PREFILTER = b'apparmor='
+
+# size of the byte ranges handed to the worker processes when parsing in parallel
+LOG_RANGE_SIZE = 16 * LOG_CHUNK_SIZE
+
+# inotify flags used by LogWatcher, see inotify(7)
+IN_MODIFY       = 0x00000002
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_NONBLOCK     = os.O_NONBLOCK
+IN_CLOEXEC      = 0o2000000
+# struct inotify_event without the name
+INOTIFY_EVENT = struct.Struct('iIII')
+
+if sys.version_info[0] >= 3:
+    LOG_DECODE_ERRORS = 'surrogateescape'
+else:
+    LOG_DECODE_ERRORS = 'replace'
+
 class ReadLog:
     RE_LOG_v2_6_syslog = re.compile('kernel:\s+(\[[\d\.\s]+\]\s+)?(audit:\s+)?type=\d+\s+audit\([\d\.\:]+\):\s+apparmor=')
     RE_LOG_v2_6_audit = re.compile('type=AVC\s+(msg=)?audit\([\d\.\:]+\):\s+apparmor=')
@@ -45,8 +79,19 @@ class ReadLog:
                        'sock_shutdown': 'net'
                        }
 
-    def __init__(self, pid, filename, existing_profiles, profile_dir, log):
+    MODE_CONVERTOR = {0: 'UNKNOWN',
+                      1: 'ERROR',
+                      2: 'AUDIT',
+                      3: 'PERMITTING',
+                      4: 'REJECTING',
+                      5: 'HINT',
+                      6: 'STATUS'
+                      }
+
+    def __init__(self, pid, filename, existing_profiles, profile_dir, log, cursor=None):
         self.filename = filename
+        # if given, start reading at the LogCursor and update it after reading
+        self.cursor = cursor
         self.profile_dir = profile_dir
         self.pid = pid
         self.existing_profiles = existing_profiles
@@ -56,13 +101,120 @@ class ReadLog:
         self.logmark = ''
         self.seenmark = None
         self.next_log_entry = None
+        self.candidate_lines = collections.deque()
+        # only used when parsing in parallel, see get_parsed_entries()
+        self.parsed_entries = None
+        self.next_parsed_entry = None
+        # logfiles still to be read, and position in the current logfile
+        self.log_files = []
+        self.log_inode = None
+        self.log_offset = 0
+        # when the cursor position couldn't be found, skip events older than this
+        self.min_time = None
+        self.last_time = None
+        # incomplete last line of the logfile, only used by follow()
+        self.follow_partial = b''
+
+    def get_log_files(self):
+        '''Return a list of (filename, offset) to read, starting at the cursor (if any)
+
+           If the logfile was rotated since the cursor was saved, the rest of
+           the rotated logfile (if it can be found) gets read first.'''
+        self.min_time = None
+        if not self.cursor or not self.cursor.is_valid_for(self.filename):
+            return [(self.filename, 0)]
+
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            raise AppArmorException('Can not read AppArmor logfile: ' + self.filename)
+
+        if st.st_ino == self.cursor.inode and st.st_size >= self.cursor.offset:
+            return [(self.filename, self.cursor.offset)]
+
+        if st.st_ino != self.cursor.inode:
+            for rotated in [self.filename + '.1', self.filename + '.0']:
+                try:
+                    rotated_st = os.stat(rotated)
+                except OSError:
+                    continue
+                if rotated_st.st_ino == self.cursor.inode and rotated_st.st_size >= self.cursor.offset:
+                    return [(rotated, self.cursor.offset), (self.filename, 0)]
+
+        # the logfile was truncated, or rotated and the old logfile is gone.
+        # All remaining entries should be new, but to be sure skip everything
+        # older than the last event seen.
+        self.min_time = self.cursor.timestamp
+        return [(self.filename, 0)]
+
+    def open_next_log_file(self):
+        '''Open the next file from self.log_files, return False if there is none'''
+        if not self.log_files:
+            return False
+        if self.LOG:
+            self.LOG.close()
+            self.LOG = None
+
+        filename, offset = self.log_files.pop(0)
+        try:
+            #print(filename)
+            self.LOG = open(filename, 'rb', LOG_CHUNK_SIZE)
+        except IOError:
+            raise AppArmorException('Can not read AppArmor logfile: ' + filename)
+        self.LOG.seek(offset)
+        self.log_inode = os.fstat(self.LOG.fileno()).st_ino
+        self.log_offset = offset
+        return True
+
+    def update_cursor(self):
+        '''Move the cursor to the position up to which the logfile was read'''
+        if self.cursor:
+            self.cursor.update(self.filename, self.log_inode, self.log_offset, self.last_time)
+
+    def is_new_event(self, event):
+        '''Check if the event is newer than the events already seen'''
+        if self.min_time and event['time'] and event['time'] < self.min_time:
+            return False
+        if event['time'] and (not self.last_time or event['time'] > self.last_time):
+            self.last_time = event['time']
+        return True
+
+    def read_candidate_line(self):
+        '''Return the next (undecoded) line of the logfile that contains
+           LOG_PREFILTER or the logmark, or '' at the end of the file'''
+        while not self.candidate_lines:
+            # reading and filtering big chunks of lines is much faster than
+            # looking at each line
+            chunk = self.LOG.readlines(LOG_CHUNK_SIZE)
+            if self.cursor and chunk and not chunk[-1].endswith(b'\n'):
+                # incomplete line at the end of the logfile, leave it for the next
+                # read (or run) - log_offset must not point into the middle of it
+                partial = chunk.pop()
+                self.LOG.seek(-len(partial), os.SEEK_CUR)
+            if not chunk:
+                if self.open_next_log_file():
+                    continue
+                return ''
+
+            self.log_offset += sum(len(line) for line in chunk)
+            self.add_candidate_lines(chunk)
+
+        return self.candidate_lines.popleft().decode('utf-8', LOG_DECODE_ERRORS)
+
+    def add_candidate_lines(self, chunk):
+        '''Add the lines in chunk that contain LOG_PREFILTER or the logmark to self.candidate_lines'''
+        if self.logmark:
+            logmark = self.logmark.encode('utf-8')
+            self.candidate_lines.extend(line for line in chunk if LOG_PREFILTER in line or logmark in line)
+        else:
+            self.candidate_lines.extend(line for line in chunk if LOG_PREFILTER in line)
 
     def prefetch_next_log_entry(self):
         if self.next_log_entry:
             sys.stderr.out('A log entry already present: %s' % self.next_log_entry)
-        self.next_log_entry = self.LOG.readline()
-        while not self.RE_LOG_v2_6_syslog.search(self.next_log_entry) and not self.RE_LOG_v2_6_audit.search(self.next_log_entry) and not (self.logmark and self.logmark in self.next_log_entry):
-            self.next_log_entry = self.LOG.readline()
+        self.next_log_entry = self.read_candidate_line()
+        while not self.is_log_entry(self.next_log_entry):
+            self.next_log_entry = self.read_candidate_line()
             if not self.next_log_entry:
                 break
 
@@ -82,9 +234,29 @@ class ReadLog:
 
     def throw_away_next_log_entry(self):
         self.next_log_entry = None
+        self.next_parsed_entry = None
+
+    def peek_at_next_event(self):
+        '''Return the parsed event of the next log entry (or None)'''
+        if self.parsed_entries is not None:
+            if self.next_parsed_entry is None:
+                self.next_parsed_entry = next(self.parsed_entries, False)
+            if not self.next_parsed_entry:
+                return None
+            return self.next_parsed_entry[1]
+
+        following = self.peek_at_next_log_entry()
+        if following:
+            return self.parse_log_record(following)
+        return None
+
+    def is_log_entry(self, line):
+        '''Check if line is a log entry (or contains the logmark)'''
+        return (self.RE_LOG_v2_6_syslog.search(line) or self.RE_LOG_v2_6_audit.search(line) or
+                (self.logmark and self.logmark in line))
 
     def parse_log_record(self, record):
-        self.debug_logger.debug('parse_log_record: %s' % record)
+        self.debug_logger.debug('parse_log_record: %s', record)
 
         record_event = self.parse_event(record)
         return record_event
@@ -92,7 +264,7 @@ class ReadLog:
     def parse_event(self, msg):
         """Parse the event from log into key value pairs"""
         msg = msg.strip()
-        self.debug_logger.info('parse_event: %s' % msg)
+        self.debug_logger.info('parse_event: %s', msg)
         #print(repr(msg))
         if sys.version_info < (3, 0):
             # parse_record fails with u'foo' style strings hence typecasting to string
@@ -131,16 +303,8 @@ class ReadLog:
 
         if ev['aamode']:
             # Convert aamode values to their counter-parts
-            mode_convertor = {0: 'UNKNOWN',
-                              1: 'ERROR',
-                              2: 'AUDIT',
-                              3: 'PERMITTING',
-                              4: 'REJECTING',
-                              5: 'HINT',
-                              6: 'STATUS'
-                              }
             try:
-                ev['aamode'] = mode_convertor[ev['aamode']]
+                ev['aamode'] = self.MODE_CONVERTOR[ev['aamode']]
             except KeyError:
                 ev['aamode'] = None
 
@@ -156,7 +320,7 @@ class ReadLog:
             return None
 
     def add_to_tree(self, loc_pid, parent, type, event):
-        self.debug_logger.info('add_to_tree: pid [%s] type [%s] event [%s]' % (loc_pid, type, event))
+        self.debug_logger.info('add_to_tree: pid [%s] type [%s] event [%s]', loc_pid, type, event)
         if not self.pid.get(loc_pid, False):
             profile, hat = event[:2]
             if parent and self.pid.get(parent, False):
@@ -246,7 +410,7 @@ class ReadLog:
                 self.add_to_tree(e['pid'], e['parent'], 'exec',
                                  [profile, hat, prog, aamode, e['denied_mask'], e['name'], ''])
             else:
-                self.debug_logger.debug('add_event_to_tree: dropped exec event in %s' % e['profile'])
+                self.debug_logger.debug('add_event_to_tree: dropped exec event in %s', e['profile'])
 
         elif ( e['operation'].startswith('file_') or e['operation'].startswith('inode_') or
             e['operation'] in ['open', 'truncate', 'mkdir', 'mknod', 'chmod', 'rename_src',
@@ -255,7 +419,7 @@ class ReadLog:
 
             # for some reason, we get file_perm log events without request_mask, see https://bugs.launchpad.net/apparmor/+bug/1466812/
             if e['operation'] == 'file_perm' and e['request_mask'] is None:
-                self.debug_logger.debug('UNHANDLED (missing request_mask): %s' % e)
+                self.debug_logger.debug('UNHANDLED (missing request_mask): %s', e)
                 return None
 
             # Map c (create) to a and d (delete) to w (logging is more detailed than the profile language)
@@ -278,12 +442,10 @@ class ReadLog:
             # check if this is an exec event
             is_domain_change = False
             if e['operation'] == 'inode_permission' and (e['denied_mask'] & AA_MAY_EXEC) and aamode == 'PERMITTING':
-                following = self.peek_at_next_log_entry()
-                if following:
-                    entry = self.parse_log_record(following)
-                    if entry and entry.get('info', False) == 'set profile':
-                        is_domain_change = True
-                        self.throw_away_next_log_entry()
+                entry = self.peek_at_next_event()
+                if entry and entry.get('info', False) == 'set profile':
+                    is_domain_change = True
+                    self.throw_away_next_log_entry()
 
             if is_domain_change:
                 self.add_to_tree(e['pid'], e['parent'], 'exec',
@@ -323,42 +485,312 @@ class ReadLog:
             self.add_to_tree(e['pid'], e['parent'], 'unknown_hat',
                              [profile, hat, aamode, hat])
         else:
-            self.debug_logger.debug('UNHANDLED: %s' % e)
+            self.debug_logger.debug('UNHANDLED: %s', e)
+
+    def get_events(self, logmark='', jobs=1):
+        '''Generator that yields the parsed events of the logfile
+
+           If logmark is given, events before the line containing logmark are skipped.
+           Consumers may call peek_at_next_event() and throw_away_next_log_entry()
+           between two events (add_event_to_tree() does this for inode_permission
+           events followed by "set profile").
+
+           With jobs > 1, the log entries are parsed by that many worker processes.
+           The events are still returned in the order of the logfile.
+
+           If self.cursor is set, reading starts at the cursor (and logmark
+           is ignored), and the cursor gets updated after reading the whole log.'''
+        if self.cursor and self.cursor.is_valid_for(self.filename):
+            # the cursor is more exact than the logmark
+            logmark = ''
+
+        if jobs > 1:
+            for event in self.get_events_parallel(logmark, jobs):
+                yield event
+            return
 
-    def read_log(self, logmark):
         self.logmark = logmark
         seenmark = True
         if self.logmark:
             seenmark = False
         #last = None
         #event_type = None
-        try:
-            #print(self.filename)
-            self.LOG = open_file_read(self.filename)
-        except IOError:
-            raise AppArmorException('Can not read AppArmor logfile: ' + self.filename)
+        self.log_files = self.get_log_files()
+        self.open_next_log_file()
         #LOG = open_file_read(log_open)
-        line = True
-        while line:
-            line = self.get_next_log_entry()
-            if not line:
-                break
-            line = line.strip()
-            self.debug_logger.debug('read_log: %s' % line)
-            if self.logmark in line:
-                seenmark = True
-
-            self.debug_logger.debug('read_log: seenmark = %s' % seenmark)
-            if not seenmark:
-                continue
-
-            event = self.parse_log_record(line)
-            #print(event)
-            if event:
-                self.add_event_to_tree(event)
-        self.LOG.close()
-        self.logmark = ''
-        return self.log
+        try:
+            line = True
+            while line:
+                line = self.get_next_log_entry()
+                if not line:
+                    break
+                line = line.strip()
+                self.debug_logger.debug('read_log: %s', line)
+                if self.logmark in line:
+                    seenmark = True
+
+                self.debug_logger.debug('read_log: seenmark = %s', seenmark)
+                if not seenmark:
+                    continue
+
+                event = self.parse_log_record(line)
+                #print(event)
+                if event and self.is_new_event(event):
+                    yield event
+
+            self.update_cursor()
+        finally:
+            if self.LOG:
+                self.LOG.close()
+                self.LOG = None
+            self.log_files = []
+            self.next_log_entry = None
+            self.candidate_lines.clear()
+            self.logmark = ''
+
+    def get_log_ranges(self, size):
+        '''Split the logfiles to read into byte ranges (filename, start, end) of
+           about size bytes, each starting at a line boundary'''
+        ranges = []
+        for filename, start in self.log_files:
+            try:
+                LOG = open(filename, 'rb')
+            except IOError:
+                raise AppArmorException('Can not read AppArmor logfile: ' + filename)
+
+            with LOG:
+                self.log_inode = os.fstat(LOG.fileno()).st_ino
+                filesize = os.fstat(LOG.fileno()).st_size
+                if self.cursor:
+                    filesize = _complete_lines_end(LOG, start, filesize)
+
+                while start < filesize:
+                    LOG.seek(start + size)
+                    LOG.readline()  # move to the start of the next line
+                    end = min(max(LOG.tell(), start + size), filesize)
+                    ranges.append((filename, start, end))
+                    start = end
+
+            self.log_offset = max(start, filesize)
+
+        return ranges
+
+    def get_parsed_entries(self, jobs):
+        '''Generator that yields (contains_logmark, event) for each log entry, parsed by jobs worker processes'''
+        total_size = 0
+        for filename, start in self.log_files:
+            try:
+                total_size += os.path.getsize(filename) - start
+            except OSError:
+                raise AppArmorException('Can not read AppArmor logfile: ' + filename)
+
+        ranges = self.get_log_ranges(max(1, min(LOG_RANGE_SIZE, total_size // jobs + 1)))
+        pool = multiprocessing.Pool(jobs)
+        try:
+            # imap() returns the results in the order of the ranges
+            for entries in pool.imap(_parse_log_range, [(filename, start, end, self.logmark) for (filename, start, end) in ranges]):
+                for entry in entries:
+                    yield entry
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def get_events_parallel(self, logmark, jobs):
+        '''Parallel version of get_events()'''
+        self.logmark = logmark
+        seenmark = True
+        if self.logmark:
+            seenmark = False
+
+        self.log_files = self.get_log_files()
+        self.parsed_entries = self.get_parsed_entries(jobs)
+        self.next_parsed_entry = None
+        try:
+            while True:
+                if self.next_parsed_entry is None:
+                    entry = next(self.parsed_entries, False)
+                else:
+                    entry = self.next_parsed_entry
+                    self.next_parsed_entry = None
+                if not entry:
+                    break
+
+                contains_logmark, event = entry
+                if contains_logmark:
+                    seenmark = True
+                if not seenmark:
+                    continue
+
+                if event and self.is_new_event(event):
+                    yield event
+
+            self.update_cursor()
+        finally:
+            self.parsed_entries.close()
+            self.parsed_entries = None
+            self.next_parsed_entry = None
+            self.log_files = []
+            self.logmark = ''
+
+    def process_log(self, sinks, logmark='', jobs=1):
+        '''Feed each event of the logfile to all sinks (in the given order), and
+           return the result of the sinks' finish()'''
+        events = 0
+        for event in self.get_events(logmark, jobs):
+            events += 1
+            for sink in sinks:
+                sink.handle(event)
+        instrument.count('log events', events)
+
+        return [sink.finish() for sink in sinks]
+
+    def read_log(self, logmark, jobs=1):
+        '''Return the complete per-pid event tree (used by aa-logprof and aa-genprof)'''
+        return self.process_log([LogTreeSink(self)], logmark, jobs)[0]
+
+    def follow(self, logmark='', batch_size=100, poll_interval=1.0, batch_delay=0.05,
+               idle_timeout=None, from_start=False, watcher=None):
+        '''Generator that yields lists of the events appended to the logfile (like tail -f)
+
+           Reading starts at the cursor if self.cursor is set (see get_events()),
+           otherwise at the end of the logfile, or at its start if from_start is True.
+           Events before the line containing logmark are skipped.
+
+           Each list contains up to batch_size events. The logfile is only
+           read when the next list is requested, so a slow consumer doesn't
+           cause unlimited buffering.
+           When there are no new events, the generator waits for a change of
+           the logfile (see LogWatcher, pass watcher to use a different one),
+           but checks at least every poll_interval seconds. After a wakeup,
+           it waits another batch_delay seconds so that a burst of log lines
+           ends up in one list.
+           If the logfile gets rotated (replaced by a file with another
+           inode), the rest of the old logfile is read before switching to
+           the new one. If it gets truncated, reading restarts at its start.
+           Incomplete lines are only read once they are complete.
+
+           The generator ends after idle_timeout seconds without new events
+           (if given). If self.cursor is set, it is updated after each list.'''
+        self.logmark = logmark
+        seenmark = True
+        if self.logmark:
+            seenmark = False
+
+        if self.cursor and self.cursor.is_valid_for(self.filename):
+            self.log_files = self.get_log_files()
+        elif from_start:
+            self.log_files = [(self.filename, 0)]
+        else:
+            self.log_files = [(self.filename, LogCursor.at_end(self.filename).offset)]
+        self.open_next_log_file()
+
+        own_watcher = watcher is None
+        if own_watcher:
+            watcher = LogWatcher(self.filename)
+
+        idle_since = time.time()
+        try:
+            while True:
+                events = []
+                while len(events) < batch_size:
+                    line = self.read_followed_line()
+                    if line is None:
+                        break
+                    line = line.strip()
+                    if self.logmark and self.logmark in line:
+                        seenmark = True
+                    if not seenmark or not self.is_log_entry(line):
+                        continue
+
+                    event = self.parse_log_record(line)
+                    if event and self.is_new_event(event):
+                        events.append(event)
+
+                if events:
+                    self.update_cursor()
+                    yield events
+                    idle_since = time.time()
+                    continue
+
+                if len(self.candidate_lines) or self.switch_followed_file():
+                    continue
+
+                timeout = poll_interval
+                if idle_timeout is not None:
+                    remaining = idle_since + idle_timeout - time.time()
+                    if remaining <= 0:
+                        break
+                    timeout = min(timeout, remaining)
+
+                if watcher.wait(timeout) and batch_delay:
+                    time.sleep(batch_delay)
+
+            self.update_cursor()
+        finally:
+            if own_watcher:
+                watcher.close()
+            if self.LOG:
+                self.LOG.close()
+                self.LOG = None
+            self.log_files = []
+            self.candidate_lines.clear()
+            self.follow_partial = b''
+            self.logmark = ''
+
+    def read_followed_line(self):
+        '''Return the next complete candidate line (see read_candidate_line())
+           of the followed logfile, or None if there is none (yet)'''
+        while not self.candidate_lines:
+            chunk = self.LOG.readlines(LOG_CHUNK_SIZE)
+            if not chunk:
+                return None
+
+            if self.follow_partial:
+                chunk[0] = self.follow_partial + chunk[0]
+                self.follow_partial = b''
+            if not chunk[-1].endswith(b'\n'):
+                # the rest of the line isn't written yet
+                self.follow_partial = chunk.pop()
+
+            self.log_offset += sum(len(line) for line in chunk)
+            self.add_candidate_lines(chunk)
+
+        return self.candidate_lines.popleft().decode('utf-8', LOG_DECODE_ERRORS)
+
+    def switch_followed_file(self):
+        '''Continue with the next logfile if the current one was rotated, or
+           at the start of the logfile if it was truncated.
+           Returns True if the read position changed.'''
+        if self.log_files:
+            # rest of a rotated logfile (from the cursor) is done
+            self.follow_partial = b''
+            return self.open_next_log_file()
+
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False  # rotated, but the new logfile doesn't exist yet
+
+        if st.st_ino != self.log_inode:
+            try:
+                LOG = open(self.filename, 'rb', LOG_CHUNK_SIZE)
+            except IOError:
+                return False
+            self.LOG.close()
+            self.LOG = LOG
+            self.log_inode = os.fstat(LOG.fileno()).st_ino
+            self.log_offset = 0
+            self.follow_partial = b''
+            return True
+
+        if st.st_size < self.log_offset + len(self.follow_partial):
+            self.LOG.seek(0)
+            self.log_offset = 0
+            self.follow_partial = b''
+            return True
+
+        return False
 
     def op_type(self, operation):
         """Returns the operation type if known, unkown otherwise"""
@@ -389,3 +821,262 @@ class ReadLog:
         profile = profile.replace('/', '.')
         full_profilename = self.profile_dir + '/' + profile
         return full_profilename
+
+
+def _complete_lines_end(LOG, start, filesize):
+    '''Return the offset after the last complete (newline-terminated) line in LOG'''
+    end = filesize
+    while end > start:
+        pos = max(start, end - LOG_CHUNK_SIZE)
+        LOG.seek(pos)
+        newline = LOG.read(end - pos).rfind(b'\n')
+        if newline >= 0:
+            return pos + newline + 1
+        end = pos
+
+    return start
+
+def _parse_log_range(args):
+    '''Worker function for ReadLog.get_parsed_entries()
+
+       Parse the log entries in the given byte range of a logfile, and return
+       a list of (contains_logmark, event) for each of them'''
+    filename, start, end, logmark = args
+    reader = ReadLog(None, filename, None, None, None)
+    reader.logmark = logmark
+
+    entries = []
+    with open(filename, 'rb', LOG_CHUNK_SIZE) as LOG:
+        LOG.seek(start)
+        reader.LOG = LOG
+        remaining = end - start
+        while remaining > 0:
+            chunk = LOG.readlines(min(LOG_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+
+            # readlines() might return lines beyond the end of the range
+            size = sum(len(line) for line in chunk)
+            while size > remaining:
+                size -= len(chunk.pop())
+            remaining -= size
+
+            if logmark:
+                encoded_logmark = logmark.encode('utf-8')
+                chunk = [line for line in chunk if LOG_PREFILTER in line or encoded_logmark in line]
+            else:
+                chunk = [line for line in chunk if LOG_PREFILTER in line]
+
+            for line in chunk:
+                line = line.decode('utf-8', LOG_DECODE_ERRORS)
+                if not reader.is_log_entry(line):
+                    continue
+                line = line.strip()
+                entries.append((logmark in line, reader.parse_log_record(line)))
+
+    return entries
+
+class LogCursor(object):
+    '''Position up to which a logfile was read
+
+       Stores the inode of the logfile, the byte offset after the last
+       complete line and the time of the newest event, so that the next
+       ReadLog can continue there - even if the logfile was rotated or
+       truncated in the meantime.'''
+
+    def __init__(self, filename=None, inode=None, offset=0, timestamp=None):
+        self.filename = filename
+        self.inode = inode
+        self.offset = offset
+        self.timestamp = timestamp
+
+    @classmethod
+    def load(cls, path):
+        '''Load a cursor saved with save(). Returns an empty cursor if path doesn't exist or is invalid.'''
+        try:
+            with open(path) as f_in:
+                data = json.load(f_in)
+            return cls(data['filename'], int(data['inode']), int(data['offset']), data.get('timestamp'))
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return cls()
+
+    @classmethod
+    def at_end(cls, filename):
+        '''Return a cursor pointing to the end of the last complete line in filename'''
+        try:
+            with open(filename, 'rb') as LOG:
+                st = os.fstat(LOG.fileno())
+                return cls(filename, st.st_ino, _complete_lines_end(LOG, 0, st.st_size), int(time.time()))
+        except (IOError, OSError):
+            return cls()
+
+    def is_valid_for(self, filename):
+        '''Check if the cursor can be used for filename'''
+        return self.inode is not None and self.filename == filename
+
+    def update(self, filename, inode, offset, timestamp):
+        self.filename = filename
+        self.inode = inode
+        self.offset = offset
+        if timestamp and (not self.timestamp or timestamp > self.timestamp):
+            self.timestamp = timestamp
+
+    def save(self, path):
+        '''Atomically write the cursor to path'''
+        data = {'filename': self.filename, 'inode': self.inode, 'offset': self.offset, 'timestamp': self.timestamp}
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            with open(tmp, 'w') as f_out:
+                json.dump(data, f_out)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise AppArmorException(_('Unable to save the log cursor to %(path)s: %(error)s') % {'path': path, 'error': e})
+
+class LogWatcher(object):
+    '''Wait for changes of a logfile
+
+       Uses inotify on the directory of the logfile, so that both appending
+       to the logfile and replacing it (log rotation) wake up the reader.
+       Falls back to polling if inotify isn't available.'''
+
+    def __init__(self, filename, use_inotify=True):
+        self.filename = filename
+        self.basename = os.path.basename(filename)
+        if not isinstance(self.basename, bytes):
+            self.basename = self.basename.encode('utf-8', LOG_DECODE_ERRORS)
+        self.fd = None
+        if use_inotify:
+            self.fd = self._init_inotify()
+
+    def _init_inotify(self):
+        '''Return an inotify file descriptor watching the directory of the logfile, or None'''
+        try:
+            # only needed here
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (ImportError, OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        if not isinstance(directory, bytes):
+            directory = directory.encode('utf-8', LOG_DECODE_ERRORS)
+        mask = IN_MODIFY | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF
+        if libc.inotify_add_watch(fd, directory, mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def uses_inotify(self):
+        return self.fd is not None
+
+    def wait(self, timeout):
+        '''Wait up to timeout seconds for a change of the logfile.
+           Returns True if there was (or, when polling, might have been) a change.'''
+        if self.fd is None:
+            time.sleep(timeout)
+            return True
+
+        deadline = time.time() + timeout
+        while True:
+            remaining = max(0, deadline - time.time())
+            readable = select.select([self.fd], [], [], remaining)[0]
+            if not readable:
+                return False
+            if self._read_events():
+                return True
+
+    def _read_events(self):
+        '''Read the pending inotify events, and check if one of them is about the logfile'''
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError:
+            return False
+
+        changed = False
+        pos = 0
+        while pos + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, pos)
+            name = data[pos + INOTIFY_EVENT.size:pos + INOTIFY_EVENT.size + length].rstrip(b'\0')
+            pos += INOTIFY_EVENT.size + length
+            # events might have been lost, or the directory is gone
+            if mask & (IN_Q_OVERFLOW | IN_IGNORED | IN_DELETE_SELF):
+                changed = True
+            elif name == self.basename:
+                changed = True
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class LogSink(object):
+    '''Base class for consumers of ReadLog.get_events() (see ReadLog.process_log())'''
+
+    def handle(self, event):
+        '''handle one event'''
+        raise AppArmorBug('%s must implement handle()' % type(self).__name__)
+
+    def finish(self):
+        '''called after the last event, returns the result of the sink'''
+        return None
+
+class LogTreeSink(LogSink):
+    '''Build the per-pid event tree used by aa-logprof (ReadLog.log)
+
+       Note that this modifies the events (for example the masks get converted to sets).'''
+
+    def __init__(self, readlog):
+        self.readlog = readlog
+
+    def handle(self, event):
+        self.readlog.add_event_to_tree(event)
+
+    def finish(self):
+        return self.readlog.log
+
+class LogCountSink(LogSink):
+    '''Count events per aamode, operation and profile'''
+
+    def __init__(self):
+        self.total = 0
+        self.aamode = dict()
+        self.operation = dict()
+        self.profile = dict()
+
+    def handle(self, event):
+        self.total += 1
+        for counter, key in [(self.aamode, 'aamode'), (self.operation, 'operation'), (self.profile, 'profile')]:
+            value = event.get(key)
+            counter[value] = counter.get(value, 0) + 1
+
+    def finish(self):
+        return {'total': self.total, 'aamode': self.aamode, 'operation': self.operation, 'profile': self.profile}
+
+class LogJSONSink(LogSink):
+    '''Write each event as one line of JSON to stream'''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def _convert(self, value):
+        # masks are sets once add_event_to_tree() has seen the event
+        if isinstance(value, (set, frozenset)):
+            return sorted(value)
+        raise TypeError('%s is not JSON serializable' % repr(value))
+
+    def handle(self, event):
+        self.stream.write(json.dumps(event, sort_keys=True, default=self._convert))
+        self.stream.write('\n')
+        self.count += 1
+
+    def finish(self):
+        self.stream.flush()
+        return self.count
@@ -0,0 +1,173 @@
+# ----------------------------------------------------------------------
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License as published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+# ----------------------------------------------------------------------
+
+import collections
+
+from apparmor.common import hasher, regexp_cache
+
+# characters that give a path rule a meaning beyond its literal text
+# (see convert_regexp())
+GLOB_CHARS = set('*?[]{}()|^$\\')
+
+class _TrieNode(object):
+    '''One path component in the glob prefix trie'''
+    __slots__ = ['children', 'globs']
+
+    def __init__(self):
+        self.children = dict()
+        self.globs = []
+
+class PathMatcher(object):
+    '''Index of the path rules of a profile or include fragment
+
+       Literal paths are kept in a dict. Globs are bucketed in a trie keyed by
+       the path components of their literal prefix (for example /usr/lib/ for
+       /usr/lib/**.so), so that match() only needs to test the globs whose
+       prefix is a leading part of the given path.'''
+
+    def __init__(self, entries):
+        self.keys = frozenset(entries)
+        self.literals = dict()
+        self.root = _TrieNode()
+
+        for pos, entry in enumerate(entries):
+            if entry == entry.strip() and not GLOB_CHARS.intersection(entry):
+                self.literals[entry] = pos
+                continue
+
+            regexp = regexp_cache.get(entry)
+            if regexp is None:
+                continue  # invalid regex never matches (see matchliteral())
+
+            node = self.root
+            prefix = entry
+            for i, char in enumerate(entry):
+                if char in GLOB_CHARS:
+                    prefix = entry[:i]
+                    break
+
+            if entry == entry.lstrip() and '/' in prefix:
+                for component in prefix[:prefix.rfind('/')].split('/'):
+                    node = node.children.setdefault(component, _TrieNode())
+
+            node.globs.append((pos, entry, regexp))
+
+    def match(self, path):
+        '''Return the entries matching path, in the order they were given to __init__()'''
+        found = []
+
+        if path in self.literals:
+            found.append((self.literals[path], path))
+
+        node = self.root
+        components = path.split('/')[:-1]
+        i = 0
+        while node is not None:
+            for pos, entry, regexp in node.globs:
+                if regexp.search(path):
+                    found.append((pos, entry))
+
+            if i >= len(components):
+                break
+            node = node.children.get(components[i])
+            i += 1
+
+        found.sort()
+        return [entry for pos, entry in found]
+
+class PathIndex(object):
+    '''Reverse index of the path rules of several fragments (for example all includes)
+
+       Each distinct path rule is tested only once per path, using the glob
+       prefix trie of PathMatcher, no matter how many fragments contain it.'''
+
+    def __init__(self, fragments):
+        '''fragments is a list of (name, path rules dict)'''
+        self.owners = dict()  # entry -> names of the fragments containing it
+        for name, rules in fragments:
+            for entry in rules:
+                self.owners.setdefault(entry, []).append(name)
+        self.matcher = PathMatcher(list(self.owners.keys()))
+
+    def match(self, path):
+        '''Return a dict fragment name -> list of its entries matching path
+
+           An entry that is identical to path counts as matching even if it
+           contains glob characters.'''
+        entries = self.matcher.match(path)
+        if path in self.owners and path not in entries:
+            entries.append(path)
+
+        found = dict()
+        for entry in entries:
+            for name in self.owners[entry]:
+                found.setdefault(name, []).append(entry)
+        return found
+
+class PathRules(collections.defaultdict):
+    '''hasher() for the path rules of a profile or include (profile['allow']['path'])
+
+       Keeps the PathMatcher for its keys, and drops it whenever a rule gets
+       added or removed (including keys created by reading a missing key,
+       like with every hasher). The matcher is rebuilt on the next lookup.'''
+
+    def __init__(self, *args, **kwargs):
+        super(PathRules, self).__init__(hasher, *args, **kwargs)
+        self._matcher = None
+
+    def __reduce__(self):
+        # don't pickle (or deepcopy) the matcher
+        return (PathRules, (), None, None, iter(self.items()))
+
+    def get_matcher(self):
+        if self._matcher is None:
+            self._matcher = PathMatcher(list(self.keys()))
+        return self._matcher
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._matcher = None
+        super(PathRules, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._matcher = None
+        super(PathRules, self).__delitem__(key)
+
+    def pop(self, *args):
+        self._matcher = None
+        return super(PathRules, self).pop(*args)
+
+    def popitem(self):
+        self._matcher = None
+        return super(PathRules, self).popitem()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._matcher = None
+        return super(PathRules, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._matcher = None
+        super(PathRules, self).update(*args, **kwargs)
+
+    def clear(self):
+        self._matcher = None
+        super(PathRules, self).clear()
+
+def get_path_matcher(rules):
+    '''Return a PathMatcher for the given path rules dict (for example profile['allow']['path'])
+
+       For PathRules, the matcher is built on first use and kept until the
+       rules change. For other dicts, it is built on each call.'''
+    if isinstance(rules, PathRules):
+        return rules.get_matcher()
+    return PathMatcher(list(rules.keys()))
@@ -0,0 +1,149 @@
+# ----------------------------------------------------------------------
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License as published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+# ----------------------------------------------------------------------
+'''Index of the profile names and attachments in a profile directory
+
+Only the lines starting and ending blocks are looked at, so building the
+index is much cheaper than parsing all profiles. The result can be cached
+in a JSON file, and only files whose inode, mtime or size changed are
+scanned again.'''
+
+import os
+
+from apparmor.cache import load_json_cache, save_json_cache
+from apparmor.common import AppArmorException, DebugLogger, open_file_read
+from apparmor.pathmatcher import PathIndex
+from apparmor.regex import (RE_PROFILE_START, RE_PROFILE_END, RE_PROFILE_HAT_DEF, RE_PROFILE_CONDITIONAL,
+                            RE_PROFILE_CONDITIONAL_VARIABLE, RE_PROFILE_CONDITIONAL_BOOLEAN,
+                            parse_profile_start_line)
+
+debug_logger = DebugLogger('profile_index')
+
+# bump this if the content of the cache changes
+CACHE_FORMAT = 2
+
+RE_BLOCK_START = [RE_PROFILE_HAT_DEF, RE_PROFILE_CONDITIONAL, RE_PROFILE_CONDITIONAL_VARIABLE, RE_PROFILE_CONDITIONAL_BOOLEAN]
+
+def scan_profile_headers(filename):
+    '''Return the names of the top-level profiles in filename, and a dict
+       attachment -> profile name (profile names starting with / are used as
+       attachment if there's no explicit one). Only the lines starting or
+       ending a block are parsed.'''
+    names = []
+    attachments = dict()
+    depth = 0
+    with open_file_read(filename) as f_in:
+        for line in f_in:
+            if '{' in line:
+                if RE_PROFILE_START.search(line):
+                    if depth == 0:
+                        matches = parse_profile_start_line(line, filename)
+                        names.append(matches['profile'])
+                        if matches['attachment']:
+                            attachments[matches['attachment']] = matches['profile']
+                        elif matches['profile'].startswith('/'):
+                            # without an explicit attachment, the profile name is used (and can contain globs)
+                            attachments[matches['profile']] = matches['profile']
+                    depth += 1
+                    continue
+                if any(regex.search(line) for regex in RE_BLOCK_START):
+                    depth += 1
+                    continue
+            if '}' in line and RE_PROFILE_END.search(line):
+                depth = max(0, depth - 1)
+
+    return names, attachments
+
+class ProfileIndex(object):
+    '''Maps profile names and attachments to the files in profile_dir defining them
+
+       skip is a function that returns True for files that aren't profiles
+       (for example is_skippable_file()). If cache_file is given, the
+       scan results are stored there (with save()) and reused as long as
+       inode, mtime and size of each file don't change.'''
+
+    def __init__(self, profile_dir, skip=None, cache_file=None):
+        self.profile_dir = profile_dir
+        self.skip = skip
+        self.cache_file = cache_file
+        self.files = dict()  # filename -> {'key': [inode, mtime, size], 'names': [...], 'attachments': {attachment: name}}
+        self.dirty = False
+        self.names = dict()
+        self.attachments = None
+        self._load_cache()
+        self.update()
+
+    def _load_cache(self):
+        cached = load_json_cache(self.cache_file, CACHE_FORMAT)
+        if cached and cached.get('profile_dir') == self.profile_dir:
+            self.files = cached['files']
+
+    def save(self):
+        '''Write the cache file (if anything changed). Errors are ignored.'''
+        if not self.cache_file or not self.dirty:
+            return
+        if save_json_cache(self.cache_file, CACHE_FORMAT, {'profile_dir': self.profile_dir, 'files': self.files}):
+            self.dirty = False
+
+    def update(self):
+        '''Scan the new and changed files in profile_dir, and forget the removed ones'''
+        files = dict()
+        for name in sorted(os.listdir(self.profile_dir)):
+            filename = os.path.join(self.profile_dir, name)
+            if not os.path.isfile(filename) or (self.skip and self.skip(filename)):
+                continue
+
+            st = os.stat(filename)
+            key = [st.st_ino, st.st_mtime, st.st_size]
+            cached = self.files.get(filename)
+            if cached and cached['key'] == key:
+                files[filename] = cached
+                continue
+
+            try:
+                names, attachments = scan_profile_headers(filename)
+            except (IOError, AppArmorException) as e:
+                # the error will show up if the file gets parsed
+                debug_logger.debug('Unable to scan %s: %s', filename, e)
+                names, attachments = [], dict()
+            files[filename] = {'key': key, 'names': names, 'attachments': attachments}
+            self.dirty = True
+
+        if set(files) != set(self.files):
+            self.dirty = True
+        self.files = files
+
+        self.names = dict()
+        for filename in sorted(self.files):
+            for name in self.files[filename]['names']:
+                # if a profile is defined in several files, the last one (sorted by name) wins
+                self.names[name] = filename
+        self.attachments = None
+
+    def find(self, name):
+        '''Return (profile name, file) for the profile name, or for the profile
+           attached to the path name (if there's only one). Returns (None, None)
+           if there is no such profile.'''
+        if name in self.names:
+            return name, self.names[name]
+        if not name.startswith('/'):
+            return None, None
+
+        if self.attachments is None:
+            self.attachments = PathIndex([(filename, self.files[filename]['attachments']) for filename in sorted(self.files)])
+        found = self.attachments.match(name)
+        if len(found) == 1:
+            filename, attachments = list(found.items())[0]
+            if len(attachments) == 1:
+                return self.files[filename]['attachments'][attachments[0]], filename
+        if found:
+            debug_logger.debug('%s is attached to several profiles: %s', name, ', '.join(sorted(found)))
+        return None, None
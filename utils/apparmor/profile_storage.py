@@ -0,0 +1,167 @@
+# ----------------------------------------------------------------------
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License as published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+# ----------------------------------------------------------------------
+
+import sys
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from apparmor.common import AppArmorBug, hasher
+from apparmor.pathmatcher import PathRules
+
+from apparmor.rule.capability import CapabilityRuleset
+from apparmor.rule.change_profile import ChangeProfileRuleset
+from apparmor.rule.network import NetworkRuleset
+from apparmor.rule.rlimit import RlimitRuleset
+
+if sys.version_info[0] >= 3:
+    from sys import intern as _intern
+else:
+    from __builtin__ import intern as _intern
+
+def intern_name(name):
+    '''Return the interned version of a profile or hat name, so that the
+       many dicts keyed by profile names share one copy of each name'''
+    try:
+        return _intern(name)
+    except TypeError:
+        # python 2 can only intern str, not unicode
+        return name
+
+# rules stored as (nested) hasher, created on first access
+CONTAINER_KEYS = ['include', 'localinclude', 'lvar', 'alias', 'repo']
+
+# allow and deny rules, stored as RuleStorage
+RULE_STORAGE_KEYS = ['allow', 'deny']
+
+# rule classes
+RULESET_KEYS = ['capability', 'change_profile', 'network', 'rlimit']
+
+# other information about the profile
+#   profile_keyword and header_comment are currently only set by set_profile_flags()
+SCALAR_KEYS = ['name', 'filename', 'flags', 'profile', 'attachment', 'external',
+               'initial_comment', 'header_comment', 'profile_keyword']
+
+# keys of RuleStorage: path rules (PathRules), link rules (hasher) and lists of rule objects
+RULE_KEYS = ['path', 'link', 'dbus', 'mount', 'signal', 'ptrace', 'pivot_root', 'unix']
+
+class SlotStorage(MutableMapping):
+    '''Base class for dict-like storage with a fixed set of keys (the __slots__
+       of the subclass), each of them stored in a slot instead of a dict.
+
+       For compatibility with the hasher() these classes replace, reading a
+       key that wasn't set yet stores and returns a new value (see _new_value()).
+       Unknown keys raise an AppArmorBug.'''
+
+    __slots__ = ()
+
+    def _new_value(self, key):
+        '''Return the value for key if it wasn't set before it gets read'''
+        return hasher()
+
+    def _check_key(self, key):
+        if key not in self.__slots__:
+            raise AppArmorBug('Unknown key in %s: %s' % (type(self).__name__, key))
+
+    def __getitem__(self, key):
+        self._check_key(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            setattr(self, key, self._new_value(key))
+            return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        self._check_key(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        delattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def __iter__(self):
+        for key in self.__slots__:
+            if hasattr(self, key):
+                yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def get(self, key, default=None):
+        if key in self:
+            return getattr(self, key)
+        return default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = getattr(self, key)
+            delattr(self, key)
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return getattr(self, key)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self.items()))
+
+class RuleStorage(SlotStorage):
+    '''Storage for the allow or deny rules of a profile or hat (aa[profile][hat]['allow'])
+
+       Only the keys listed in RULE_KEYS can be used. 'path' is always set
+       (to PathRules, see rematchfrag()).'''
+
+    __slots__ = RULE_KEYS
+
+    def __init__(self):
+        self.path = PathRules()
+
+    def _new_value(self, key):
+        if key == 'path':
+            return PathRules()
+        return hasher()
+
+class ProfileStorage(SlotStorage):
+    '''Storage for a profile or hat (aa[profile][hat])
+
+       Only the keys listed in CONTAINER_KEYS, RULE_STORAGE_KEYS, RULESET_KEYS
+       and SCALAR_KEYS can be used, see SlotStorage.'''
+
+    __slots__ = CONTAINER_KEYS + RULE_STORAGE_KEYS + RULESET_KEYS + SCALAR_KEYS
+
+    def __init__(self):
+        self.capability = CapabilityRuleset()
+        self.change_profile = ChangeProfileRuleset()
+        self.network = NetworkRuleset()
+        self.rlimit = RlimitRuleset()
+
+        self.allow = RuleStorage()
+        self.allow['dbus'] = list()
+        self.allow['mount'] = list()
+        self.allow['signal'] = list()
+        self.allow['ptrace'] = list()
+        self.allow['pivot_root'] = list()
+
+    def _new_value(self, key):
+        if key in RULE_STORAGE_KEYS:
+            return RuleStorage()
+        return hasher()
@@ -56,11 +56,26 @@ class BaseRule(object):
            Note: This function just provides an answer to "is this your job?".
                  It does not guarantee that the rule is completely valid.'''
 
-        if cls._match(raw_rule):
+        if cls._cached_match(raw_rule):
             return True
         else:
             return False
 
+    @classmethod
+    def _cached_match(cls, raw_rule):
+        '''return the regex match object for raw_rule
+           The result of the last call is cached per class because match() and
+           _parse() are typically called for the same raw_rule directly after
+           each other, so the regex only needs to run once.'''
+
+        last_rule, last_match = cls.__dict__.get('_last_match', (None, None))
+        if last_rule is not None and last_rule == raw_rule:
+            return last_match
+
+        matches = cls._match(raw_rule)
+        cls._last_match = (raw_rule, matches)
+        return matches
+
     # @abstractmethod  FIXME - uncomment when python3 only
     @classmethod
     def _match(cls, raw_rule):
@@ -141,7 +156,17 @@ class BaseRule(object):
            - "unknown" (to be exact: the value specified for "unknown" as set when loading the severity database), or
            - sev_db.NOT_IMPLEMENTED if no severity check is implemented for this rule type.
            sev_db must be an apparmor.severity.Severity object.'''
-        return sev_db.NOT_IMPLEMENTED
+        resources = self.severity_resources()
+        if resources is None:
+            return sev_db.NOT_IMPLEMENTED
+
+        return sev_db.max_rank(sev_db.rank_many(resources))
+
+    def severity_resources(self):
+        '''return the list of resources (as understood by Severity.rank()) to check
+           for the severity of this rule, or None if no severity check is
+           implemented for this rule type - override in child class'''
+        return None
 
     def logprof_header(self):
         '''return the headers (human-readable version of the rule) to display in aa-logprof for this rule object
@@ -320,6 +345,36 @@ class BaseRuleset(object):
 
         return deleted
 
+    def get_severity_summary(self, sev_db):
+        '''return the severity of all rules, as
+           {'max': highest severity, 'ranks': {severity: number of rules}}
+           'max' is None if no rule has a known severity.
+           sev_db must be an apparmor.severity.Severity object.'''
+
+        # rank the resources of all rules in one go
+        all_resources = []
+        rule_resources = []
+        for rule in self.rules:
+            resources = rule.severity_resources()
+            rule_resources.append(resources)
+            if resources:
+                all_resources += resources
+
+        ranks = iter(sev_db.rank_many(all_resources))
+
+        summary = {'max': None, 'ranks': dict()}
+        for resources in rule_resources:
+            if resources is None:
+                severity = sev_db.NOT_IMPLEMENTED
+            else:
+                severity = sev_db.max_rank([next(ranks) for resource in resources])
+
+            summary['ranks'][severity] = summary['ranks'].get(severity, 0) + 1
+            if isinstance(severity, int) and (summary['max'] is None or severity > summary['max']):
+                summary['max'] = severity
+
+        return summary
+
     def get_glob_ext(self, path_or_rule):
         '''returns the next possible glob with extension (for file rules only).
            For all other rule types, raise an exception'''
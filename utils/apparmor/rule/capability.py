@@ -68,7 +68,7 @@ class CapabilityRule(BaseRule):
     def _parse(cls, raw_rule):
         '''parse raw_rule and return CapabilityRule'''
 
-        matches = cls._match(raw_rule)
+        matches = cls._cached_match(raw_rule)
         if not matches:
             raise AppArmorException(_("Invalid capability rule '%s'") % raw_rule)
 
@@ -126,20 +126,11 @@ class CapabilityRule(BaseRule):
 
         return True
 
-    def severity(self, sev_db):
+    def severity_resources(self):
         if self.all_caps:
-            severity = sev_db.rank_capability('__ALL__')
-        else:
-            severity = -1
-            for cap in self.capability:
-                sev = sev_db.rank_capability(cap)
-                if isinstance(sev, int):  # type check avoids breakage caused by 'unknown'
-                    severity = max(severity, sev)
-
-        if severity == -1:
-            severity = sev  # effectively 'unknown'
+            return ['CAP___ALL__']
 
-        return severity
+        return ['CAP_%s' % cap for cap in sorted(self.capability)]
 
     def logprof_header_localvars(self):
         if self.all_caps:
@@ -79,7 +79,7 @@ class ChangeProfileRule(BaseRule):
     def _parse(cls, raw_rule):
         '''parse raw_rule and return ChangeProfileRule'''
 
-        matches = cls._match(raw_rule)
+        matches = cls._cached_match(raw_rule)
         if not matches:
             raise AppArmorException(_("Invalid change_profile rule '%s'") % raw_rule)
 
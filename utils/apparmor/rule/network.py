@@ -97,7 +97,7 @@ class NetworkRule(BaseRule):
     def _parse(cls, raw_rule):
         '''parse raw_rule and return NetworkRule'''
 
-        matches = cls._match(raw_rule)
+        matches = cls._cached_match(raw_rule)
         if not matches:
             raise AppArmorException(_("Invalid network rule '%s'") % raw_rule)
 
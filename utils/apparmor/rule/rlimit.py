@@ -113,7 +113,7 @@ class RlimitRule(BaseRule):
     def _parse(cls, raw_rule):
         '''parse raw_rule and return RlimitRule'''
 
-        matches = cls._match(raw_rule)
+        matches = cls._cached_match(raw_rule)
         if not matches:
             raise AppArmorException(_("Invalid rlimit rule '%s'") % raw_rule)
 
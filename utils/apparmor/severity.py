@@ -14,12 +14,46 @@
 from __future__ import with_statement
 import os
 import re
+from apparmor.cache import FileCache
 from apparmor.common import AppArmorException, open_file_read, warn, convert_regexp  # , msg, error, debug
 from apparmor.regex import re_match_include
 
+RE_VARIABLE = re.compile('@{([^{.]*)}')
+
+# maximum number of different variable sets to keep variable ranks for
+MAX_VARIABLE_SETS = 16
+
+class _SeverityNode(object):
+    '''One directory level of the severity tree of glob paths'''
+    __slots__ = ['children', 'globs']
+
+    def __init__(self):
+        self.children = dict()
+        self.globs = []  # (compiled regex, rank)
+
+def _compile_tree(tree):
+    '''Convert the REGEXPS tree to a tree of _SeverityNode with precompiled regexes'''
+    node = _SeverityNode()
+    for key, subtree in tree.items():
+        if '*' in key:
+            if 'AA_RANK' in subtree:
+                node.globs.append((re.compile('^' + key), subtree['AA_RANK']))
+        else:
+            node.children[key] = _compile_tree(subtree)
+    return node
+
+def _max_rank(ranks, mode, sev):
+    '''Returns the max of sev and the ranks for mode'''
+    for m in mode:
+        if sev is None or ranks.get(m, -1) > sev:
+            sev = ranks.get(m, None)
+    return sev
+
 class Severity(object):
-    def __init__(self, dbname=None, default_rank=10):
-        """Initialises the class object"""
+    def __init__(self, dbname=None, default_rank=10, cache_dir=None):
+        """Initialises the class object
+
+           If cache_dir is given, the parsed database is cached there."""
         self.PROF_DIR = '/etc/apparmor.d'  # The profile directory
         self.NOT_IMPLEMENTED = '_-*not*implemented*-_'  # used for rule types that don't have severity ratings
         self.severity = dict()
@@ -30,9 +64,30 @@ class Severity(object):
         self.severity['DEFAULT_RANK'] = default_rank
         # For variable expansions for the profile
         self.severity['VARIABLES'] = dict()
+        # ranks of resources containing variables, per set of variables
+        self.variable_rank_caches = dict()
+        self.variable_ranks = None
         if not dbname:
             raise AppArmorException("No severity db file given")
 
+        db_cache = None
+        cached = None
+        if cache_dir:
+            # the mtime of this file changes with each update of the utils
+            db_cache = FileCache(cache_dir, 'severity', os.path.getmtime(__file__))
+            cached = db_cache.load(dbname)
+
+        if cached:
+            self.severity['CAPABILITIES'], self.severity['FILES'], self.severity['REGEXPS'] = cached
+        else:
+            self.load_database(dbname)
+            if db_cache:
+                db_cache.store(dbname, (self.severity['CAPABILITIES'], self.severity['FILES'], self.severity['REGEXPS']))
+
+        self.regexp_tree = _compile_tree(self.severity['REGEXPS'])
+
+    def load_database(self, dbname):
+        """Parses the severity database"""
         with open_file_read(dbname) as database:  # open(dbname, 'r')
             for lineno, line in enumerate(database, start=1):
                 line = line.strip()  # or only rstrip and lstrip?
@@ -89,28 +144,29 @@ class Severity(object):
         return self.severity['DEFAULT_RANK']
 
     def check_subtree(self, tree, mode, sev, segments):
-        """Returns the max severity from the regex tree"""
-        if len(segments) == 0:
-            first = ''
-        else:
-            first = segments[0]
-        rest = segments[1:]
-        path = '/'.join([first] + rest)
-        # Check if we have a matching directory tree to descend into
-        if tree.get(first, False):
-            sev = self.check_subtree(tree[first], mode, sev, rest)
-        # If severity still not found, match against globs
-        if sev is None:
-            # Match against all globs at this directory level
-            for chunk in tree.keys():
-                if '*' in chunk:
-                    # Match rest of the path
-                    if re.search("^" + chunk, path):
-                        # Find max rank
-                        if "AA_RANK" in tree[chunk].keys():
-                            for m in mode:
-                                if sev is None or tree[chunk]["AA_RANK"].get(m, -1) > sev:
-                                    sev = tree[chunk]["AA_RANK"].get(m, None)
+        """Returns the max severity from the regex tree (a _SeverityNode)"""
+        # Descend into the matching directory tree as far as possible
+        nodes = [tree]
+        while True:
+            if len(nodes) <= len(segments):
+                first = segments[len(nodes) - 1]
+            else:
+                first = ''
+            child = nodes[-1].children.get(first)
+            if child is None:
+                break
+            nodes.append(child)
+
+        # Match against the globs, starting at the deepest directory level,
+        # until a severity is found
+        for depth in range(len(nodes) - 1, -1, -1):
+            if sev is not None:
+                break
+            # Match rest of the path
+            path = '/'.join(segments[depth:])
+            for regexp, ranks in nodes[depth].globs:
+                if regexp.search(path):
+                    sev = _max_rank(ranks, mode, sev)
         return sev
 
     def handle_file(self, resource, mode):
@@ -119,14 +175,12 @@ class Severity(object):
         pieces = resource.split('/')    # break path into directory level chunks
         sev = None
         # Check for an exact match in the db
-        if resource in self.severity['FILES'].keys():
+        if resource in self.severity['FILES']:
             # Find max value among the given modes
-            for m in mode:
-                if sev is None or self.severity['FILES'][resource].get(m, -1) > sev:
-                    sev = self.severity['FILES'][resource].get(m, None)
+            sev = _max_rank(self.severity['FILES'][resource], mode, sev)
         else:
             # Search regex tree for matching glob
-            sev = self.check_subtree(self.severity['REGEXPS'], mode, sev, pieces)
+            sev = self.check_subtree(self.regexp_tree, mode, sev, pieces)
         if sev is None:
             # Return default rank if severity cannot be found
             return self.severity['DEFAULT_RANK']
@@ -136,7 +190,10 @@ class Severity(object):
     def rank(self, resource, mode=None):
         """Returns the rank for the resource file/capability"""
         if '@' in resource:    # path contains variable
-            return self.handle_variable_rank(resource, mode)
+            ranks = self.get_variable_ranks()
+            if (resource, mode) not in ranks:
+                ranks[(resource, mode)] = self.handle_variable_rank(resource, mode)
+            return ranks[(resource, mode)]
         elif resource[0] == '/':    # file resource
             return self.handle_file(resource, mode)
         elif resource[0:4] == 'CAP_':    # capability resource
@@ -144,10 +201,90 @@ class Severity(object):
         else:
             raise AppArmorException("Unexpected rank input: %s" % resource)
 
+    def rank_many(self, resources, modes=None):
+        """Returns a list with the ranks for the resource files/capabilities
+
+           modes can be a list with the mode for each resource, or a single mode
+           used for all resources. File resources that share leading path
+           components share the walk through the regex tree."""
+        if modes is None or not isinstance(modes, list):
+            modes = [modes] * len(resources)
+        elif len(modes) != len(resources):
+            raise AppArmorException('rank_many() needs one mode per resource')
+
+        ranks = [None] * len(resources)
+        pending = dict()  # resource -> {mode: None}, for files that need the regex tree
+        for index, (resource, mode) in enumerate(zip(resources, modes)):
+            if resource[0] == '/' and '@' not in resource:
+                if resource[1:] in self.severity['FILES']:
+                    ranks[index] = _max_rank(self.severity['FILES'][resource[1:]], mode, None)
+                else:
+                    pending.setdefault(resource, dict())[mode] = None
+            else:
+                ranks[index] = self.rank(resource, mode)
+
+        if pending:
+            items = [(resource[1:].split('/'), sevs) for resource, sevs in pending.items()]
+            self.rank_subtree(self.regexp_tree, 0, items)
+
+            for index, (resource, mode) in enumerate(zip(resources, modes)):
+                if resource in pending:
+                    ranks[index] = pending[resource][mode]
+
+        for index, rank in enumerate(ranks):
+            if rank is None:
+                # Return default rank if severity cannot be found
+                ranks[index] = self.severity['DEFAULT_RANK']
+
+        return ranks
+
+    def rank_subtree(self, node, depth, items):
+        """Stores the severity from the regex tree for all items (segments, {mode: severity})
+           that share the first depth path segments"""
+        # Descend into the matching directory trees first
+        groups = dict()
+        for item in items:
+            segments = item[0]
+            first = segments[depth] if depth < len(segments) else ''
+            if first in node.children:
+                groups.setdefault(first, []).append(item)
+        for first, group in groups.items():
+            self.rank_subtree(node.children[first], depth + 1, group)
+
+        # If severity still not found, match against globs at this directory level
+        if not node.globs:
+            return
+        for segments, sevs in items:
+            modes = [mode for mode in sevs if sevs[mode] is None]
+            if not modes:
+                continue
+            # Match rest of the path
+            path = '/'.join(segments[depth:])
+            for regexp, node_ranks in node.globs:
+                if regexp.search(path):
+                    for mode in modes:
+                        sevs[mode] = _max_rank(node_ranks, mode, sevs[mode])
+
+    def max_rank(self, ranks):
+        """Returns the highest of the given ranks, ignoring unknown ranks
+           (default rank if none of them is known)"""
+        known = [rank for rank in ranks if isinstance(rank, int)]  # type check avoids breakage caused by 'unknown'
+        if known:
+            return max(known)
+        return self.severity['DEFAULT_RANK']
+
+    def get_variable_ranks(self):
+        """Returns the cache of variable ranks for the currently loaded variables"""
+        if self.variable_ranks is None:
+            key = tuple(sorted((var, tuple(values)) for var, values in self.severity['VARIABLES'].items()))
+            if key not in self.variable_rank_caches and len(self.variable_rank_caches) >= MAX_VARIABLE_SETS:
+                self.variable_rank_caches.clear()
+            self.variable_ranks = self.variable_rank_caches.setdefault(key, dict())
+        return self.variable_ranks
+
     def handle_variable_rank(self, resource, mode):
         """Returns the max possible rank for file resources containing variables"""
-        regex_variable = re.compile('@{([^{.]*)}')
-        matches = regex_variable.search(resource)
+        matches = RE_VARIABLE.search(resource)
         if matches:
             rank = self.severity['DEFAULT_RANK']
             variable = '@{%s}' % matches.groups()[0]
@@ -180,6 +317,7 @@ class Severity(object):
 
     def load_variables(self, prof_path):
         """Loads the variables for the given profile"""
+        self.variable_ranks = None
         if os.path.isfile(prof_path):
             with open_file_read(prof_path) as f_in:
                 for line in f_in:
@@ -210,3 +348,4 @@ class Severity(object):
     def unload_variables(self):
         """Clears all loaded variables"""
         self.severity['VARIABLES'] = dict()
+        self.variable_ranks = None
@@ -0,0 +1,94 @@
+# ----------------------------------------------------------------------
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License as published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+# ----------------------------------------------------------------------
+
+from copy import deepcopy
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from apparmor.common import hasher
+
+def take_snapshot(data):
+    '''Return a pickled snapshot of data (for example a hasher tree with profiles)
+
+       Pickling is done in C and much faster than copy.deepcopy(), and
+       the snapshot is immutable, so it can be stored without copying it
+       again. Returns None if data can't be pickled.'''
+    try:
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+
+def snapshot_copy(data):
+    '''Return a deep copy of data, made via a snapshot if possible'''
+    snapshot = take_snapshot(data)
+    if snapshot is None:
+        return deepcopy(data)
+    return pickle.loads(snapshot)
+
+class _Snapshot(object):
+    '''Value stored in a SnapshotStore that wasn't accessed yet'''
+    __slots__ = ['pickled', 'data']
+
+    def __init__(self, data):
+        self.pickled = take_snapshot(data)
+        if self.pickled is None:
+            self.data = deepcopy(data)
+
+    def load(self):
+        if self.pickled is None:
+            return self.data
+        return pickle.loads(self.pickled)
+
+class SnapshotStore(dict):
+    '''dict that stores a snapshot of each value assigned to it (like
+       hasher()[key] = deepcopy(value), for example for original_aa)
+
+       The snapshot is only unpickled when the value is accessed for the
+       first time, so keeping the original state of all profiles is cheap
+       as long as only a few of them are looked at. Missing keys are
+       created as hasher() like in a hasher.'''
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, _Snapshot(value))
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, _Snapshot):
+            value = value.load()
+            dict.__setitem__(self, key, value)
+        return value
+
+    def __missing__(self, key):
+        value = hasher()
+        dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            dict.__delitem__(self, key)
+            return value
+        return dict.pop(self, key, *default)
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
@@ -11,26 +11,51 @@
 #    GNU General Public License for more details.
 #
 # ----------------------------------------------------------------------
+import glob
 import os
 import sys
 
 import apparmor.aa as apparmor
 import apparmor.ui as aaui
-from apparmor.common import user_perm, cmd
+from apparmor.common import user_perm, open_file_read
 
 # setup module translations
 from apparmor.translations import init_translation
 _ = init_translation()
 
+def read_target_list(filename):
+    '''Read the programs or profiles from filename (- for stdin), one per line.
+       Empty lines and lines starting with # are ignored.'''
+    if filename == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open_file_read(filename) as f_in:
+            lines = f_in.readlines()
+
+    targets = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            targets.append(line)
+    return targets
+
 class aa_tools:
     def __init__(self, tool_name, args):
         self.name = tool_name
         self.profiledir = args.dir
-        self.profiling = args.program
+        self.profiling = list(args.program)
         self.check_profile_dir()
         self.silent = None
         self.do_reload = args.do_reload
 
+        # only some of the tools have these options
+        if getattr(args, 'from_file', None):
+            self.profiling += read_target_list(args.from_file)
+        if getattr(args, 'jobs', None):
+            apparmor.parallel_jobs = args.jobs
+        # profiles to reload/unload with one apparmor_parser call, see flush_reload()
+        self.reload_queue = apparmor.ReloadQueue()
+
         if tool_name in ['audit']:
             self.remove = args.remove
         elif tool_name == 'autodep':
@@ -48,10 +73,34 @@ class aa_tools:
         if not user_perm(apparmor.profile_dir):
             raise apparmor.AppArmorException("Cannot write to profile directory: %s" % (apparmor.profile_dir))
 
+    def get_profile_file(self, program):
+        '''Returns the file with the profile for program, using the profile
+           index instead of reading all profiles. If there's no profile, the
+           default filename for program is returned.'''
+        return apparmor.find_profile(program)[1] or apparmor.get_profile_filename(program)
+
+    def expand_globs(self):
+        '''Iterator function that expands the arguments containing glob characters.
+           Relative patterns that don't match anything are tried in the profile directory.'''
+        for p in self.profiling:
+            if not glob.has_magic(p):
+                yield p
+                continue
+
+            matches = sorted(glob.glob(p))
+            if not matches and not p.startswith('/'):
+                matches = sorted(glob.glob(os.path.join(apparmor.profile_dir, p)))
+            matches = [match for match in matches if os.path.isfile(match) and not apparmor.is_skippable_file(match)]
+            if not matches:
+                aaui.UI_Info(_("%s doesn't match any file, skipping") % p)
+
+            for match in matches:
+                yield match
+
     def get_next_to_profile(self):
         '''Iterator function to walk the list of arguments passed'''
 
-        for p in self.profiling:
+        for p in self.expand_globs():
             if not p:
                 continue
 
@@ -64,12 +113,12 @@ class aa_tools:
                     profile = fq_path
                 else:
                     program = fq_path
-                    profile = apparmor.get_profile_filename(fq_path)
+                    profile = self.get_profile_file(fq_path)
             else:
                 which = apparmor.which(p)
                 if which is not None:
                     program = apparmor.get_full_path(which)
-                    profile = apparmor.get_profile_filename(program)
+                    profile = self.get_profile_file(program)
                 elif os.path.exists(os.path.join(apparmor.profile_dir, p)):
                     program = None
                     profile = apparmor.get_full_path(os.path.join(apparmor.profile_dir, p)).strip()
@@ -82,19 +131,44 @@ class aa_tools:
 
             yield (program, profile)
 
+    def get_targets(self):
+        '''Returns a list of (profile name, profile file, output name) for the
+           existing profiles given on the commandline'''
+        targets = []
+        seen = set()
+        for (program, profile) in self.get_next_to_profile():
+
+            output_name = profile if program is None else program
+
+            if not os.path.isfile(profile) or apparmor.is_skippable_file(profile):
+                aaui.UI_Info(_('Profile for %s not found, skipping') % output_name)
+                continue
+
+            if program is not None:
+                # the profile might be attached to program, but have a different name
+                program = apparmor.find_profile(program)[0] or program
+
+            if (program, profile) not in seen:
+                seen.add((program, profile))
+                targets.append((program, profile, output_name))
+
+        return targets
+
     def act(self):
         # used by aa-cleanprof
-        apparmor.read_profiles()
-
         for (program, profile) in self.get_next_to_profile():
             if program is None:
                 program = profile
+            else:
+                # only parse the profile (and its includes) that gets cleaned
+                program = apparmor.read_profile_for(program)[0] or program
 
             if not program or not(os.path.exists(program) or apparmor.profile_exists(program)):
                 if program and not program.startswith('/'):
                     program = aaui.UI_GetString(_('The given program cannot be found, please try with the fully qualified path name of the program: '), '')
                 else:
                     aaui.UI_Info(_("%s does not exist, please double-check the path.") % program)
+                    self.flush_reload()
                     sys.exit(1)
 
             if program and apparmor.profile_exists(program):
@@ -118,82 +192,46 @@ class aa_tools:
                     aaui.UI_Info(_("Can't find %(program)s in the system path list. If the name of the application\nis correct, please run 'which %(program)s' as a user with correct PATH\nenvironment set up in order to find the fully-qualified path and\nuse the full path as parameter.") % { 'program': program })
                 else:
                     aaui.UI_Info(_("%s does not exist, please double-check the path.") % program)
+                    self.flush_reload()
                     sys.exit(1)
 
-    def cmd_disable(self):
-        apparmor.read_profiles()
-
-        for (program, profile) in self.get_next_to_profile():
-
-            output_name = profile if program is None else program
-
-            if not os.path.isfile(profile) or apparmor.is_skippable_file(profile):
-                aaui.UI_Info(_('Profile for %s not found, skipping') % output_name)
-                continue
+        self.flush_reload()
 
+    def cmd_disable(self):
+        for (program, profile, output_name) in self.get_targets():
             aaui.UI_Info(_('Disabling %s.') % output_name)
             self.disable_profile(profile)
 
             self.unload_profile(profile)
 
-    def cmd_enforce(self):
-        apparmor.read_profiles()
+        self.flush_reload()
 
-        for (program, profile) in self.get_next_to_profile():
-
-            output_name = profile if program is None else program
-
-            if not os.path.isfile(profile) or apparmor.is_skippable_file(profile):
-                aaui.UI_Info(_('Profile for %s not found, skipping') % output_name)
-                continue
-
-            apparmor.set_enforce(profile, program)
-
-            self.reload_profile(profile)
+    def cmd_enforce(self):
+        changes = [apparmor.prepare_enforce(profile, program) for (program, profile, output_name) in self.get_targets()]
+        self.flush_reload(self.change_flags(changes))
 
     def cmd_complain(self):
-        apparmor.read_profiles()
-
-        for (program, profile) in self.get_next_to_profile():
-
-            output_name = profile if program is None else program
-
-            if not os.path.isfile(profile) or apparmor.is_skippable_file(profile):
-                aaui.UI_Info(_('Profile for %s not found, skipping') % output_name)
-                continue
-
-            apparmor.set_complain(profile, program)
-
-            self.reload_profile(profile)
+        changes = [apparmor.prepare_complain(profile, program) for (program, profile, output_name) in self.get_targets()]
+        self.flush_reload(self.change_flags(changes))
 
     def cmd_audit(self):
-        apparmor.read_profiles()
-
-        for (program, profile) in self.get_next_to_profile():
-
-            output_name = profile if program is None else program
-
-            if not os.path.isfile(profile) or apparmor.is_skippable_file(profile):
-                aaui.UI_Info(_('Profile for %s not found, skipping') % output_name)
-                continue
-
+        changes = []
+        for (program, profile, output_name) in self.get_targets():
             # keep this to allow toggling 'audit' flags
             if not self.remove:
                 aaui.UI_Info(_('Setting %s to audit mode.') % output_name)
             else:
                 aaui.UI_Info(_('Removing audit mode from %s.') % output_name)
-            apparmor.change_profile_flags(profile, program, 'audit', not self.remove)
+            changes.append((profile, program, 'audit', not self.remove))
 
             disable_link = '%s/disable/%s' % (apparmor.profile_dir, os.path.basename(profile))
 
             if os.path.exists(disable_link):
                 aaui.UI_Info(_('\nWarning: the profile %s is disabled. Use aa-enforce or aa-complain to enable it.') % os.path.basename(profile))
 
-            self.reload_profile(profile)
+        self.flush_reload(self.change_flags(changes))
 
     def cmd_autodep(self):
-        apparmor.read_profiles()
-
         for (program, profile) in self.get_next_to_profile():
             if not program:
                 aaui.UI_Info(_('Please pass an application to generate a profile for, not a profile itself - skipping %s.') % profile)
@@ -201,12 +239,14 @@ class aa_tools:
 
             apparmor.check_qualifiers(program)
 
-            if os.path.exists(apparmor.get_profile_filename(program)) and not self.force:
+            if os.path.exists(profile) and not self.force:
                 aaui.UI_Info(_('Profile for %s already exists - skipping.') % program)
             else:
                 apparmor.autodep(program)
                 if self.aa_mountpoint:
-                    apparmor.reload(program)
+                    apparmor.reload(program, self.reload_queue)
+
+        self.flush_reload()
 
     def clean_profile(self, program):
         filename = apparmor.get_profile_filename(program)
@@ -254,16 +294,36 @@ class aa_tools:
             return
 
         # FIXME: should ensure profile is loaded before unloading
-        cmd_info = cmd([apparmor.parser, '-I%s' % apparmor.profile_dir, '--base', apparmor.profile_dir, '-R', profile])
-
-        if cmd_info[0] != 0:
-            raise apparmor.AppArmorException(cmd_info[1])
+        self.reload_queue.unload(profile)
 
     def reload_profile(self, profile):
         if not self.do_reload:
             return
 
-        cmd_info = cmd([apparmor.parser, '-I%s' % apparmor.profile_dir, '--base', apparmor.profile_dir, '-r', profile])
+        self.reload_queue.add(profile)
 
-        if cmd_info[0] != 0:
-            raise apparmor.AppArmorException(cmd_info[1])
+    def change_flags(self, changes):
+        '''Apply a list of (profile, program, flag, set_flag) changes (in
+           parallel_jobs processes), and queue the changed profiles for reloading.
+           Returns the error messages for the profiles that couldn't be changed.'''
+        results = apparmor.change_profiles_flags(changes)
+
+        errors = []
+        for profile in sorted(results):
+            if results[profile] is None:
+                self.reload_profile(profile)
+            else:
+                errors.append(results[profile])
+        return errors
+
+    def flush_reload(self, errors=None):
+        '''(Re)load and unload the queued profiles with one apparmor_parser call per action.
+           Raises an AppArmorException with the given errors and the parser
+           output of the profiles that failed to load, if any.'''
+        errors = list(errors or [])
+        if self.reload_queue:
+            results = self.reload_queue.flush()
+            errors += [results[profile][1] for profile in sorted(results) if not results[profile][0]]
+
+        if errors:
+            raise apparmor.AppArmorException('\n'.join(errors))
@@ -0,0 +1,235 @@
+#! /usr/bin/env python
+# ----------------------------------------------------------------------
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License as published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+# ----------------------------------------------------------------------
+'''Time the expensive steps of aa-logprof on a synthetic profile tree and log
+
+Run from utils/test/ with   make benchmark   or
+    PYTHONPATH=.. python3 benchmark/benchmark.py --output result.json
+and compare two results with
+    PYTHONPATH=.. python3 benchmark/benchmark.py --compare old.json new.json'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import generate
+
+import apparmor.aa
+import apparmor.logparser
+import apparmor.severity
+from apparmor.common import hasher
+from apparmor.snapshot import SnapshotStore
+
+# the timed steps, in the order they run
+STEPS = ['read_profiles', 'loadincludes', 'read_log', 'handle_children', 'collapse_log',
+         'severity_rank', 'serialize_profile', 'delete_duplicates']
+
+def default_severity_db():
+    utils_db = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(apparmor.aa.__file__))), 'severity.db')
+    if os.path.exists(utils_db):
+        return utils_db
+    return apparmor.aa.CONFDIR + '/severity.db'
+
+def reset_state(profile_dir, jobs):
+    '''Reset the global state of apparmor.aa, so that each run starts from scratch'''
+    aa = apparmor.aa
+    aa.profile_dir = profile_dir
+    aa.parallel_jobs = jobs
+    aa.parse_cache = False
+    aa.aa = hasher()
+    aa.original_aa = SnapshotStore()
+    aa.extras = hasher()
+    aa.include = dict()
+    aa.include_closures = dict()
+    aa.filelist = hasher()
+    aa.existing_profiles = dict()
+    aa.prelog = hasher()
+    aa.log_dict = hasher()
+    aa.profile_changes = hasher()
+    aa.log = []
+    aa.pid = dict()
+
+class Timer(object):
+    def __init__(self):
+        self.timings = dict()
+
+    def run(self, step, func, *args):
+        start = time.time()
+        result = func(*args)
+        self.timings[step] = time.time() - start
+        return result
+
+def run_once(profile_dir, logfile, severity_db, jobs):
+    '''Run all steps once, and return a dict step -> seconds'''
+    aa = apparmor.aa
+    reset_state(profile_dir, jobs)
+    timer = Timer()
+
+    timer.run('read_profiles', aa.read_profiles)
+    timer.run('loadincludes', aa.loadincludes)
+
+    log_reader = apparmor.logparser.ReadLog(aa.pid, logfile, aa.existing_profiles, profile_dir, aa.log)
+    log = timer.run('read_log', log_reader.read_log, '', jobs)
+
+    def handle_children():
+        for root in log:
+            aa.handle_children('', '', root)
+        for pid in sorted(aa.profile_changes.keys()):
+            aa.set_process(pid, aa.profile_changes[pid])
+    timer.run('handle_children', handle_children)
+    timer.run('collapse_log', aa.collapse_log)
+
+    def severity_rank():
+        sev_db = apparmor.severity.Severity(severity_db, 'unknown')
+        sev_db.PROF_DIR = profile_dir
+        for aamode in aa.prelog:
+            for profile in aa.prelog[aamode]:
+                sev_db.load_variables(aa.get_profile_filename(profile))
+                for hat in aa.prelog[aamode][profile]:
+                    for path in aa.prelog[aamode][profile][hat]['path']:
+                        sev_db.rank(path, 'w')
+                    for cap in aa.prelog[aamode][profile][hat]['capability']:
+                        sev_db.rank('CAP_%s' % cap.upper())
+                sev_db.unload_variables()
+    timer.run('severity_rank', severity_rank)
+
+    def serialize_profile():
+        for profile in aa.aa:
+            aa.serialize_profile(aa.aa[profile], profile, {'METADATA': True})
+    timer.run('serialize_profile', serialize_profile)
+
+    def delete_duplicates():
+        deleted = 0
+        for profile in aa.aa:
+            for hat in aa.aa[profile]:
+                for incname in list(aa.aa[profile][hat]['include'].keys()):
+                    deleted += aa.delete_duplicates(aa.aa[profile][hat], incname)
+        return deleted
+    timer.run('delete_duplicates', delete_duplicates)
+
+    return timer.timings
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def summarize(runs):
+    results = dict()
+    for step in STEPS:
+        values = [run[step] for run in runs]
+        results[step] = {
+            'runs':     values,
+            'min':      min(values),
+            'median':   median(values),
+            'max':      max(values),
+        }
+    return results
+
+def compare(old_file, new_file, max_ratio):
+    '''Print the ratio of the median timings, and return False if a step got slower than max_ratio'''
+    with open(old_file) as f_in:
+        old = json.load(f_in)
+    with open(new_file) as f_in:
+        new = json.load(f_in)
+
+    if old['parameters'] != new['parameters']:
+        sys.stderr.write('Warning: the benchmark parameters differ\n')
+
+    ok = True
+    for step in STEPS:
+        if step not in old['results'] or step not in new['results']:
+            continue
+        old_time = old['results'][step]['median']
+        new_time = new['results'][step]['median']
+        ratio = new_time / old_time if old_time else 1.0
+        marker = ''
+        if ratio > max_ratio:
+            marker = '  SLOWER'
+            ok = False
+        sys.stdout.write('%-20s %10.4f %10.4f %7.2fx%s\n' % (step, old_time, new_time, ratio, marker))
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the utils on synthetic profiles and logs')
+    parser.add_argument('--profiles', type=int, default=200, help='number of profiles')
+    parser.add_argument('--abstractions', type=int, default=40, help='number of abstractions')
+    parser.add_argument('--depth', type=int, default=3, help='include depth of the abstractions')
+    parser.add_argument('--rules', type=int, default=20, help='path rules per profile and abstraction')
+    parser.add_argument('--hats', type=int, default=1, help='hats per profile')
+    parser.add_argument('--events', type=int, default=20000, help='number of log events')
+    parser.add_argument('--mix', default=None, help='event mix, for example file=70,exec=5,capability=10,network=10,change_hat=5')
+    parser.add_argument('--syslog', action='store_true', help='use syslog instead of audit.log format')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='parallel jobs for profile and log parsing')
+    parser.add_argument('--severity-db', default=None, help='severity.db to use')
+    parser.add_argument('--output', default=None, help='write the JSON result to this file instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON results instead of running the benchmark')
+    parser.add_argument('--max-ratio', type=float, default=1.25, help='with --compare, fail if a step is slower than this')
+    args = parser.parse_args()
+
+    if args.compare:
+        if not compare(args.compare[0], args.compare[1], args.max_ratio):
+            sys.exit(1)
+        return
+
+    mix = generate.parse_mix(args.mix) if args.mix else generate.DEFAULT_MIX
+    parameters = {
+        'profiles':     args.profiles,
+        'abstractions': args.abstractions,
+        'depth':        args.depth,
+        'rules':        args.rules,
+        'hats':         args.hats,
+        'events':       args.events,
+        'mix':          mix,
+        'syslog':       args.syslog,
+        'seed':         args.seed,
+        'jobs':         args.jobs,
+    }
+
+    tmpdir = tempfile.mkdtemp(prefix='aa-benchmark-')
+    try:
+        profile_dir = os.path.join(tmpdir, 'apparmor.d')
+        logfile = os.path.join(tmpdir, 'audit.log')
+        generate.generate_profiles(profile_dir, args.profiles, args.abstractions, args.depth, args.rules, args.hats, args.seed)
+        generate.generate_log(logfile, args.events, args.profiles, args.abstractions, args.hats, mix, args.syslog, seed=args.seed)
+
+        severity_db = args.severity_db or default_severity_db()
+        runs = []
+        for i in range(args.repeat):
+            runs.append(run_once(profile_dir, logfile, severity_db, args.jobs))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    result = {
+        'parameters':   parameters,
+        'python':       platform.python_version(),
+        'timestamp':    int(time.time()),
+        'results':      summarize(runs),
+    }
+    output = json.dumps(result, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f_out:
+            f_out.write(output)
+    else:
+        sys.stdout.write(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+#! /usr/bin/env python
+# ----------------------------------------------------------------------
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License as published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+# ----------------------------------------------------------------------
+'''Generate synthetic profile directories and audit logs for benchmark.py
+
+The output only depends on the parameters and the seed, so that timings
+of different versions of the utils are comparable.'''
+
+import argparse
+import os
+import random
+
+# default mix of log events (relative weights)
+DEFAULT_MIX = {
+    'file':         70,
+    'exec':         5,
+    'capability':   10,
+    'network':      10,
+    'change_hat':   5,
+}
+
+CAPABILITIES = ['chown', 'dac_override', 'dac_read_search', 'fowner', 'fsetid', 'kill',
+                'setgid', 'setuid', 'net_bind_service', 'net_raw', 'sys_chroot', 'sys_ptrace']
+
+NETWORK = [('inet', 'stream', 6), ('inet', 'dgram', 17), ('inet6', 'stream', 6), ('unix', 'stream', 0), ('netlink', 'raw', 0)]
+
+FILE_MODES = ['r', 'r', 'r', 'w', 'rw', 'c', 'd']
+
+TUNABLES_GLOBAL = '''# generated for benchmarks
+@{HOME}=@{HOMEDIRS}/*/ /root/
+@{HOMEDIRS}=/home/
+@{PROC}=/proc/
+@{multiarch}=*-linux-gnu*
+'''
+
+def parse_mix(mix):
+    '''Parse a mix like "file=70,exec=5" into a dict'''
+    result = dict()
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise ValueError('Unknown event type %s' % name)
+        result[name] = int(weight)
+    return result
+
+def program_name(num):
+    return '/usr/bin/prog_%d' % num
+
+def write(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f_out:
+        f_out.write(content)
+
+def abstraction_includes(num, abstractions, depth):
+    '''The abstractions are chained in groups of depth abstractions, each including the next one'''
+    if depth > 1 and num % depth != depth - 1 and num + 1 < abstractions:
+        return ['abstractions/abs_%d' % (num + 1)]
+    return []
+
+def generate_abstraction(num, abstractions, depth, rules):
+    lines = ['# abstraction %d' % num]
+    for incname in abstraction_includes(num, abstractions, depth):
+        lines.append('#include <%s>' % incname)
+    lines.append('')
+    lines.append('capability %s,' % CAPABILITIES[num % len(CAPABILITIES)])
+    lines.append('network %s %s,' % NETWORK[num % len(NETWORK)][:2])
+    for i in range(rules):
+        if i % 3 == 0:
+            lines.append('/usr/share/abs_%d/** r,' % num)
+        elif i % 3 == 1:
+            lines.append('/usr/lib/@{multiarch}/libabs_%d_%d.so* mr,' % (num, i))
+        else:
+            lines.append('owner @{HOME}/.config/abs_%d/file_%d rw,' % (num, i))
+    lines.append('')
+    return '\n'.join(lines)
+
+def generate_profile(num, abstractions, rules, hats, rnd):
+    name = program_name(num)
+    lines = ['# profile %d' % num, '#include <tunables/global>', '']
+    lines.append('%s flags=(complain) {' % name)
+    if abstractions:
+        for incnum in sorted(set(rnd.randrange(abstractions) for i in range(3))):
+            lines.append('  #include <abstractions/abs_%d>' % incnum)
+    lines.append('')
+    lines.append('  capability %s,' % CAPABILITIES[num % len(CAPABILITIES)])
+    lines.append('  network %s %s,' % NETWORK[num % len(NETWORK)][:2])
+    lines.append('')
+    lines.append('  %s mr,' % name)
+    lines.append('  /usr/bin/exec_* ix,')
+    for i in range(rules):
+        if i % 4 == 0:
+            lines.append('  /etc/prog_%d/file_%d r,' % (num, i))
+        elif i % 4 == 1:
+            lines.append('  /var/lib/prog_%d/dir_%d/{,**} rw,' % (num, i))
+        elif i % 4 == 2:
+            lines.append('  owner @{HOME}/.prog_%d/dir_%d/** rw,' % (num, i))
+        else:
+            lines.append('  deny /etc/shadow_%d w,' % i)
+    for hat in range(hats):
+        lines.append('')
+        lines.append('  ^hat_%d {' % hat)
+        lines.append('    /srv/prog_%d/hat_%d/** r,' % (num, hat))
+        lines.append('  }')
+    lines.append('}')
+    lines.append('')
+    return '\n'.join(lines)
+
+def generate_profiles(profile_dir, profiles=100, abstractions=20, depth=3, rules=20, hats=1, seed=0):
+    '''Write profiles, abstractions (included up to depth levels deep) and tunables to profile_dir'''
+    rnd = random.Random(seed)
+    write(os.path.join(profile_dir, 'tunables', 'global'), TUNABLES_GLOBAL)
+    for num in range(abstractions):
+        write(os.path.join(profile_dir, 'abstractions', 'abs_%d' % num), generate_abstraction(num, abstractions, depth, rules))
+    for num in range(profiles):
+        write(os.path.join(profile_dir, program_name(num)[1:].replace('/', '.')), generate_profile(num, abstractions, rules, hats, rnd))
+
+def file_event(rnd, num, abstractions):
+    choice = rnd.random()
+    if choice < 0.4:
+        name = '/etc/prog_%d/file_%d' % (num, rnd.randrange(40))  # partly covered by the profile
+    elif choice < 0.6 and abstractions:
+        name = '/usr/share/abs_%d/data_%d' % (rnd.randrange(abstractions), rnd.randrange(20))
+    elif choice < 0.8:
+        name = '/srv/data_%d/file_%d.txt' % (rnd.randrange(50), rnd.randrange(50))  # not covered
+    else:
+        name = '/home/user/.prog_%d/dir_%d/cache' % (num, rnd.randrange(40))
+    mode = rnd.choice(FILE_MODES)
+    operation = 'mknod' if mode == 'c' else 'unlink' if mode == 'd' else 'open'
+    return 'operation="%s" profile="%s" name="%s" comm="prog_%d" requested_mask="%s" denied_mask="%s" fsuid=1000 ouid=1000' % (
+        operation, program_name(num), name, num, mode, mode)
+
+def exec_event(rnd, num, abstractions):
+    target = '/usr/bin/exec_%d' % rnd.randrange(20)
+    return 'operation="exec" profile="%s" name="%s" comm="prog_%d" requested_mask="x" denied_mask="x" fsuid=1000 ouid=0 target="%s"' % (
+        program_name(num), target, num, target)
+
+def capability_event(rnd, num, abstractions):
+    cap = rnd.choice(CAPABILITIES)
+    return 'operation="capable" profile="%s" name="%s" comm="prog_%d" capability=%d capname="%s"' % (
+        program_name(num), cap, num, CAPABILITIES.index(cap), cap)
+
+def network_event(rnd, num, abstractions):
+    family, sock_type, protocol = rnd.choice(NETWORK)
+    return 'operation="create" profile="%s" comm="prog_%d" family="%s" sock_type="%s" protocol=%d' % (
+        program_name(num), num, family, sock_type, protocol)
+
+def change_hat_event(rnd, num, abstractions):
+    # only hats that exist in the profile, to avoid questions in handle_children()
+    return 'operation="change_hat" profile="%s" name="%s//hat_0" comm="prog_%d"' % (program_name(num), program_name(num), num)
+
+EVENT_GENERATORS = {
+    'file':         file_event,
+    'exec':         exec_event,
+    'capability':   capability_event,
+    'network':      network_event,
+    'change_hat':   change_hat_event,
+}
+
+def generate_log(filename, events=10000, profiles=100, abstractions=20, hats=1, mix=None, syslog=False, noise=0.2, seed=0):
+    '''Write a logfile with AppArmor events (plus unrelated lines) for the generated profiles
+
+       mix is a dict of event type -> weight (see DEFAULT_MIX), noise
+       controls the share of unrelated lines.'''
+    rnd = random.Random(seed)
+    if not mix:
+        mix = DEFAULT_MIX
+    if not hats:
+        mix = dict((typ, weight) for typ, weight in mix.items() if typ != 'change_hat')
+    types = sorted(mix)
+    weights = [mix[typ] for typ in types]
+    total = sum(weights)
+
+    timestamp = 1400000000
+    serial = 1
+    with open(filename, 'w') as f_out:
+        for i in range(events):
+            while rnd.random() < noise:
+                f_out.write('Jan  1 00:00:00 host sshd[%d]: something unrelated\n' % rnd.randrange(1000, 5000))
+
+            pick = rnd.uniform(0, total)
+            for typ, weight in zip(types, weights):
+                pick -= weight
+                if pick <= 0:
+                    break
+
+            num = rnd.randrange(profiles)
+            details = EVENT_GENERATORS[typ](rnd, num, abstractions)
+            if typ == 'change_hat' or rnd.random() < 0.8:
+                aamode = 'ALLOWED'
+            else:
+                aamode = 'DENIED'
+
+            serial += 1
+            if i % 50 == 0:
+                timestamp += 1
+            stamp = 'audit(%d.%03d:%d)' % (timestamp, serial % 1000, serial)
+            event = 'apparmor="%s" %s pid=%d parent=1' % (aamode, details, 10000 + num)
+            if syslog:
+                f_out.write('Jan  1 00:00:00 host kernel: [%d.000000] type=1400 %s: %s\n' % (timestamp, stamp, event))
+            else:
+                f_out.write('type=AVC msg=%s: %s\n' % (stamp, event))
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic profiles and audit logs for benchmarks')
+    parser.add_argument('directory', help='output directory (profiles in apparmor.d/, log in audit.log)')
+    parser.add_argument('--profiles', type=int, default=100, help='number of profiles')
+    parser.add_argument('--abstractions', type=int, default=20, help='number of abstractions')
+    parser.add_argument('--depth', type=int, default=3, help='include depth of the abstractions')
+    parser.add_argument('--rules', type=int, default=20, help='path rules per profile and abstraction')
+    parser.add_argument('--hats', type=int, default=1, help='hats per profile')
+    parser.add_argument('--events', type=int, default=10000, help='number of log events')
+    parser.add_argument('--mix', default=None, help='event mix, for example file=70,exec=5,capability=10,network=10,change_hat=5')
+    parser.add_argument('--syslog', action='store_true', help='write syslog instead of audit.log format')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix) if args.mix else None
+    generate_profiles(os.path.join(args.directory, 'apparmor.d'), args.profiles, args.abstractions, args.depth, args.rules, args.hats, args.seed)
+    generate_log(os.path.join(args.directory, 'audit.log'), args.events, args.profiles, args.abstractions, args.hats, mix, args.syslog, seed=args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,7 @@
 #    GNU General Public License for more details.
 #
 # ----------------------------------------------------------------------
+import glob
 import os
 import shutil
 import subprocess
@@ -19,7 +20,7 @@ import unittest
 from common_test import AATest, setup_all_loops
 
 import apparmor.aa as apparmor
-from common_test import read_file
+from common_test import read_file, write_file
 
 python_interpreter = 'python'
 if sys.version_info >= (3, 0):
@@ -124,6 +125,23 @@ class MinitoolsTest(AATest):
         self.assertEqual(os.path.islink('%s/disable/%s' % (self.profile_dir, os.path.basename(self.local_profilename))), True,
                 'Failed to create a symlink for %s in disable' % self.local_profilename)
 
+    def test_bulk(self):
+        # Switch profiles given as wildcard and in a list file to complain mode, using two processes
+        list_file = write_file(self.tmpdir, 'profiles.list', '# profiles to switch\n%s\n\n' % self.local_profilename)
+        subprocess.check_output("%s ./../aa-complain --no-reload -j 2 -d %s --from-file %s 'usr.sbin.*'" % (python_interpreter, self.profile_dir, list_file), shell=True)
+
+        profiles = glob.glob('%s/usr.sbin.*' % self.profile_dir)
+        self.assertTrue(len(profiles) > 1)
+        for profile in profiles:
+            self.assertTrue('complain' in apparmor.get_profile_flags(profile, None).split(','),
+                    'Complain flag could not be set in profile %s' % profile)
+
+        subprocess.check_output("%s ./../aa-enforce --no-reload -j 2 -d %s '%s/usr.sbin.*'" % (python_interpreter, self.profile_dir, self.profile_dir), shell=True)
+
+        for profile in profiles:
+            self.assertFalse('complain' in (apparmor.get_profile_flags(profile, None) or '').split(','),
+                    'Complain flag could not be removed in profile %s' % profile)
+
     def test_autodep(self):
         pass
 
@@ -13,9 +13,18 @@ import unittest
 from common_test import AATest, setup_all_loops
 from common_test import read_file, write_file
 
+import os
+
+import apparmor.aa
 from apparmor.aa import (check_for_apparmor, get_profile_flags, set_profile_flags, is_skippable_file, is_skippable_dir,
-     parse_profile_start, parse_profile_data, separate_vars, store_list_var, write_header, serialize_parse_profile_start)
+     parse_profile_start, parse_profile_data, separate_vars, store_list_var, write_header, serialize_parse_profile_start,
+     include_closure, match_include_to_path, classify_profile_line, PROFILE_LINE_TYPES,
+     prefetch_profile_data, read_profile, suggest_includes_for_path, match_includes, profile_storage, loadincludes,
+     ReloadQueue, change_profiles_flags, prepare_complain, prepare_enforce, serialize_profile_from_old_profile, ALL,
+     get_profile_index, save_profile_index)
 from apparmor.common import AppArmorException, AppArmorBug
+from apparmor.aamode import str_to_mode
+from apparmor.rule.capability import CapabilityRule
 
 class AaTestWithTempdir(AATest):
     def AASetup(self):
@@ -273,6 +282,57 @@ class AaTest_set_profile_flags(AaTestWithTempdir):
         with self.assertRaises(IOError):
             set_profile_flags('%s/file-not-found' % self.tmpdir, '/foo', 'audit')
 
+class AaTest_change_profiles_flags(AaTestWithTempdir):
+    def _test_change_flags(self, jobs):
+        files = []
+        for i in range(4):
+            files.append(write_file(self.tmpdir, 'profile%d' % i, '/foo%d flags=(audit) {\n  /bar r,\n}\n' % i))
+        broken = write_file(self.tmpdir, 'broken', '# no profile here\n')
+
+        changes = [(filename, None, 'complain', True) for filename in files]
+        changes.append((files[0], None, 'audit', False))  # same file, applied in order
+        changes.append((broken, None, 'complain', True))
+
+        results = change_profiles_flags(changes, jobs)
+
+        self.assertEqual(sorted(results.keys()), sorted(files + [broken]))
+        self.assertEqual(read_file(files[0]), '/foo0 flags=(complain) {\n  /bar r,\n}\n')
+        for i in range(1, 4):
+            self.assertEqual(results[files[i]], None)
+            self.assertEqual(read_file(files[i]), '/foo%d flags=(audit,complain) {\n  /bar r,\n}\n' % i)
+        self.assertTrue('contain' in results[broken])
+        self.assertEqual(read_file(broken), '# no profile here\n')
+
+    def test_change_flags_serial(self):
+        self._test_change_flags(1)
+
+    def test_change_flags_parallel(self):
+        self._test_change_flags(2)
+
+    def test_change_flags_empty(self):
+        self.assertEqual(change_profiles_flags([], 2), {})
+
+    def test_prepare_enforce_complain(self):
+        orig_profile_dir = apparmor.aa.profile_dir
+        apparmor.aa.profile_dir = self.tmpdir
+        try:
+            filename = write_file(self.tmpdir, 'usr.bin.foo', '/usr/bin/foo flags=(complain) {\n}\n')
+            for subdir in ['disable', 'force-complain']:
+                os.mkdir(os.path.join(self.tmpdir, subdir))
+                os.symlink(filename, os.path.join(self.tmpdir, subdir, 'usr.bin.foo'))
+
+            self.assertEqual(prepare_complain(filename, '/usr/bin/foo'), (filename, '/usr/bin/foo', 'complain', True))
+            self.assertFalse(os.path.islink(os.path.join(self.tmpdir, 'disable', 'usr.bin.foo')))
+            self.assertTrue(os.path.islink(os.path.join(self.tmpdir, 'force-complain', 'usr.bin.foo')))
+
+            self.assertEqual(prepare_enforce(filename, '/usr/bin/foo'), (filename, '/usr/bin/foo', 'complain', False))
+            self.assertFalse(os.path.islink(os.path.join(self.tmpdir, 'force-complain', 'usr.bin.foo')))
+
+            # the flags are only changed by change_profile(s)_flags()
+            self.assertEqual(read_file(filename), '/usr/bin/foo flags=(complain) {\n}\n')
+        finally:
+            apparmor.aa.profile_dir = orig_profile_dir
+
 
 class AaTest_is_skippable_file(AATest):
     def test_not_skippable_01(self):
@@ -405,6 +465,324 @@ class AaTest_parse_profile_data(AATest):
             # file contains two profiles with the same name
             parse_profile_data('profile /foo {\n}\nprofile /foo {\n}\n'.split(), 'somefile', False)
 
+class AaTest_classify_profile_line(AATest):
+    tests = [
+        ('/foo {',                              'profile_start'),
+        ('profile foo /foo (complain) {',       'profile_start'),
+        ('}',                                   'profile_end'),
+        ('audit deny capability sys_admin,',    'capability'),
+        ('link /foo -> /bar,',                  'link'),
+        ('change_profile -> /bar,',             'change_profile'),
+        ('alias /foo -> /bar,',                 'alias'),
+        ('set rlimit nproc <= 10,',             'rlimit'),
+        ('$foo = true',                         'boolean'),
+        ('@{foo} += /bar',                      'variable'),
+        ('if $foo {',                           'conditional'),
+        ('if defined @{foo} {',                 'conditional_variable'),
+        ('owner file,',                         'bare_file'),
+        ('audit owner /foo rw,',                'path'),
+        ('file /foo r,',                        'path'),
+        ('@{HOME}/foo r,',                      'path'),
+        ('"/foo bar" r,',                       'path'),
+        ('#include <abstractions/base>',        'include'),
+        ('include <abstractions/base>',         'include'),
+        ('deny network inet,',                  'network'),
+        ('dbus send,',                          'dbus'),
+        ('umount,',                             'mount'),
+        ('signal (send),',                      'signal'),
+        ('ptrace,',                             'ptrace'),
+        ('pivot_root,',                         'pivot_root'),
+        ('unix,',                               'unix'),
+        ('^foo,',                               'change_hat'),
+        ('^foo {',                              'hat_def'),
+        ('hat foo {',                           'hat_def'),
+        ('# a comment',                         None),
+        ('capability',                          None),  # missing comma
+        ('foo,',                                None),
+        ('/foo',                                None),
+    ]
+
+    def _run_test(self, params, expected):
+        line_type, matches = classify_profile_line(params)
+        self.assertEqual(line_type, expected)
+
+        # same result as checking the line against all line types
+        expected_matches = None
+        for line_type, matcher in PROFILE_LINE_TYPES:
+            expected_matches = matcher(params)
+            if expected_matches:
+                self.assertEqual(line_type, expected)
+                break
+
+        if expected is None:
+            self.assertFalse(expected_matches)
+            self.assertEqual(matches, None)
+        else:
+            self.assertTrue(matches)
+
+class AaTest_include_closure(AaTestWithTempdir):
+    def AASetup(self):
+        self.createTmpdir()
+        self.orig_profile_dir = apparmor.aa.profile_dir
+        apparmor.aa.profile_dir = self.tmpdir
+
+        os.mkdir(os.path.join(self.tmpdir, 'abstractions'))
+        os.mkdir(os.path.join(self.tmpdir, 'abstractions/foo.d'))
+        write_file(self.tmpdir, 'abstractions/foo', '#include <abstractions/bar>\n#include <abstractions/foo.d>\n/foo r,\n')
+        write_file(self.tmpdir, 'abstractions/bar', '#include <abstractions/qux>\n/bar/** r,\n')
+        write_file(self.tmpdir, 'abstractions/qux', '/qux w,\n')
+        write_file(self.tmpdir, 'abstractions/foo.d/baz', '#include <abstractions/qux>\n/baz/* r,\n')
+
+    def AATeardown(self):
+        apparmor.aa.profile_dir = self.orig_profile_dir
+        for incname in list(apparmor.aa.include.keys()):
+            if incname.startswith('abstractions/'):
+                apparmor.aa.include.pop(incname)
+        apparmor.aa.include_closures.clear()
+        apparmor.aa.include_index.clear()
+
+    def test_include_closure_01(self):
+        expected = ('abstractions/foo', 'abstractions/bar', 'abstractions/qux', 'abstractions/foo.d/baz')
+        self.assertEqual(include_closure('abstractions/foo'), expected)
+        # cached
+        self.assertTrue(include_closure('abstractions/foo') is include_closure('abstractions/foo'))
+
+    def test_include_closure_02(self):
+        self.assertEqual(include_closure('abstractions/foo.d'), ('abstractions/foo.d/baz', 'abstractions/qux'))
+
+        # a new file in an included directory invalidates the cached closure
+        write_file(self.tmpdir, 'abstractions/foo.d/new', '/new r,\n')
+        os.utime(os.path.join(self.tmpdir, 'abstractions/foo.d'), (0, 0))
+        self.assertEqual(sorted(include_closure('abstractions/foo.d')), ['abstractions/foo.d/baz', 'abstractions/foo.d/new', 'abstractions/qux'])
+
+    def test_include_closure_03(self):
+        self.assertEqual(include_closure('abstractions/bar'), ('abstractions/bar', 'abstractions/qux'))
+
+        # a changed file invalidates the cached closure and is parsed again
+        write_file(self.tmpdir, 'abstractions/bar', '#include <abstractions/foo.d>\n/bar/** r,\n')
+        os.utime(os.path.join(self.tmpdir, 'abstractions/bar'), (0, 0))
+        self.assertEqual(include_closure('abstractions/bar'), ('abstractions/bar', 'abstractions/foo.d/baz', 'abstractions/qux'))
+        self.assertEqual(list(apparmor.aa.include['abstractions/bar']['abstractions/bar']['include'].keys()), ['abstractions/foo.d'])
+
+    def test_match_include_to_path(self):
+        mode, audit, matches = match_include_to_path('abstractions/foo', 'allow', '/baz/x')
+        self.assertEqual(matches, ['/baz/*'])
+        mode, audit, matches = match_include_to_path('abstractions/foo', 'allow', '/qux')
+        self.assertEqual(matches, ['/qux'])
+        mode, audit, matches = match_include_to_path('abstractions/bar', 'allow', '/baz/x')
+        self.assertEqual(matches, [])
+
+    def test_suggest_includes_for_path(self):
+        write_file(self.tmpdir, 'abstractions/nowrite', '#include <abstractions/qux>\ndeny /qux w,\ncapability chown,\n')
+        write_file(self.tmpdir, 'abstractions/everything', '/** rw,\n')
+        loadincludes()
+
+        expected = ['abstractions/bar', 'abstractions/foo', 'abstractions/foo.d/baz', 'abstractions/qux']
+        self.assertEqual(suggest_includes_for_path(None, '/qux', str_to_mode('w')), expected)
+        self.assertEqual(suggest_includes_for_path(None, '/qux', str_to_mode('r')), [])
+        self.assertEqual(suggest_includes_for_path(None, '/bar/x/y', str_to_mode('r')), ['abstractions/bar', 'abstractions/foo'])
+        self.assertEqual(suggest_includes_for_path(None, '/etc/foo', str_to_mode('r')), [])
+
+        # includes already used by the profile aren't suggested
+        profile = profile_storage()
+        profile['include']['abstractions/bar'] = True
+        self.assertEqual(suggest_includes_for_path(profile, '/bar/x/y', str_to_mode('r')), ['abstractions/foo'])
+
+        # the index gets rebuilt after loading another include
+        write_file(self.tmpdir, 'abstractions/new', '/etc/foo r,\n')
+        apparmor.aa.load_include('abstractions/new')
+        self.assertEqual(suggest_includes_for_path(None, '/etc/foo', str_to_mode('r')), ['abstractions/new'])
+
+    def test_match_includes(self):
+        write_file(self.tmpdir, 'abstractions/caps', 'capability chown,\n')
+        loadincludes()
+
+        self.assertEqual(match_includes(None, 'capability', CapabilityRule('chown')), ['abstractions/caps'])
+        self.assertEqual(match_includes(None, 'capability', CapabilityRule('kill')), [])
+
+        profile = profile_storage()
+        profile['include']['abstractions/caps'] = True
+        self.assertEqual(match_includes(profile, 'capability', CapabilityRule('chown')), [])
+
+class AaTest_prefetch_profile_data(AaTestWithTempdir):
+    def AASetup(self):
+        self.createTmpdir()
+        self.orig_profile_dir = apparmor.aa.profile_dir
+        apparmor.aa.profile_dir = self.tmpdir
+
+        os.mkdir(os.path.join(self.tmpdir, 'abstractions'))
+        write_file(self.tmpdir, 'abstractions/prefetch', '#include <abstractions/prefetch2>\n/foo r,\n')
+        write_file(self.tmpdir, 'abstractions/prefetch2', '/bar r,\n')
+        self.profile = write_file(self.tmpdir, 'usr.bin.prefetch', '#include <tunables/global>\n/usr/bin/prefetch {\n  #include <abstractions/prefetch>\n  /baz w,\n}\n')
+        self.broken = write_file(self.tmpdir, 'usr.bin.broken', '/usr/bin/broken {\n  /baz w,\n  foo,\n}\n')
+
+    def AATeardown(self):
+        apparmor.aa.profile_dir = self.orig_profile_dir
+        apparmor.aa.prefetched_records.clear()
+        for incname in ['abstractions/prefetch', 'abstractions/prefetch2']:
+            apparmor.aa.include.pop(incname, None)
+            apparmor.aa.filelist.pop(incname, None)
+        for profile in ['/usr/bin/prefetch', '/usr/bin/broken']:
+            apparmor.aa.aa.pop(profile, None)
+            apparmor.aa.original_aa.pop(profile, None)
+            apparmor.aa.existing_profiles.pop(profile, None)
+        for filename in [self.profile, self.broken]:
+            apparmor.aa.filelist.pop(filename, None)
+        apparmor.aa.include_closures.clear()
+
+    def test_prefetch(self):
+        prefetch_profile_data([(self.profile, self.profile, False)], 2)
+
+        # includes are parsed in the workers too, but not merged into the global data yet
+        self.assertEqual(sorted(apparmor.aa.prefetched_records.keys()), [
+            (os.path.join(self.tmpdir, 'abstractions/prefetch'), 'abstractions/prefetch', True),
+            (os.path.join(self.tmpdir, 'abstractions/prefetch2'), 'abstractions/prefetch2', True),
+            (self.profile, self.profile, False),
+        ])
+        self.assertFalse(apparmor.aa.include.get('abstractions/prefetch'))
+        self.assertFalse(apparmor.aa.existing_profiles.get('/usr/bin/prefetch'))
+
+        # tunables/global doesn't exist - left to the usual include handling
+        with self.assertRaises(AppArmorException):
+            read_profile(self.profile, True)
+
+    def test_prefetch_merge(self):
+        os.mkdir(os.path.join(self.tmpdir, 'tunables'))
+        write_file(self.tmpdir, 'tunables/global', '@{HOME}=/home/\n')
+
+        prefetch_profile_data([(self.profile, self.profile, False)], 2)
+        read_profile(self.profile, True)
+
+        self.assertEqual(apparmor.aa.prefetched_records, {})
+        self.assertEqual(apparmor.aa.existing_profiles['/usr/bin/prefetch'], self.profile)
+        self.assertEqual(list(apparmor.aa.aa['/usr/bin/prefetch']['/usr/bin/prefetch']['allow']['path'].keys()), ['/baz'])
+        self.assertEqual(list(apparmor.aa.include['abstractions/prefetch2']['abstractions/prefetch2']['allow']['path'].keys()), ['/bar'])
+        apparmor.aa.include.pop('tunables/global', None)
+        apparmor.aa.filelist.pop('tunables/global', None)
+
+    def test_prefetch_error(self):
+        prefetch_profile_data([(self.broken, self.broken, False)], 2)
+
+        # the parser error is raised when the profile is read
+        with self.assertRaises(AppArmorException) as cm:
+            read_profile(self.broken, True)
+        self.assertTrue('line: 3' in str(cm.exception))
+        self.assertFalse(apparmor.aa.aa.get('/usr/bin/broken'))
+
+class AaTest_get_profile_index(AaTestWithTempdir):
+    def AASetup(self):
+        self.createTmpdir()
+        self.orig_profile_dir = apparmor.aa.profile_dir
+        self.orig_profile_index = apparmor.aa.profile_index
+        self.orig_cachedir = apparmor.aa.cfg['settings'].get('cachedir')
+        self.cachedir = os.path.join(self.tmpdir, 'cache')
+        apparmor.aa.cfg['settings']['cachedir'] = self.cachedir
+        apparmor.aa.profile_index = None
+
+        self.dirs = []
+        for name in ['first', 'second']:
+            directory = os.path.join(self.tmpdir, name)
+            os.mkdir(directory)
+            write_file(directory, 'usr.bin.%s' % name, '/usr/bin/%s {\n}\n' % name)
+            self.dirs.append(directory)
+
+    def AATeardown(self):
+        apparmor.aa.profile_dir = self.orig_profile_dir
+        apparmor.aa.profile_index = self.orig_profile_index
+        if self.orig_cachedir is None:
+            del apparmor.aa.cfg['settings']['cachedir']
+        else:
+            apparmor.aa.cfg['settings']['cachedir'] = self.orig_cachedir
+
+    def test_switch_profile_dir(self):
+        for directory in self.dirs + self.dirs:
+            apparmor.aa.profile_dir = directory
+            index = get_profile_index()
+            self.assertEqual(index.profile_dir, directory)
+        # the second round used the cache files written when switching to the other directory
+        self.assertFalse(index.dirty)
+        self.assertEqual(index.find('/usr/bin/second'), ('/usr/bin/second', os.path.join(self.dirs[1], 'usr.bin.second')))
+
+        save_profile_index()
+        self.assertEqual(len(os.listdir(self.cachedir)), 2)
+
+class AaTest_serialize_profile_from_old_profile(AaTestWithTempdir):
+    PROFILE = '/usr/bin/two {\n  /etc/foo r,\n  deny file,\n\n  profile child {\n    /etc/bar r,\n  }\n}\n'
+
+    def AASetup(self):
+        self.createTmpdir()
+        self.orig_profile_dir = apparmor.aa.profile_dir
+        apparmor.aa.profile_dir = self.tmpdir
+        self.profile = write_file(self.tmpdir, 'usr.bin.two', self.PROFILE)
+
+    def AATeardown(self):
+        apparmor.aa.profile_dir = self.orig_profile_dir
+        for profile in ['/usr/bin/two']:
+            apparmor.aa.aa.pop(profile, None)
+            apparmor.aa.original_aa.pop(profile, None)
+            apparmor.aa.existing_profiles.pop(profile, None)
+        apparmor.aa.filelist.pop(self.profile, None)
+
+    def test_child_profile(self):
+        read_profile(self.profile, True)
+        prof = apparmor.aa.aa['/usr/bin/two']
+        self.assertEqual(sorted(prof.keys()), ['/usr/bin/two', 'child'])
+        self.assertTrue(ALL in prof['/usr/bin/two']['deny']['path'])
+
+        serialized = serialize_profile_from_old_profile(prof, '/usr/bin/two', {})
+        self.assertTrue(serialized.startswith(self.PROFILE))
+
+class AaTest_ReloadQueue(AaTestWithTempdir):
+    def AASetup(self):
+        self.createTmpdir()
+        self.calls = os.path.join(self.tmpdir, 'calls')
+        # fake parser that logs its arguments and fails for files named "broken*"
+        self.parser = write_file(self.tmpdir, 'apparmor_parser', '#!/bin/sh\necho "$@" >> %s\nfor arg in "$@"; do case "$arg" in */broken*) echo "error in $arg"; exit 1;; esac; done\n' % self.calls)
+        os.chmod(self.parser, 0o755)
+        self.queue = ReloadQueue(self.parser, ['/etc/apparmor.d'], '/etc/apparmor.d')
+
+    def get_calls(self):
+        if not os.path.exists(self.calls):
+            return []
+        return read_file(self.calls).splitlines()
+
+    def test_batch(self):
+        self.queue.add('/profiles/foo')
+        self.queue.add('/profiles/bar')
+        self.queue.add('/profiles/foo')
+        self.queue.unload('/profiles/baz')
+        self.assertEqual(len(self.queue), 3)
+
+        results = self.queue.flush()
+        self.assertEqual(sorted(results.keys()), ['/profiles/bar', '/profiles/baz', '/profiles/foo'])
+        self.assertTrue(all(success for success, output in results.values()))
+        self.assertEqual(self.get_calls(), [
+            '-I/etc/apparmor.d --base /etc/apparmor.d -r /profiles/foo /profiles/bar',
+            '-I/etc/apparmor.d --base /etc/apparmor.d -R /profiles/baz',
+        ])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_last_action_wins(self):
+        self.queue.add('/profiles/foo')
+        self.queue.unload('/profiles/foo')
+        self.queue.flush()
+        self.assertEqual(self.get_calls(), ['-I/etc/apparmor.d --base /etc/apparmor.d -R /profiles/foo'])
+
+    def test_failure(self):
+        for name in ['foo', 'broken', 'bar']:
+            self.queue.add('/profiles/%s' % name)
+
+        results = self.queue.flush()
+        self.assertEqual(results['/profiles/foo'][0], True)
+        self.assertEqual(results['/profiles/bar'][0], True)
+        self.assertEqual(results['/profiles/broken'], (False, 'error in /profiles/broken\n'))
+        # one batched call, then one call per file
+        self.assertEqual(len(self.get_calls()), 4)
+
+    def test_empty(self):
+        self.assertEqual(self.queue.flush(), {})
+        self.assertEqual(self.get_calls(), [])
+
 class AaTest_separate_vars(AATest):
     tests = [
         (''                             , set()                      ),
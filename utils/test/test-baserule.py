@@ -13,7 +13,7 @@ import unittest
 from common_test import AATest, setup_all_loops
 
 from apparmor.common import AppArmorBug
-from apparmor.rule import BaseRule, parse_modifiers
+from apparmor.rule import BaseRule, BaseRuleset, parse_modifiers
 import apparmor.severity as severity
 
 import re
@@ -58,6 +58,14 @@ class TestBaserule(AATest):
         rank = obj.severity(sev_db)
         self.assertEqual(rank, sev_db.NOT_IMPLEMENTED)
 
+    def test_default_severity_summary(self):
+        sev_db = severity.Severity('severity.db', 'unknown')
+        ruleset = BaseRuleset()
+        ruleset.add(BaseRule())
+        ruleset.add(BaseRule())
+        summary = ruleset.get_severity_summary(sev_db)
+        self.assertEqual(summary, {'max': None, 'ranks': {sev_db.NOT_IMPLEMENTED: 2}})
+
     def test_logprof_header_localvars(self):
         obj = BaseRule()
         with self.assertRaises(AppArmorBug):
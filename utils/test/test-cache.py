@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+# ------------------------------------------------------------------
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License published by the Free Software Foundation.
+#
+# ------------------------------------------------------------------
+
+import unittest
+from common_test import AATest, setup_all_loops
+from common_test import write_file
+
+import os
+
+from apparmor.cache import FileCache, cache_key, load_json_cache, modules_version, save_json_cache
+
+class TestFileCache(AATest):
+    def AASetup(self):
+        self.createTmpdir()
+        self.source = write_file(self.tmpdir, 'source', 'foo\n')
+        self.cache = FileCache(self.tmpdir, 'cache', 'version 1')
+
+    def test_store_and_load(self):
+        self.assertTrue(self.cache.enabled)
+        self.assertEqual(self.cache.load(self.source), None)
+
+        self.cache.store(self.source, {'foo': set(['bar'])})
+        self.assertEqual(self.cache.load(self.source), {'foo': set(['bar'])})
+
+        # other cache instance with the same settings
+        self.assertEqual(FileCache(self.tmpdir, 'cache', 'version 1').load(self.source), {'foo': set(['bar'])})
+
+    def test_extra_key(self):
+        self.cache.store(self.source, 'first', extra_key=('a', 1))
+        self.cache.store(self.source, 'second', extra_key=('b', 1))
+        self.assertEqual(self.cache.load(self.source, ('a', 1)), 'first')
+        self.assertEqual(self.cache.load(self.source, ('b', 1)), 'second')
+        self.assertEqual(self.cache.load(self.source), None)
+
+    def test_source_changed(self):
+        self.cache.store(self.source, 'data')
+        write_file(self.tmpdir, 'source', 'foo bar\n')
+        self.assertEqual(self.cache.load(self.source), None)
+
+    def test_source_removed(self):
+        self.cache.store(self.source, 'data')
+        os.unlink(self.source)
+        self.assertEqual(self.cache.load(self.source), None)
+
+    def test_version_changed(self):
+        self.cache.store(self.source, 'data')
+        self.assertEqual(FileCache(self.tmpdir, 'cache', 'version 2').load(self.source), None)
+
+    def test_broken_cache_file(self):
+        self.cache.store(self.source, 'data')
+        for name in os.listdir(self.cache.cache_dir):
+            write_file(self.cache.cache_dir, name, 'garbage')
+        self.assertEqual(self.cache.load(self.source), None)
+
+    def test_insecure_cache_dir(self):
+        os.chmod(self.tmpdir, 0o777)
+        os.mkdir(os.path.join(self.tmpdir, 'insecure'))
+        os.chmod(os.path.join(self.tmpdir, 'insecure'), 0o777)
+
+        cache = FileCache(self.tmpdir, 'insecure')
+        self.assertFalse(cache.enabled)
+        cache.store(self.source, 'data')
+        self.assertEqual(cache.load(self.source), None)
+
+    def test_clear(self):
+        self.cache.store(self.source, 'data')
+        self.cache.clear()
+        self.assertEqual(self.cache.load(self.source), None)
+        self.assertEqual(os.listdir(self.cache.cache_dir), [])
+
+
+class TestJsonCache(AATest):
+    def AASetup(self):
+        self.createTmpdir()
+        self.cache_file = os.path.join(self.tmpdir, 'cache', 'test.json')
+
+    def test_save_and_load(self):
+        self.assertEqual(load_json_cache(self.cache_file, 1), None)
+        self.assertTrue(save_json_cache(self.cache_file, 1, {'foo': ['bar']}))
+        self.assertEqual(load_json_cache(self.cache_file, 1), {'foo': ['bar']})
+        self.assertEqual(os.listdir(os.path.dirname(self.cache_file)), ['test.json'])
+
+    def test_version_changed(self):
+        save_json_cache(self.cache_file, 1, 'data')
+        self.assertEqual(load_json_cache(self.cache_file, 2), None)
+
+    def test_broken_cache_file(self):
+        save_json_cache(self.cache_file, 1, 'data')
+        write_file(os.path.dirname(self.cache_file), 'test.json', '{"format": 1')
+        self.assertEqual(load_json_cache(self.cache_file, 1), None)
+
+    def test_untrusted_cache_file(self):
+        save_json_cache(self.cache_file, 1, 'data')
+        os.chmod(self.cache_file, 0o666)
+        self.assertEqual(load_json_cache(self.cache_file, 1), None)
+
+    def test_unwriteable_dir(self):
+        write_file(self.tmpdir, 'cache', 'not a directory')
+        self.assertFalse(save_json_cache(self.cache_file, 1, 'data'))
+
+class TestCacheKey(AATest):
+    tests = [
+        ('/etc/apparmor.d',     'c27cc13af14d688ea411dedcfd40c3cd346f6e28'),
+        (u'/tmp/\xe4',          '875832fd155eefd7f20b4b40f383f3888077bab2'),
+    ]
+
+    def _run_test(self, params, expected):
+        self.assertEqual(cache_key(params), expected)
+
+
+class TestModulesVersion(AATest):
+    def AASetup(self):
+        self.createTmpdir()
+        os.mkdir(os.path.join(self.tmpdir, 'rule'))
+        write_file(self.tmpdir, 'foo.py', '')
+        write_file(self.tmpdir, 'rule/bar.py', '')
+        write_file(self.tmpdir, 'README', '')
+
+    def test_modules_version(self):
+        version = modules_version(self.tmpdir)
+        self.assertEqual(modules_version(self.tmpdir), version)
+
+        # other files don't matter
+        os.utime(os.path.join(self.tmpdir, 'README'), (0, 0))
+        self.assertEqual(modules_version(self.tmpdir), version)
+
+        # modules in subdirectories do
+        os.utime(os.path.join(self.tmpdir, 'rule/bar.py'), (0, 0))
+        self.assertNotEqual(modules_version(self.tmpdir), version)
+
+
+setup_all_loops(__name__)
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
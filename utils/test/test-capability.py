@@ -212,6 +212,17 @@ class CapabilityTest(AATest):
             'comment':          "",
         })
 
+    def test_cached_match(self):
+        matches = CapabilityRule._cached_match('capability chown,')
+        self.assertEqual(matches.group('capability'), ' chown')
+        self.assertTrue(CapabilityRule._cached_match('capability chown,') is matches)
+
+        self.assertEqual(CapabilityRule._cached_match('capability fsetid,').group('capability'), ' fsetid')
+        self.assertEqual(CapabilityRule._cached_match('network,'), None)
+
+        obj = CapabilityRule.parse('capability chown,')
+        self.assertEqual(obj.capability, {'chown'})
+
 
 class InvalidCapabilityTest(AATest):
     def _check_invalid_rawrule(self, rawrule):
@@ -436,6 +447,20 @@ class CapabiliySeverityTest(AATest):
         rank = obj.severity(sev_db)
         self.assertEqual(rank, expected)
 
+class CapabilityRulesetSeverityTest(AATest):
+    def test_severity_summary(self):
+        sev_db = severity.Severity('severity.db', 'unknown')
+        ruleset = CapabilityRuleset()
+        for rule in ['capability fsetid,', 'capability dac_read_search,', 'capability fsetid dac_read_search,', 'capability foo,']:
+            ruleset.add(CapabilityRule.parse(rule))
+
+        summary = ruleset.get_severity_summary(sev_db)
+        self.assertEqual(summary, {'max': 9, 'ranks': {9: 2, 7: 1, 'unknown': 1}})
+
+    def test_severity_summary_empty(self):
+        sev_db = severity.Severity('severity.db', 'unknown')
+        self.assertEqual(CapabilityRuleset().get_severity_summary(sev_db), {'max': None, 'ranks': {}})
+
 class CapabilityLogprofHeaderTest(AATest):
     tests = [
         ('capability,',                         [                               _('Capability'), _('ALL'),         ]),
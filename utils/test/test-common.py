@@ -12,7 +12,7 @@
 import unittest
 from common_test import AATest, setup_all_loops
 
-from apparmor.common import type_is_str
+from apparmor.common import type_is_str, RegexpCache
 
 class TestIs_str_type(AATest):
     tests = [
@@ -26,6 +26,50 @@ class TestIs_str_type(AATest):
     def _run_test(self, params, expected):
         self.assertEqual(type_is_str(params), expected)
 
+class TestRegexpCache(AATest):
+    tests = [
+        (['/foo/*',         '/foo/bar'],        True),
+        (['/foo/*',         '/foo/bar/baz'],    False),
+        (['/foo/**',        '/foo/bar/baz'],    True),
+        (['/foo/{bar,baz}', '/foo/baz'],        True),
+        (['/foo/ba?',       '/foo/bar'],        True),
+        (['/foo/bar',       '/foo/bar.txt'],    False),
+    ]
+
+    def _run_test(self, params, expected):
+        cache = RegexpCache()
+        regexp = cache.get(params[0])
+        self.assertEqual(bool(regexp.search(params[1])), expected)
+
+    def test_hits_and_misses(self):
+        cache = RegexpCache()
+        first = cache.get('/foo/*')
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertTrue(cache.get('/foo/*') is first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        cache.clear()
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 0, 0))
+
+    def test_invalid(self):
+        cache = RegexpCache()
+        self.assertEqual(cache.get('/foo/[bar'), None)
+        self.assertEqual(cache.get('/foo/[bar'), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        cache = RegexpCache(maxsize=2)
+        cache.get('/a')
+        cache.get('/b')
+        cache.get('/a')  # /b is now the least recently used entry
+        cache.get('/c')
+        self.assertEqual(len(cache), 2)
+
+        cache.get('/a')
+        self.assertEqual(cache.misses, 3)
+        cache.get('/b')
+        self.assertEqual(cache.misses, 4)
+
 
 setup_all_loops(__name__)
 if __name__ == '__main__':
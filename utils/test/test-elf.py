@@ -0,0 +1,254 @@
+#! /usr/bin/env python
+# ------------------------------------------------------------------
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License published by the Free Software Foundation.
+#
+# ------------------------------------------------------------------
+
+import unittest
+from common_test import AATest, setup_all_loops, write_file
+
+import os
+import struct
+import subprocess
+
+import apparmor.elf as elf
+
+VADDR = 0x400000
+
+def make_elf(needed=(), soname=None, rpath=None, runpath=None, interp=None, elf_class=elf.ELFCLASS64, machine=62, dynamic=True):
+    '''Return the content of a minimal little-endian ELF file'''
+    header_fmt, phdr_fmt, dyn_fmt = [struct.Struct('<' + fmt) for fmt in elf.ELF_STRUCTS[elf_class]]
+
+    strtab = b'\0'
+    dyn = []
+    def add_string(tag, value):
+        offset = len(strtab)
+        dyn.append((tag, offset))
+        return strtab + value.encode('utf-8') + b'\0'
+    for name in needed:
+        strtab = add_string(elf.DT_NEEDED, name)
+    if soname:
+        strtab = add_string(elf.DT_SONAME, soname)
+    if rpath:
+        strtab = add_string(elf.DT_RPATH, rpath)
+    if runpath:
+        strtab = add_string(elf.DT_RUNPATH, runpath)
+
+    phnum = 1 + bool(interp) + bool(dynamic)
+    interp_offset = 16 + header_fmt.size + phnum * phdr_fmt.size
+    interp_data = interp.encode('utf-8') + b'\0' if interp else b''
+    strtab_offset = interp_offset + len(interp_data)
+    dyn_offset = strtab_offset + len(strtab)
+    dyn += [(elf.DT_STRTAB, VADDR + strtab_offset), (elf.DT_STRSZ, len(strtab)), (elf.DT_NULL, 0)]
+    dyn_data = b''.join(dyn_fmt.pack(tag, value) for tag, value in dyn)
+    size = dyn_offset + len(dyn_data)
+
+    def phdr(p_type, offset, filesz, vaddr):
+        if elf_class == elf.ELFCLASS32:
+            return phdr_fmt.pack(p_type, offset, vaddr, vaddr, filesz, filesz, 0, 0)
+        return phdr_fmt.pack(p_type, 0, offset, vaddr, vaddr, filesz, filesz, 0)
+
+    phdrs = phdr(elf.PT_LOAD, 0, size, VADDR)
+    if interp:
+        phdrs += phdr(elf.PT_INTERP, interp_offset, len(interp_data), VADDR + interp_offset)
+    if dynamic:
+        phdrs += phdr(elf.PT_DYNAMIC, dyn_offset, len(dyn_data), VADDR + dyn_offset)
+
+    ident = elf.ELF_MAGIC + struct.pack('BBB', elf_class, elf.ELFDATA2LSB, 1) + b'\0' * 9
+    header = header_fmt.pack(3, machine, 1, 0, 16 + header_fmt.size, 0, 0, 16 + header_fmt.size, phdr_fmt.size, phnum, 0, 0, 0)
+    data = ident + header + phdrs + interp_data + strtab
+    if dynamic:
+        data += dyn_data
+    return data
+
+def write_elf(path, **kwargs):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as f_out:
+        f_out.write(make_elf(**kwargs))
+    return path
+
+class TestReadElfInfo(AATest):
+    def AASetup(self):
+        self.createTmpdir()
+
+    def test_dynamic(self):
+        path = write_elf(os.path.join(self.tmpdir, 'bin'), needed=['libfoo.so.1', 'libbar.so.2'], rpath='/opt/a:/opt/b', interp='/lib/ld.so')
+        info = elf.read_elf_info(path)
+        self.assertEqual(info['class'], elf.ELFCLASS64)
+        self.assertEqual(info['machine'], 62)
+        self.assertEqual(info['interp'], '/lib/ld.so')
+        self.assertEqual(info['needed'], ['libfoo.so.1', 'libbar.so.2'])
+        self.assertEqual(info['rpath'], ['/opt/a', '/opt/b'])
+        self.assertEqual(info['runpath'], [])
+        self.assertEqual(info['soname'], None)
+
+    def test_32bit_library(self):
+        path = write_elf(os.path.join(self.tmpdir, 'libfoo.so'), soname='libfoo.so.1', runpath='$ORIGIN', elf_class=elf.ELFCLASS32, machine=3)
+        info = elf.read_elf_info(path)
+        self.assertEqual(info['class'], elf.ELFCLASS32)
+        self.assertEqual(info['machine'], 3)
+        self.assertEqual(info['soname'], 'libfoo.so.1')
+        self.assertEqual(info['runpath'], ['$ORIGIN'])
+
+    def test_static(self):
+        path = write_elf(os.path.join(self.tmpdir, 'static'), dynamic=False)
+        info = elf.read_elf_info(path)
+        self.assertEqual(info['needed'], [])
+        self.assertEqual(info['interp'], None)
+
+    def test_not_elf(self):
+        path = write_file(self.tmpdir, 'script', '#!/bin/sh\necho hello\n')
+        self.assertEqual(elf.read_elf_info(path), None)
+        self.assertEqual(elf.read_elf_info(write_file(self.tmpdir, 'empty', '')), None)
+
+    def test_truncated(self):
+        path = os.path.join(self.tmpdir, 'broken')
+        with open(path, 'wb') as f_out:
+            f_out.write(make_elf(needed=['libfoo.so.1'])[:80])
+        with self.assertRaises(elf.ElfError):
+            elf.read_elf_info(path)
+
+class TestReadLdSoConf(AATest):
+    def AASetup(self):
+        self.createTmpdir()
+
+    def test_read_ld_so_conf(self):
+        os.mkdir(os.path.join(self.tmpdir, 'ld.so.conf.d'))
+        write_file(self.tmpdir, 'ld.so.conf.d/b.conf', '/opt/b/lib\n')
+        write_file(self.tmpdir, 'ld.so.conf.d/a.conf', '# comment\n/opt/a/lib/ # trailing comment\n\n')
+        conf = write_file(self.tmpdir, 'ld.so.conf', 'include ld.so.conf.d/*.conf\n/usr/local/lib:/opt/c,/opt/d=libc5\nhwcap 1 foo\ninclude %s/ld.so.conf\n' % self.tmpdir)
+        self.assertEqual(elf.read_ld_so_conf(conf), ['/opt/a/lib', '/opt/b/lib', '/usr/local/lib', '/opt/c', '/opt/d'])
+
+    def test_missing(self):
+        self.assertEqual(elf.read_ld_so_conf(os.path.join(self.tmpdir, 'nonexistent')), [])
+
+class TestLibraryResolver(AATest):
+    def AASetup(self):
+        self.createTmpdir()
+        self.libdir = os.path.join(self.tmpdir, 'lib')
+        self.interp = write_elf(os.path.join(self.libdir, 'ld-test.so.1'), soname='ld-test.so.1')
+        self.conf = write_file(self.tmpdir, 'ld.so.conf', '')
+
+    def resolver(self, **kwargs):
+        return elf.LibraryResolver(ld_so_conf=self.conf, default_dirs=[self.libdir], **kwargs)
+
+    def test_recursive(self):
+        libc = write_elf(os.path.join(self.libdir, 'libc.so.6'), soname='libc.so.6', needed=['ld-test.so.1'])
+        libbar = write_elf(os.path.join(self.libdir, 'libbar.so.2'), soname='libbar.so.2', needed=['libc.so.6'])
+        libfoo = write_elf(os.path.join(self.libdir, 'libfoo.so.1'), soname='libfoo.so.1', needed=['libbar.so.2', 'libc.so.6'])
+        binary = write_elf(os.path.join(self.tmpdir, 'bin', 'prog'), needed=['libfoo.so.1', 'libmissing.so.1', 'libc.so.6'], interp=self.interp)
+
+        resolver = self.resolver()
+        self.assertEqual(resolver.get_reqs(binary), [libfoo, libc, libbar, self.interp])
+        self.assertEqual(resolver.get_reqs(libbar), [libc, self.interp])
+
+    def test_search_order(self):
+        conf_dir = os.path.join(self.tmpdir, 'conf')
+        write_file(self.tmpdir, 'ld.so.conf', '%s\n' % conf_dir)
+        for directory in [self.libdir, conf_dir, os.path.join(self.tmpdir, 'bin', 'runpath'), os.path.join(self.tmpdir, 'rpath')]:
+            write_elf(os.path.join(directory, 'libfoo.so.1'))
+        write_elf(os.path.join(conf_dir, 'libbar.so.1'))
+        write_elf(os.path.join(self.libdir, 'libbar.so.1'))
+        write_elf(os.path.join(self.libdir, 'libbaz.so.1'))
+
+        binary = write_elf(os.path.join(self.tmpdir, 'bin', 'prog1'), needed=['libfoo.so.1', 'libbar.so.1', 'libbaz.so.1'], rpath=os.path.join(self.tmpdir, 'rpath'))
+        self.assertEqual(self.resolver().get_reqs(binary), [
+            os.path.join(self.tmpdir, 'rpath', 'libfoo.so.1'),
+            os.path.join(conf_dir, 'libbar.so.1'),
+            os.path.join(self.libdir, 'libbaz.so.1'),
+        ])
+
+        # DT_RPATH is ignored if DT_RUNPATH is set
+        binary = write_elf(os.path.join(self.tmpdir, 'bin', 'prog2'), needed=['libfoo.so.1'], rpath=os.path.join(self.tmpdir, 'rpath'), runpath='$ORIGIN/runpath')
+        self.assertEqual(self.resolver().get_reqs(binary), [os.path.join(self.tmpdir, 'bin', 'runpath', 'libfoo.so.1')])
+
+    def test_origin_parent(self):
+        libfoo = write_elf(os.path.join(self.tmpdir, 'usr', 'lib', 'libfoo.so.1'))
+        libbar = write_elf(os.path.join(self.tmpdir, 'usr', 'lib', 'libbar.so.1'))
+        binary = write_elf(os.path.join(self.tmpdir, 'usr', 'bin', 'prog'), needed=['libfoo.so.1', '$ORIGIN/../lib/libbar.so.1'], runpath='$ORIGIN/../lib')
+        self.assertEqual(self.resolver().get_reqs(binary), [libfoo, libbar])
+
+    def test_wrong_class(self):
+        write_elf(os.path.join(self.tmpdir, 'lib32', 'libfoo.so.1'), elf_class=elf.ELFCLASS32, machine=3)
+        libfoo = write_elf(os.path.join(self.libdir, 'libfoo.so.1'))
+        binary = write_elf(os.path.join(self.tmpdir, 'prog'), needed=['libfoo.so.1'], runpath=os.path.join(self.tmpdir, 'lib32'))
+        self.assertEqual(self.resolver().get_reqs(binary), [libfoo])
+
+    def test_not_elf(self):
+        self.assertEqual(self.resolver().get_reqs(write_file(self.tmpdir, 'script', '#!/bin/sh\n')), [])
+        self.assertEqual(self.resolver().get_reqs(os.path.join(self.tmpdir, 'nonexistent')), [])
+
+    def test_broken(self):
+        path = os.path.join(self.tmpdir, 'broken')
+        with open(path, 'wb') as f_out:
+            f_out.write(make_elf(needed=['libfoo.so.1'])[:80])
+        self.assertEqual(self.resolver().get_reqs(path), None)
+
+    def test_cache(self):
+        cache_file = os.path.join(self.tmpdir, 'cache', 'elf.json')
+        libfoo = write_elf(os.path.join(self.libdir, 'libfoo.so.1'))
+        binary = write_elf(os.path.join(self.tmpdir, 'prog'), needed=['libfoo.so.1'])
+
+        resolver = self.resolver(cache_file=cache_file)
+        self.assertEqual(resolver.get_reqs(binary), [libfoo])
+        resolver.save()
+        self.assertTrue(os.path.exists(cache_file))
+
+        # cached info is used as long as the file doesn't change
+        resolver = self.resolver(cache_file=cache_file)
+        self.assertEqual(resolver.files[binary]['info']['needed'], ['libfoo.so.1'])
+        resolver.files[binary]['info']['needed'] = ['libcached.so.1']
+        self.assertEqual(resolver.get_info(binary)['needed'], ['libcached.so.1'])
+        self.assertFalse(resolver.dirty)
+
+        # changed files are read again
+        libbar = write_elf(os.path.join(self.libdir, 'libbar.so.1'))
+        write_elf(binary, needed=['libfoo.so.1', 'libbar.so.1'])
+        resolver = self.resolver(cache_file=cache_file)
+        self.assertEqual(resolver.get_reqs(binary), [libfoo, libbar])
+        self.assertTrue(resolver.dirty)
+
+    def test_untrusted_cache(self):
+        cache_file = os.path.join(self.tmpdir, 'elf.json')
+        binary = write_elf(os.path.join(self.tmpdir, 'prog'))
+        resolver = self.resolver(cache_file=cache_file)
+        resolver.get_reqs(binary)
+        resolver.save()
+
+        os.chmod(cache_file, 0o666)
+        self.assertEqual(self.resolver(cache_file=cache_file).files, {})
+
+class TestLdd(AATest):
+    '''Compare with ldd for some binaries of the system'''
+    tests = [
+        ('/bin/ls',         None),
+        ('/bin/sh',         None),
+        ('/usr/bin/env',    None),
+    ]
+
+    def _run_test(self, params, expected):
+        path = os.path.realpath(params)
+        if not os.path.exists(path) or not os.path.exists('/usr/bin/ldd'):
+            raise unittest.SkipTest('%s or ldd not available' % params)
+
+        ldd = subprocess.Popen(['/usr/bin/ldd', path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = ldd.communicate()[0].decode('utf-8')
+        if ldd.returncode != 0 or 'statically linked' in output:
+            raise unittest.SkipTest('%s is not dynamically linked' % params)
+
+        reqs = set()
+        for line in output.split('\n'):
+            line = line.split('(')[0].split()
+            if line and line[-1].startswith('/'):
+                reqs.add(line[-1])
+
+        self.assertEqual(set(elf.LibraryResolver().get_reqs(path)), reqs)
+
+setup_all_loops(__name__)
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+# ------------------------------------------------------------------
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License published by the Free Software Foundation.
+#
+# ------------------------------------------------------------------
+
+import unittest
+from common_test import AATest, setup_all_loops
+
+import json
+import os
+
+import apparmor.instrument as instrument
+
+class TestInstrument(AATest):
+    def AATeardown(self):
+        instrument.disable()
+        instrument.reset()
+
+    def test_disabled(self):
+        instrument.disable()
+        with instrument.span('foo'):
+            instrument.count('bar')
+        self.assertEqual(instrument.get_span_totals(), {})
+        self.assertEqual(instrument.get_counters(), {})
+        # no new object per call
+        self.assertTrue(instrument.span('foo') is instrument.span('bar'))
+
+    def test_spans_and_counters(self):
+        instrument.enable()
+        for i in range(3):
+            with instrument.span('outer'):
+                with instrument.span('inner', item=i):
+                    instrument.count('items')
+        instrument.count('bytes', 42)
+
+        totals = instrument.get_span_totals()
+        self.assertEqual(sorted(totals.keys()), ['inner', 'outer'])
+        self.assertEqual(totals['outer'][0], 3)
+        self.assertTrue(totals['outer'][1] >= totals['inner'][1])
+        self.assertEqual(instrument.get_counters(), {'items': 3, 'bytes': 42})
+
+        summary = instrument.summary()
+        self.assertTrue('outer' in summary)
+        self.assertTrue('bytes' in summary)
+
+    def test_span_exception(self):
+        instrument.enable()
+        with self.assertRaises(ValueError):
+            with instrument.span('failing'):
+                raise ValueError('foo')
+        self.assertEqual(instrument.get_span_totals()['failing'][0], 1)
+
+        # depth is restored
+        with instrument.span('next'):
+            pass
+        self.assertEqual(instrument._spans[-1][3], 0)
+
+    def test_enable_resets(self):
+        instrument.enable()
+        instrument.count('foo')
+        instrument.enable()
+        self.assertEqual(instrument.get_counters(), {})
+
+    def test_chrome_trace(self):
+        self.createTmpdir()
+        instrument.enable()
+        with instrument.span('outer'):
+            with instrument.span('inner', file='/etc/apparmor.d/foo'):
+                pass
+        instrument.count('files parsed', 2)
+
+        tracefile = os.path.join(self.tmpdir, 'trace.json')
+        instrument.write_chrome_trace(tracefile)
+        with open(tracefile) as f_in:
+            trace = json.load(f_in)
+
+        events = trace['traceEvents']
+        self.assertEqual([event['name'] for event in events], ['outer', 'inner', 'files parsed'])
+        self.assertEqual([event['ph'] for event in events], ['X', 'X', 'C'])
+        self.assertEqual(events[1]['args'], {'file': '/etc/apparmor.d/foo'})
+        self.assertEqual(events[2]['args'], {'value': 2})
+        self.assertTrue(events[0]['dur'] >= events[1]['dur'])
+
+
+setup_all_loops(__name__)
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
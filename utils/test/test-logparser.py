@@ -13,8 +13,19 @@
 #
 # ----------------------------------------------------------------------
 import unittest
+from common_test import AATest, write_file
 
-from apparmor.logparser import ReadLog
+import json
+import os
+
+import apparmor.logparser
+from apparmor.common import AppArmorBug
+from apparmor.logparser import ReadLog, LogCursor, LogCountSink, LogJSONSink, LogSink, LogTreeSink, LogWatcher
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 class TestParseEvent(unittest.TestCase):
     def setUp(self):
@@ -94,6 +105,297 @@ class TestParseEvent(unittest.TestCase):
         self.assertIsNotNone(ReadLog.RE_LOG_v2_6_audit.search(event))
         self.assertIsNone(ReadLog.RE_LOG_v2_6_syslog.search(event))
 
+LOG_LINES = [
+    'Dec  7 13:18:59 rosa kernel: [1.23] usb 1-1: new high-speed USB device number 2\n',
+    'type=AVC msg=audit(1345027352.096:499): apparmor="ALLOWED" operation="open" parent=6974 profile="/usr/bin/foo" name="/etc/foo" pid=20143 comm="foo" requested_mask="r" denied_mask="r" fsuid=0 ouid=0\n',
+    'Dec  7 13:19:00 rosa sshd[42]: something unrelated\n',
+    'type=AVC msg=audit(1345027353.096:500): apparmor="DENIED" operation="mkdir" parent=6974 profile="/usr/bin/foo" name="/tmp/bar/" pid=20143 comm="foo" requested_mask="c" denied_mask="c" fsuid=0 ouid=0\n',
+    'type=AVC msg=audit(1345027354.096:501): apparmor="ALLOWED" operation="capable" parent=6974 profile="/usr/bin/bar" name="chown" pid=20144 comm="bar" capability=0 capname="chown"\n',
+]
+
+class TestLogSinks(AATest):
+    def AASetup(self):
+        self.createTmpdir()
+        self.logfile = write_file(self.tmpdir, 'audit.log', ''.join(LOG_LINES))
+        self.parser = ReadLog(dict(), self.logfile, {'/usr/bin/foo': True, '/usr/bin/bar': True}, self.tmpdir, [])
+
+    def test_get_events(self):
+        names = [event['name'] for event in self.parser.get_events()]
+        self.assertEqual(names, ['/etc/foo', '/tmp/bar/', 'chown'])
+
+    def test_get_events_logmark(self):
+        names = [event['name'] for event in self.parser.get_events('audit(1345027353.096:500)')]
+        self.assertEqual(names, ['/tmp/bar/', 'chown'])
+
+    def test_count_sink(self):
+        counts = self.parser.process_log([LogCountSink()])[0]
+        self.assertEqual(counts['total'], 3)
+        self.assertEqual(counts['aamode'], {'PERMITTING': 2, 'REJECTING': 1})
+        self.assertEqual(counts['profile'], {'/usr/bin/foo': 2, '/usr/bin/bar': 1})
+
+    def test_incomplete_sink(self):
+        with self.assertRaises(AppArmorBug):
+            self.parser.process_log([LogSink()])
+
+    def test_all_sinks(self):
+        stream = StringIO()
+        json_count, counts, log = self.parser.process_log([LogJSONSink(stream), LogCountSink(), LogTreeSink(self.parser)])
+
+        self.assertEqual(json_count, 3)
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([event['operation'] for event in events], ['open', 'mkdir', 'capable'])
+
+        self.assertEqual(counts['total'], 3)
+
+        # same as read_log()
+        self.assertEqual(log, ReadLog(dict(), self.logfile, {'/usr/bin/foo': True, '/usr/bin/bar': True}, self.tmpdir, []).read_log(''))
+        self.assertEqual(len(log), 2)  # two pids
+
+    def test_prefilter(self):
+        with open(self.logfile, 'ab') as f:
+            f.write(b'Dec  7 13:19:01 rosa foo: invalid utf-8 \xff\xfe\n')
+            f.write(b'Dec  7 13:19:02 rosa foo: apparmor="DENIED" but not from the kernel\n')
+
+        names = [event['name'] for event in self.parser.get_events()]
+        self.assertEqual(names, ['/etc/foo', '/tmp/bar/', 'chown'])
+
+    def test_parallel(self):
+        # many small ranges to make sure the "set profile" lookahead works across ranges
+        lines = []
+        for i in range(200):
+            lines.append(LOG_LINES[i % len(LOG_LINES)])
+            if i % 3 == 0:
+                lines.append('type=AVC msg=audit(1345027360.096:%d): apparmor="ALLOWED" operation="inode_permission" parent=6974 profile="/usr/bin/foo" name="/usr/bin/child" pid=20143 comm="foo" requested_mask="x" denied_mask="x" fsuid=0 ouid=0\n' % i)
+                lines.append('type=AVC msg=audit(1345027360.096:%d): apparmor="AUDIT" operation="exec" info="set profile" parent=6974 profile="/usr/bin/foo" name="/usr/bin/child" pid=20143 comm="foo" requested_mask="x" denied_mask="x"\n' % i)
+        write_file(self.tmpdir, 'audit.log', ''.join(lines))
+
+        expected = ReadLog(dict(), self.logfile, {'/usr/bin/foo': True, '/usr/bin/bar': True}, self.tmpdir, []).read_log('audit(1345027360.096:30)')
+
+        orig_range_size = apparmor.logparser.LOG_RANGE_SIZE
+        apparmor.logparser.LOG_RANGE_SIZE = 1000
+        try:
+            for jobs in [2, 3]:
+                log = ReadLog(dict(), self.logfile, {'/usr/bin/foo': True, '/usr/bin/bar': True}, self.tmpdir, []).read_log('audit(1345027360.096:30)', jobs)
+                self.assertEqual(log, expected)
+        finally:
+            apparmor.logparser.LOG_RANGE_SIZE = orig_range_size
+
+    def test_json_sink_sets(self):
+        stream = StringIO()
+        sink = LogJSONSink(stream)
+        sink.handle({'denied_mask': set(['r', 'w'])})
+        self.assertEqual(sink.finish(), 1)
+        self.assertEqual(json.loads(stream.getvalue()), {'denied_mask': ['r', 'w']})
+
+class TestLogCursor(AATest):
+    def AASetup(self):
+        self.createTmpdir()
+        self.logfile = write_file(self.tmpdir, 'audit.log', ''.join(LOG_LINES[:3]))
+        self.cursor = LogCursor()
+
+    def _names(self, jobs=1):
+        parser = ReadLog(dict(), self.logfile, {'/usr/bin/foo': True, '/usr/bin/bar': True}, self.tmpdir, [], self.cursor)
+        return [event['name'] for event in parser.get_events(jobs=jobs)]
+
+    def _append(self, text):
+        with open(self.logfile, 'a') as f:
+            f.write(text)
+
+    def test_resume(self):
+        for jobs in [1, 2]:
+            self.cursor = LogCursor()
+            self.logfile = write_file(self.tmpdir, 'audit.log', ''.join(LOG_LINES[:3]))
+            self.assertEqual(self._names(jobs), ['/etc/foo'])
+            self.assertEqual(self.cursor.offset, os.path.getsize(self.logfile))
+            self.assertEqual(self.cursor.timestamp, 1345027352)
+
+            self._append(''.join(LOG_LINES[3:]))
+            self.assertEqual(self._names(jobs), ['/tmp/bar/', 'chown'])
+            self.assertEqual(self._names(jobs), [])
+
+    def test_incomplete_line(self):
+        self._append(LOG_LINES[3][:50])
+        self.assertEqual(self._names(), ['/etc/foo'])
+        self._append(LOG_LINES[3][50:])
+        self.assertEqual(self._names(), ['/tmp/bar/'])
+
+    def test_incomplete_line_while_reading(self):
+        self._append(LOG_LINES[3][:50])
+        parser = ReadLog(dict(), self.logfile, {'/usr/bin/foo': True, '/usr/bin/bar': True}, self.tmpdir, [], self.cursor)
+        events = parser.get_events()
+        self.assertEqual(next(events)['name'], '/etc/foo')
+        # the line gets completed while the log is read
+        self._append(LOG_LINES[3][50:])
+        self.assertEqual([event['name'] for event in events], ['/tmp/bar/'])
+        self.assertEqual(self.cursor.offset, os.path.getsize(self.logfile))
+
+        self._append(LOG_LINES[4])
+        self.assertEqual(self._names(), ['chown'])
+
+    def test_logmark_ignored(self):
+        self._names()
+        self._append(''.join(LOG_LINES[3:]))
+        parser = ReadLog(dict(), self.logfile, {'/usr/bin/foo': True, '/usr/bin/bar': True}, self.tmpdir, [], self.cursor)
+        names = [event['name'] for event in parser.get_events('audit(1345027354.096:501)')]
+        self.assertEqual(names, ['/tmp/bar/', 'chown'])
+
+    def test_rotated(self):
+        self._names()
+        self._append(LOG_LINES[3])
+        os.rename(self.logfile, self.logfile + '.1')
+        write_file(self.tmpdir, 'audit.log', LOG_LINES[4])
+        self.assertEqual(self._names(), ['/tmp/bar/', 'chown'])
+        self.assertEqual(self.cursor.inode, os.stat(self.logfile).st_ino)
+
+    def test_rotated_and_removed(self):
+        self._names()
+        os.rename(self.logfile, self.logfile + '.old')
+        # the old events get skipped based on their timestamp
+        write_file(self.tmpdir, 'audit.log', LOG_LINES[0] + LOG_LINES[3] + LOG_LINES[4])
+        self.assertEqual(self._names(), ['/tmp/bar/', 'chown'])
+
+    def test_truncated(self):
+        self._names()
+        with open(self.logfile, 'w') as f:
+            f.write(LOG_LINES[4])
+        self.assertEqual(self._names(), ['chown'])
+
+    def test_other_logfile(self):
+        self._names()
+        self.cursor.filename = '/var/log/something.log'
+        self.assertEqual(self._names(), ['/etc/foo'])
+
+    def test_save_load(self):
+        self._names()
+        cursorfile = os.path.join(self.tmpdir, 'cursor')
+        self.cursor.save(cursorfile)
+
+        loaded = LogCursor.load(cursorfile)
+        self.assertEqual((loaded.filename, loaded.inode, loaded.offset, loaded.timestamp),
+                         (self.cursor.filename, self.cursor.inode, self.cursor.offset, self.cursor.timestamp))
+
+    def test_load_invalid(self):
+        for content in [None, '', 'not json', '{"filename": "/var/log/audit.log"}']:
+            cursorfile = os.path.join(self.tmpdir, 'cursor')
+            if content is not None:
+                write_file(self.tmpdir, 'cursor', content)
+            self.assertFalse(LogCursor.load(cursorfile).is_valid_for(self.logfile))
+
+    def test_at_end(self):
+        self._append(LOG_LINES[3][:50])
+        self.cursor = LogCursor.at_end(self.logfile)
+        self.assertEqual(self.cursor.offset, len(''.join(LOG_LINES[:3])))
+        self._append(LOG_LINES[3][50:] + LOG_LINES[4])
+        self.assertEqual(self._names(), ['/tmp/bar/', 'chown'])
+
+
+class FakeWatcher(object):
+    '''LogWatcher replacement that simulates the log writer: each wait() runs the next action'''
+    def __init__(self, actions):
+        self.actions = actions
+
+    def wait(self, timeout):
+        if self.actions:
+            self.actions.pop(0)()
+            return True
+        return False
+
+    def close(self):
+        pass
+
+class TestLogFollow(AATest):
+    def AASetup(self):
+        self.createTmpdir()
+        self.logfile = write_file(self.tmpdir, 'audit.log', ''.join(LOG_LINES[:3]))
+        self.parser = ReadLog(dict(), self.logfile, {'/usr/bin/foo': True, '/usr/bin/bar': True}, self.tmpdir, [])
+
+    def _append(self, text):
+        with open(self.logfile, 'a') as f:
+            f.write(text)
+
+    def _follow(self, actions, **kwargs):
+        kwargs.setdefault('batch_delay', 0)
+        return self.parser.follow(watcher=FakeWatcher(actions), **kwargs)
+
+    def _names(self, batch):
+        return [event['name'] for event in batch]
+
+    def test_append(self):
+        follow = self._follow([lambda: self._append(LOG_LINES[3][:50]),
+                               lambda: self._append(LOG_LINES[3][50:] + LOG_LINES[4])], from_start=True)
+        self.assertEqual(self._names(next(follow)), ['/etc/foo'])
+        # the incomplete line is only read once it's complete
+        self.assertEqual(self._names(next(follow)), ['/tmp/bar/', 'chown'])
+        follow.close()
+
+    def test_start_at_end(self):
+        follow = self._follow([lambda: self._append(LOG_LINES[3])])
+        self.assertEqual(self._names(next(follow)), ['/tmp/bar/'])
+        follow.close()
+
+    def test_logmark(self):
+        follow = self._follow([lambda: self._append(''.join(LOG_LINES[3:]))], logmark='audit(1345027354.096:501)', from_start=True)
+        self.assertEqual(self._names(next(follow)), ['chown'])
+        follow.close()
+
+    def test_batch_size(self):
+        self._append(''.join(LOG_LINES[3:]) * 3)
+        follow = self._follow([], batch_size=2, from_start=True, idle_timeout=0)
+        self.assertEqual([len(batch) for batch in follow], [2, 2, 2, 1])
+
+    def test_idle_timeout(self):
+        follow = self._follow([], from_start=True, idle_timeout=0)
+        self.assertEqual([self._names(batch) for batch in follow], [['/etc/foo']])
+
+    def test_rotated(self):
+        def rotate():
+            self._append(LOG_LINES[3])
+            os.rename(self.logfile, self.logfile + '.1')
+            write_file(self.tmpdir, 'audit.log', LOG_LINES[4])
+
+        follow = self._follow([rotate])
+        # the rest of the old logfile is read first
+        self.assertEqual(self._names(next(follow)), ['/tmp/bar/'])
+        self.assertEqual(self._names(next(follow)), ['chown'])
+        follow.close()
+
+    def test_truncated(self):
+        def truncate():
+            with open(self.logfile, 'w') as f:
+                f.write(LOG_LINES[4])
+
+        follow = self._follow([truncate], from_start=True)
+        self.assertEqual(self._names(next(follow)), ['/etc/foo'])
+        self.assertEqual(self._names(next(follow)), ['chown'])
+        follow.close()
+
+    def test_cursor(self):
+        self.parser.cursor = LogCursor()
+        self._append(LOG_LINES[3][:50])
+        follow = self._follow([], from_start=True, idle_timeout=0)
+        self.assertEqual([self._names(batch) for batch in follow], [['/etc/foo']])
+        self.assertEqual(self.parser.cursor.offset, len(''.join(LOG_LINES[:3])))
+
+        # continues at the cursor
+        self._append(LOG_LINES[3][50:] + LOG_LINES[4])
+        follow = self._follow([], idle_timeout=0)
+        self.assertEqual([self._names(batch) for batch in follow], [['/tmp/bar/', 'chown']])
+
+    def test_watcher(self):
+        for use_inotify in [True, False]:
+            watcher = LogWatcher(self.logfile, use_inotify)
+            try:
+                if use_inotify and not watcher.uses_inotify():
+                    continue
+                if watcher.uses_inotify():
+                    self.assertFalse(watcher.wait(0.01))
+                    # changes of other files in the directory are ignored
+                    write_file(self.tmpdir, 'other.log', 'foo')
+                    self.assertFalse(watcher.wait(0.01))
+                self._append(LOG_LINES[3])
+                self.assertTrue(watcher.wait(1))
+            finally:
+                watcher.close()
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+# ------------------------------------------------------------------
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License published by the Free Software Foundation.
+#
+# ------------------------------------------------------------------
+
+import unittest
+from common_test import AATest, setup_all_loops
+
+from apparmor.common import convert_regexp
+from apparmor.pathmatcher import PathMatcher, PathIndex, PathRules, get_path_matcher
+
+from copy import deepcopy
+import pickle
+import re
+
+ENTRIES = [
+    '/etc/passwd',
+    '/etc/ld.so.cache',
+    '/usr/lib/**.so*',
+    '/usr/lib/*/',
+    '/usr/{lib,lib64}/foo/*',
+    '/usr/share/ba?/',
+    '/**',
+    '@{PROC}/[0-9]*/stat',
+    '/home/*/.config/foo.conf',
+    'relative/*',
+    '\0ALL',
+]
+
+class TestPathMatcher(AATest):
+    tests = [
+        ('/etc/passwd',                 ['/etc/passwd', '/**']),
+        ('/etc/ld.so.cache',            ['/etc/ld.so.cache', '/**']),
+        ('/etc/ldXsoXcache',            ['/**']),
+        ('/usr/lib/libc.so.6',          ['/usr/lib/**.so*', '/**']),
+        ('/usr/lib/x86_64/',            ['/usr/lib/*/', '/**']),
+        ('/usr/lib64/foo/bar',          ['/usr/{lib,lib64}/foo/*', '/**']),
+        ('/usr/share/bar/',             ['/usr/share/ba?/', '/**']),
+        ('/home/user/.config/foo.conf', ['/**', '/home/*/.config/foo.conf']),
+        ('relative/foo',                ['relative/*']),
+        ('/',                           []),
+        ('\0ALL',                       ['\0ALL']),
+    ]
+
+    def _run_test(self, params, expected):
+        matcher = PathMatcher(ENTRIES)
+        self.assertEqual(matcher.match(params), expected)
+
+        # compare with a plain regex test of each entry
+        brute_force = [e for e in ENTRIES if re.search(convert_regexp(e), params)]
+        self.assertEqual(matcher.match(params), brute_force)
+
+class TestGetPathMatcher(AATest):
+    def test_reuse_and_invalidate(self):
+        rules = PathRules()
+        rules['/foo/*'] = {}
+        rules['/bar'] = {}
+        matcher = get_path_matcher(rules)
+        self.assertTrue(get_path_matcher(rules) is matcher)
+        self.assertEqual(matcher.match('/bar'), ['/bar'])
+
+        # changing an existing rule keeps the matcher
+        rules['/bar']['mode'] = set(['r'])
+        rules['/bar'] = {'mode': set(['w'])}
+        self.assertTrue(get_path_matcher(rules) is matcher)
+
+        rules['/baz/**'] = {}
+        new_matcher = get_path_matcher(rules)
+        self.assertFalse(new_matcher is matcher)
+        self.assertEqual(new_matcher.match('/baz/x/y'), ['/baz/**'])
+
+        rules.pop('/bar')
+        self.assertEqual(get_path_matcher(rules).match('/bar'), [])
+
+        del rules['/baz/**']
+        self.assertEqual(get_path_matcher(rules).match('/baz/x/y'), [])
+
+        # like in a hasher, reading a missing key adds it
+        rules['/new/*']['mode'] = set(['r'])
+        self.assertEqual(get_path_matcher(rules).match('/new/x'), ['/new/*'])
+
+        rules.update({'/upd': {}})
+        self.assertEqual(get_path_matcher(rules).match('/upd'), ['/upd'])
+
+        rules.clear()
+        self.assertEqual(get_path_matcher(rules).match('/upd'), [])
+
+    def test_copy_and_pickle(self):
+        rules = PathRules()
+        rules['/foo/*']['mode'] = set(['r'])
+        get_path_matcher(rules)
+
+        for copied in [deepcopy(rules), pickle.loads(pickle.dumps(rules, pickle.HIGHEST_PROTOCOL))]:
+            self.assertTrue(isinstance(copied, PathRules))
+            self.assertEqual(copied['/foo/*']['mode'], set(['r']))
+            self.assertEqual(get_path_matcher(copied).match('/foo/bar'), ['/foo/*'])
+            copied['/bar']['mode'] = set(['w'])
+            self.assertEqual(get_path_matcher(copied).match('/bar'), ['/bar'])
+
+    def test_plain_dict(self):
+        rules = {'/foo/*': {}}
+        self.assertEqual(get_path_matcher(rules).match('/foo/bar'), ['/foo/*'])
+        rules['/bar'] = {}
+        self.assertEqual(get_path_matcher(rules).match('/bar'), ['/bar'])
+
+class TestPathIndex(AATest):
+    def test_match(self):
+        index = PathIndex([
+            ('abstractions/foo', {'/etc/foo': {}, '/usr/lib/**.so*': {}}),
+            ('abstractions/bar', {'/usr/lib/**.so*': {}, '/usr/{lib,lib64}/foo/*': {}}),
+            ('abstractions/empty', {}),
+        ])
+        self.assertEqual(index.match('/etc/foo'), {'abstractions/foo': ['/etc/foo']})
+        self.assertEqual(index.match('/usr/lib/libc.so.6'), {'abstractions/foo': ['/usr/lib/**.so*'], 'abstractions/bar': ['/usr/lib/**.so*']})
+        self.assertEqual(index.match('/usr/lib/foo/bar.so'), {'abstractions/foo': ['/usr/lib/**.so*'], 'abstractions/bar': ['/usr/lib/**.so*', '/usr/{lib,lib64}/foo/*']})
+        self.assertEqual(index.match('/etc/bar'), {})
+
+        # an entry identical to the path always matches
+        self.assertEqual(index.match('/usr/lib/**.so*'), {'abstractions/foo': ['/usr/lib/**.so*'], 'abstractions/bar': ['/usr/lib/**.so*']})
+
+
+setup_all_loops(__name__)
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
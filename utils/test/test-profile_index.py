@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+# ------------------------------------------------------------------
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License published by the Free Software Foundation.
+#
+# ------------------------------------------------------------------
+
+import unittest
+from common_test import AATest, setup_all_loops, write_file
+
+import json
+import os
+
+from apparmor.profile_index import ProfileIndex, scan_profile_headers
+
+PROFILE_FOO = '''
+# a comment with { and }
+#include <tunables/global>
+
+/usr/bin/foo {
+  #include <abstractions/base>
+
+  /etc/foo.conf r,
+
+  ^hat {
+    /tmp/hat r,
+  }
+
+  profile child /usr/bin/child {
+    /tmp/child r,
+  }
+
+  if $FOO {
+    /tmp/cond r,
+  } else {
+    /tmp/notcond r,
+  }
+}
+
+profile bar /{usr/,}bin/bar* flags=(complain) {
+  /tmp/bar r,
+}
+
+profile baz {
+}
+'''
+
+class TestScanProfileHeaders(AATest):
+    def AASetup(self):
+        self.createTmpdir()
+
+    def test_scan(self):
+        filename = write_file(self.tmpdir, 'foo', PROFILE_FOO)
+        names, attachments = scan_profile_headers(filename)
+        self.assertEqual(names, ['/usr/bin/foo', 'bar', 'baz'])
+        self.assertEqual(attachments, {'/usr/bin/foo': '/usr/bin/foo', '/{usr/,}bin/bar*': 'bar'})
+
+    def test_no_profile(self):
+        filename = write_file(self.tmpdir, 'foo', '# nothing to see here\n')
+        self.assertEqual(scan_profile_headers(filename), ([], dict()))
+
+class TestProfileIndex(AATest):
+    def AASetup(self):
+        self.createTmpdir()
+        self.profile_dir = os.path.join(self.tmpdir, 'profiles')
+        os.mkdir(self.profile_dir)
+        self.cache_file = os.path.join(self.tmpdir, 'cache', 'profile_index.json')
+        self.foo = write_file(self.profile_dir, 'usr.bin.foo', PROFILE_FOO)
+        self.ping = write_file(self.profile_dir, 'bin.ping', '/{usr/,}bin/ping {\n}\n')
+        write_file(self.profile_dir, 'README', 'profile readme {\n}\n')
+
+    def skip(self, filename):
+        return os.path.basename(filename) == 'README'
+
+    def test_find(self):
+        index = ProfileIndex(self.profile_dir, self.skip)
+        self.assertEqual(index.find('/usr/bin/foo'), ('/usr/bin/foo', self.foo))
+        self.assertEqual(index.find('baz'), ('baz', self.foo))
+        self.assertEqual(index.find('/bin/bar2'), ('bar', self.foo))
+        self.assertEqual(index.find('/usr/bin/bar'), ('bar', self.foo))
+        self.assertEqual(index.find('/usr/bin/ping'), ('/{usr/,}bin/ping', self.ping))
+
+        # child profiles and hats aren't indexed
+        self.assertEqual(index.find('child'), (None, None))
+        self.assertEqual(index.find('/usr/bin/child'), (None, None))
+        self.assertEqual(index.find('hat'), (None, None))
+        # skipped files aren't indexed
+        self.assertEqual(index.find('readme'), (None, None))
+        self.assertEqual(index.find('/usr/bin/nothing'), (None, None))
+
+    def test_ambiguous_attachment(self):
+        write_file(self.profile_dir, 'ping2', 'profile ping2 /usr/bin/ping {\n}\n')
+        index = ProfileIndex(self.profile_dir, self.skip)
+        self.assertEqual(index.find('/usr/bin/ping'), (None, None))
+        self.assertEqual(index.find('ping2'), ('ping2', os.path.join(self.profile_dir, 'ping2')))
+
+    def test_cache(self):
+        index = ProfileIndex(self.profile_dir, self.skip, self.cache_file)
+        index.save()
+        with open(self.cache_file) as f_in:
+            self.assertEqual(sorted(json.load(f_in)['data']['files']), [self.ping, self.foo])
+
+        # a cached entry is used as long as the file doesn't change
+        with open(self.cache_file) as f_in:
+            cached = json.load(f_in)
+        cached['data']['files'][self.ping]['names'] = ['cached']
+        with open(self.cache_file, 'w') as f_out:
+            json.dump(cached, f_out)
+        index = ProfileIndex(self.profile_dir, self.skip, self.cache_file)
+        self.assertFalse(index.dirty)
+        self.assertEqual(index.find('cached'), ('cached', self.ping))
+
+        # changed files are scanned again
+        write_file(self.profile_dir, 'bin.ping', '/{usr/,}bin/ping {\n  /etc/hosts r,\n}\n')
+        index = ProfileIndex(self.profile_dir, self.skip, self.cache_file)
+        self.assertTrue(index.dirty)
+        self.assertEqual(index.find('cached'), (None, None))
+        self.assertEqual(index.find('/{usr/,}bin/ping'), ('/{usr/,}bin/ping', self.ping))
+
+    def test_removed_file(self):
+        index = ProfileIndex(self.profile_dir, self.skip, self.cache_file)
+        index.save()
+        os.unlink(self.foo)
+        index = ProfileIndex(self.profile_dir, self.skip, self.cache_file)
+        self.assertTrue(index.dirty)
+        self.assertEqual(index.find('baz'), (None, None))
+
+    def test_untrusted_cache(self):
+        index = ProfileIndex(self.profile_dir, self.skip, self.cache_file)
+        index.save()
+        with open(self.cache_file) as f_in:
+            cached = json.load(f_in)
+        cached['data']['files'][self.ping]['names'] = ['cached']
+        with open(self.cache_file, 'w') as f_out:
+            json.dump(cached, f_out)
+        os.chmod(self.cache_file, 0o666)
+
+        index = ProfileIndex(self.profile_dir, self.skip, self.cache_file)
+        self.assertEqual(index.find('cached'), (None, None))
+
+    def test_other_profile_dir(self):
+        index = ProfileIndex(self.profile_dir, self.skip, self.cache_file)
+        index.save()
+        other_dir = os.path.join(self.tmpdir, 'other')
+        os.mkdir(other_dir)
+        index = ProfileIndex(other_dir, self.skip, self.cache_file)
+        self.assertEqual(index.find('baz'), (None, None))
+
+setup_all_loops(__name__)
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
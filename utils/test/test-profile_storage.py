@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+# ------------------------------------------------------------------
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License published by the Free Software Foundation.
+#
+# ------------------------------------------------------------------
+
+import unittest
+from common_test import AATest, setup_all_loops
+
+from apparmor.common import AppArmorBug
+from apparmor.pathmatcher import PathRules
+from apparmor.profile_storage import ProfileStorage, RuleStorage, intern_name
+from apparmor.rule.capability import CapabilityRuleset
+
+from copy import deepcopy
+import pickle
+
+class TestProfileStorage(AATest):
+    def test_initial_keys(self):
+        prof = ProfileStorage()
+        self.assertEqual(list(prof.keys()), ['allow', 'capability', 'change_profile', 'network', 'rlimit'])
+        self.assertTrue(isinstance(prof['capability'], CapabilityRuleset))
+        self.assertEqual(prof['allow']['dbus'], [])
+
+    def test_container_created_on_access(self):
+        prof = ProfileStorage()
+        self.assertFalse('include' in prof)
+        prof['include']['abstractions/base'] = True
+        self.assertTrue('include' in prof)
+        self.assertEqual(prof['include'], {'abstractions/base': True})
+
+    def test_unset_scalar(self):
+        prof = ProfileStorage()
+        self.assertEqual(prof.get('flags', 'default'), 'default')
+        # like with hasher(), reading an unset key stores an empty hasher
+        self.assertFalse(prof['flags'])
+        self.assertTrue('flags' in prof)
+        prof['flags']['foo'] = 1
+        self.assertEqual(prof['flags'], {'foo': 1})
+
+        prof['flags'] = 'complain'
+        self.assertEqual(prof.get('flags', 'default'), 'complain')
+        self.assertEqual(prof.pop('flags'), 'complain')
+        self.assertFalse('flags' in prof)
+        self.assertEqual(prof.pop('flags', None), None)
+
+        with self.assertRaises(KeyError):
+            del prof['flags']
+
+    def test_unknown_key(self):
+        prof = ProfileStorage()
+        with self.assertRaises(AppArmorBug):
+            prof['foo']
+        with self.assertRaises(AppArmorBug):
+            prof['foo']['bar'] = 1
+        with self.assertRaises(AppArmorBug):
+            prof['foo'] = True
+        self.assertFalse('foo' in prof)
+        self.assertEqual(prof.get('foo'), None)
+
+    def test_rule_storage(self):
+        prof = ProfileStorage()
+        self.assertTrue(isinstance(prof['allow'], RuleStorage))
+        self.assertTrue(isinstance(prof['allow']['path'], PathRules))
+        self.assertFalse('deny' in prof)
+        self.assertTrue(isinstance(prof['deny'], RuleStorage))
+        self.assertTrue(isinstance(prof['deny']['path'], PathRules))
+        self.assertEqual(list(prof['deny'].keys()), ['path'])
+
+        prof['deny']['link']['/foo']['to'] = '/bar'
+        self.assertEqual(prof['deny']['link'], {'/foo': {'to': '/bar'}})
+        self.assertEqual(prof['deny'].get('dbus'), None)
+        with self.assertRaises(AppArmorBug):
+            prof['allow']['foo']
+
+    def test_copy_and_pickle(self):
+        prof = ProfileStorage()
+        prof['name'] = '/usr/bin/foo'
+        prof['allow']['path']['/etc/foo']['mode'] = set(['r'])
+
+        for copied in [deepcopy(prof), pickle.loads(pickle.dumps(prof, pickle.HIGHEST_PROTOCOL))]:
+            self.assertEqual(copied['name'], '/usr/bin/foo')
+            self.assertEqual(copied['allow']['path']['/etc/foo']['mode'], set(['r']))
+            self.assertEqual(list(copied.keys()), list(prof.keys()))
+
+        self.assertEqual(dict(prof.items())['name'], '/usr/bin/foo')
+
+    def test_intern_name(self):
+        name = ''.join(['/usr/bin/', 'foo'])
+        self.assertEqual(intern_name(name), '/usr/bin/foo')
+        self.assertTrue(intern_name(name) is intern_name(''.join(['/usr/', 'bin/foo'])))
+
+
+setup_all_loops(__name__)
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
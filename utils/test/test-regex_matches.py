@@ -10,11 +10,13 @@
 # ------------------------------------------------------------------
 
 import apparmor.aa as aa
+import pickle
+import re
 import unittest
 from common_test import AATest, setup_all_loops
 from apparmor.common import AppArmorBug, AppArmorException
 
-from apparmor.regex import strip_quotes, parse_profile_start_line, re_match_include, RE_PROFILE_START, RE_PROFILE_CAP
+from apparmor.regex import strip_quotes, parse_profile_start_line, re_match_include, RE_PROFILE_START, RE_PROFILE_CAP, LazyRegex
 
 
 class AARegexTest(AATest):
@@ -515,6 +517,28 @@ class TestStripQuotes(AATest):
         self.assertEqual('"""foo"bar"""', strip_quotes('""""foo"bar""""'))
 
 
+class TestLazyRegex(AATest):
+    def test_lazy_compile(self):
+        regex = LazyRegex('^foo(?P<bar>bar)?$', re.IGNORECASE)
+        self.assertEqual(regex._regex, None)
+        self.assertEqual(regex.search('FOOBAR').group('bar'), 'BAR')
+        self.assertEqual(regex.match('baz'), None)
+        self.assertEqual(regex.pattern, '^foo(?P<bar>bar)?$')
+        self.assertNotEqual(regex._regex, None)
+
+    def test_pickle(self):
+        regex = LazyRegex('^foo(?P<bar>bar)?$', re.IGNORECASE)
+        for used in [False, True]:
+            if used:
+                regex.search('foo')
+            copied = pickle.loads(pickle.dumps(regex))
+            self.assertEqual(copied._regex, None)
+            self.assertEqual(copied.search('FOOBAR').group('bar'), 'BAR')
+
+    def test_private_attribute(self):
+        with self.assertRaises(AttributeError):
+            LazyRegex('foo')._nonexistent
+
 
 setup_all_loops(__name__)
 if __name__ == '__main__':
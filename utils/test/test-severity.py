@@ -14,6 +14,7 @@
 #    GNU General Public License for more details.
 #
 # ----------------------------------------------------------------------
+import os
 import unittest
 from common_test import AATest, setup_all_loops
 
@@ -57,6 +58,30 @@ class SeverityTest(SeverityBaseTest):
         with self.assertRaises(AppArmorException):
             self._simple_severity_w_perm('unexpected_unput', 'rw', 6)
 
+class SeverityRankManyTest(SeverityBaseTest):
+    def test_rank_many(self):
+        resources = [test[0][0] for test in SeverityTest.tests]
+        modes = [test[0][1] for test in SeverityTest.tests]
+        expected = [test[1] for test in SeverityTest.tests]
+        self.assertEqual(self.sev_db.rank_many(resources, modes), expected)
+
+    def test_rank_many_single_mode(self):
+        resources = ['/dev/doublehit', '/usr/bin/whatis', '/etc', 'CAP_SETPCAP', '/dev/doublehit']
+        self.assertEqual(self.sev_db.rank_many(resources, 'x'), [0, 5, 'unknown', 9, 0])
+        self.assertEqual(self.sev_db.rank_many(resources, 'x'), [self.sev_db.rank(res, 'x') for res in resources])
+
+    def test_rank_many_empty(self):
+        self.assertEqual(self.sev_db.rank_many([]), [])
+
+    def test_rank_many_invalid_modes(self):
+        with self.assertRaises(AppArmorException):
+            self.sev_db.rank_many(['/etc', '/dev/doublehit'], ['r'])
+
+    def test_max_rank(self):
+        self.assertEqual(self.sev_db.max_rank([3, 'unknown', 7]), 7)
+        self.assertEqual(self.sev_db.max_rank(['unknown']), 'unknown')
+        self.assertEqual(self.sev_db.max_rank([]), 'unknown')
+
 class SeverityTestCap(SeverityBaseTest):
     tests = [
         ('KILL', 8),
@@ -173,6 +198,39 @@ class SeverityDBTest(AATest):
         with self.assertRaises(AppArmorException):
             severity.Severity()
 
+class SeverityCacheTest(AATest):
+    def AASetup(self):
+        self.createTmpdir()
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.db_file = self.writeTmpfile('severity.db', 'CAP_LEASE 8\n/etc/passwd*    4 8 0\n/home/*/.ssh/** 7 9 0\n')
+
+    def test_cached_db(self):
+        sev_db = severity.Severity(self.db_file, 'unknown', self.cache_dir)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, 'severity'))), 1)
+
+        cached_db = severity.Severity(self.db_file, 'unknown', self.cache_dir)
+        self.assertEqual(cached_db.severity, sev_db.severity)
+        self.assertEqual(cached_db.rank('/home/foo/.ssh/id_rsa', 'w'), 9)
+        self.assertEqual(cached_db.rank('/etc/passwd-', 'r'), 4)
+        self.assertEqual(cached_db.rank('CAP_LEASE'), 8)
+
+    def test_changed_db(self):
+        severity.Severity(self.db_file, 'unknown', self.cache_dir)
+        self.writeTmpfile('severity.db', 'CAP_LEASE 3\n')
+        self.assertEqual(severity.Severity(self.db_file, 'unknown', self.cache_dir).rank('CAP_LEASE'), 3)
+
+class SeverityVariableCacheTest(SeverityBaseTest):
+    def test_changed_variables(self):
+        tunables = self.writeTmpfile('tunables', '@{foo}=/proc/\n')
+        self.sev_db.load_variables(tunables)
+        self.assertEqual(self.sev_db.rank('@{foo}/sys/vm/overcommit_memory', 'r'), 6)
+        self.sev_db.unload_variables()
+
+        tunables = self.writeTmpfile('tunables', '@{foo}=/home/\n')
+        self.sev_db.load_variables(tunables)
+        self.assertEqual(self.sev_db.rank('@{foo}/sys/vm/overcommit_memory', 'r'), 4)
+        self.sev_db.unload_variables()
+
 setup_all_loops(__name__)
 if __name__ == '__main__':
     unittest.main(verbosity=2)
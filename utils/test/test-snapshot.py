@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+# ------------------------------------------------------------------
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of version 2 of the GNU General Public
+#    License published by the Free Software Foundation.
+#
+# ------------------------------------------------------------------
+
+import unittest
+from common_test import AATest, setup_all_loops
+
+from apparmor.common import hasher
+from apparmor.profile_storage import ProfileStorage
+from apparmor.snapshot import SnapshotStore, snapshot_copy
+
+def _profile():
+    prof = hasher()
+    prof['/usr/bin/foo']['allow']['path']['/etc/foo']['mode'] = set(['r'])
+    prof['/usr/bin/foo']['include']['abstractions/base'] = True
+    return prof
+
+class TestSnapshotCopy(AATest):
+    def test_copy(self):
+        prof = _profile()
+        copied = snapshot_copy(prof)
+        self.assertEqual(copied, prof)
+
+        prof['/usr/bin/foo']['include']['abstractions/bash'] = True
+        self.assertEqual(list(copied['/usr/bin/foo']['include'].keys()), ['abstractions/base'])
+
+        # still a hasher
+        self.assertEqual(copied['/usr/bin/bar']['x'], {})
+
+    def test_copy_profile_storage(self):
+        prof = ProfileStorage()
+        prof['include']['abstractions/base'] = True
+        copied = snapshot_copy(prof)
+        self.assertTrue(isinstance(copied, ProfileStorage))
+        self.assertEqual(copied['include'], prof['include'])
+        self.assertFalse(copied['capability'] is prof['capability'])
+
+    def test_copy_unpicklable(self):
+        data = {'func': lambda x: x}
+        copied = snapshot_copy(data)
+        self.assertEqual(copied, data)
+        self.assertFalse(copied is data)
+
+class TestSnapshotStore(AATest):
+    def test_snapshot(self):
+        prof = _profile()
+        store = SnapshotStore()
+        store['foo'] = prof
+
+        # changes after storing the snapshot don't affect it
+        prof['/usr/bin/foo']['allow']['path']['/etc/bar']['mode'] = set(['w'])
+        self.assertEqual(list(store['foo']['/usr/bin/foo']['allow']['path'].keys()), ['/etc/foo'])
+
+        # the value is only unpickled once
+        self.assertTrue(store['foo'] is store['foo'])
+        self.assertTrue(store.get('foo') is store['foo'])
+
+    def test_dict_methods(self):
+        store = SnapshotStore()
+        store['foo'] = _profile()
+        store['bar'] = _profile()
+
+        self.assertEqual(sorted(store.keys()), ['bar', 'foo'])
+        self.assertEqual(dict(store.items())['foo'], _profile())
+        self.assertEqual(store.values(), [_profile(), _profile()])
+        self.assertEqual(store.pop('bar'), _profile())
+        self.assertEqual(store.pop('bar', None), None)
+        self.assertEqual(store.get('bar'), None)
+
+    def test_missing(self):
+        store = SnapshotStore()
+        store['foo']['bar']['baz'] = True
+        self.assertEqual(store['foo'], {'bar': {'baz': True}})
+
+
+setup_all_loops(__name__)
+if __name__ == '__main__':
+    unittest.main(verbosity=2)